@@ -0,0 +1,51 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from app.db.database import get_db
+from sqlalchemy.orm import Session
+from app.db.models import Keg, User, UserRole
+from app.core.auth import get_current_user
+from app.services.analytics import maybe_refresh_dwell, brewery_summary, keg_summary, idle_kegs
+from typing import Optional
+
+router = APIRouter()
+
+def resolve_brewery(current_user: User, brewery_id: Optional[str]) -> str:
+    # Solo el admin global consulta otras cervecerías
+    if brewery_id is None:
+        brewery_id = current_user.brewery_id
+    if current_user.role != UserRole.GLOBAL_ADMIN and brewery_id != current_user.brewery_id:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    if brewery_id is None:
+        raise HTTPException(status_code=400, detail="brewery_id is required")
+    return brewery_id
+
+@router.get("/dwell")
+def brewery_dwell(brewery_id: Optional[str] = None, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    brewery_id = resolve_brewery(current_user, brewery_id)
+    maybe_refresh_dwell(db)
+    summary = brewery_summary(db, brewery_id)
+    summary["brewery_id"] = brewery_id
+    return summary
+
+@router.get("/kegs/{keg_id}")
+def keg_dwell(keg_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    keg = db.query(Keg.id, Keg.brewery_id).filter(Keg.id == keg_id).first()
+    if keg is None:
+        raise HTTPException(status_code=404, detail="Keg not found")
+    if current_user.role == UserRole.USER and keg.brewery_id != current_user.brewery_id:
+        raise HTTPException(status_code=403, detail="No tienes acceso a este barril")
+    maybe_refresh_dwell(db)
+    summary = keg_summary(db, keg_id)
+    summary["keg_id"] = keg_id
+    return summary
+
+@router.get("/idle")
+def idle(
+    brewery_id: Optional[str] = None,
+    days: int = Query(14, ge=0),
+    limit: int = Query(500, ge=1, le=5000),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    brewery_id = resolve_brewery(current_user, brewery_id)
+    maybe_refresh_dwell(db)
+    return idle_kegs(db, brewery_id, days, limit)
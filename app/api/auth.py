@@ -1,11 +1,13 @@
 from fastapi import APIRouter, HTTPException, Depends, Query
 from pydantic import BaseModel, EmailStr
-from app.db.database import SessionLocal
+from app.db.database import SessionRunner, get_db, get_session_runner
+from sqlalchemy.orm import Session
 from app.db.models import User, Brewery
-from passlib.context import CryptContext
 from jose import jwt
 from app.core.config import get_settings
+from app.core.security import hash_password_async, verify_password_async
 from app.services.email_service import send_email
+from app.services import token_store
 import os
 from jose import JWTError
 from fastapi.security import OAuth2PasswordBearer
@@ -13,7 +15,6 @@ from datetime import datetime, timezone
 
 router = APIRouter()
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 settings = get_settings()
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
@@ -29,30 +30,52 @@ class ResetPasswordRequest(BaseModel):
     token: str
     password: str
 
+def _login_user(db, email: str):
+    user = db.query(
+        User.id, User.email, User.role, User.brewery_id, User.hashed_password, Brewery.name.label("brewery_name")
+    ).outerjoin(Brewery, Brewery.id == User.brewery_id).filter(User.email == email).first()
+    # Cierra la transacción de lectura: la conexión vuelve al pool mientras se verifica la contraseña
+    db.rollback()
+    return user
+
+def _store_password(db, user_id: str, hashed_password: str, previous_hash: str = None):
+    query = db.query(User).filter(User.id == user_id)
+    if previous_hash is not None:
+        # Rehash tras el login: no pisar un cambio de contraseña hecho mientras tanto
+        query = query.filter(User.hashed_password == previous_hash)
+    query.update({"hashed_password": hashed_password}, synchronize_session=False)
+    db.commit()
+
 @router.post("/login")
-def login(data: LoginRequest):
-    db = SessionLocal()
-    user = db.query(User).filter(User.email == data.email).first()
-    brewery = None
-    if user and user.brewery_id:
-        brewery = db.query(Brewery).filter(Brewery.id == user.brewery_id).first()
-    db.close()
-    if not user or not pwd_context.verify(data.password, getattr(user, 'hashed_password', '')):
+async def login(data: LoginRequest, db: SessionRunner = Depends(get_session_runner)):
+    # bcrypt fuera de la sesión: un pico de logins no agota el pool de conexiones
+    user = await db.run(_login_user, data.email)
+    if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    valid, new_hash = await verify_password_async(data.password, user.hashed_password or '')
+    if not valid:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    if new_hash:
+        # Hash con parámetros antiguos: se regenera de forma transparente
+        await db.run(_store_password, user.id, new_hash, user.hashed_password)
     token = jwt.encode({
         "sub": user.email,
         "user_id": user.id,
         "role": user.role,  # Incluir el rol en el JWT
         "brewery_id": user.brewery_id,
-        "brewery_name": brewery.name if brewery else None
+        "brewery_name": user.brewery_name
     }, settings.SECRET_KEY, algorithm="HS256")
     return {"access_token": token, "token_type": "bearer"}
 
+def _reset_recipient(db, email: str):
+    user = db.query(User.id, User.email).filter(User.email == email).first()
+    # Libera la conexión antes de encolar el email (enqueue usa su propia sesión)
+    db.rollback()
+    return user
+
 @router.post("/forgot-password")
-async def forgot_password(data: ForgotPasswordRequest):
-    db = SessionLocal()
-    user = db.query(User).filter(User.email == data.email).first()
-    db.close()
+async def forgot_password(data: ForgotPasswordRequest, db: SessionRunner = Depends(get_session_runner)):
+    user = await db.run(_reset_recipient, data.email)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     from datetime import datetime, timedelta, timezone
@@ -67,12 +90,21 @@ async def forgot_password(data: ForgotPasswordRequest):
     )
     return {"message": "reset email sent"}
 
-used_reset_tokens = set()
+def _reset_user_exists(db, token: str, user_id: str) -> bool:
+    if token_store.is_used(db, token):
+        raise HTTPException(status_code=400, detail="Reset link already used")
+    exists = db.query(User.id).filter(User.id == user_id).first() is not None
+    db.rollback()
+    return exists
+
+def _reset_password(db, token: str, exp, user_id: str, hashed_password: str):
+    # El consumo del token y la nueva contraseña se confirman en la misma transacción
+    if not token_store.consume(db, token, "reset", exp):
+        raise HTTPException(status_code=400, detail="Reset link already used")
+    _store_password(db, user_id, hashed_password)
 
 @router.post("/reset-password")
-def reset_password(data: ResetPasswordRequest):
-    if data.token in used_reset_tokens:
-        raise HTTPException(status_code=400, detail="Reset link already used")
+async def reset_password(data: ResetPasswordRequest, db: SessionRunner = Depends(get_session_runner)):
     try:
         payload = jwt.decode(data.token, settings.SECRET_KEY, algorithms=["HS256"])
         user_id = payload.get("user_id")
@@ -85,20 +117,16 @@ def reset_password(data: ResetPasswordRequest):
             raise HTTPException(status_code=400, detail="Invalid token")
     except JWTError:
         raise HTTPException(status_code=400, detail="Invalid or expired token")
-    db = SessionLocal()
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
-        db.close()
+    if not await db.run(_reset_user_exists, data.token, user_id):
         raise HTTPException(status_code=404, detail="User not found")
-    user.hashed_password = pwd_context.hash(data.password)
-    db.commit()
-    db.close()
-    used_reset_tokens.add(data.token)
+    # Hash antes de escribir, sin sesión abierta
+    hashed_password = await hash_password_async(data.password)
+    await db.run(_reset_password, data.token, exp, user_id, hashed_password)
     return {"message": "password reset ok"}
 
 @router.get("/reset-password/validate")
-def validate_reset_token(token: str = Query(...)):
-    if token in used_reset_tokens:
+def validate_reset_token(token: str = Query(...), db: Session = Depends(get_db)):
+    if token_store.is_used(db, token):
         raise HTTPException(status_code=400, detail="Reset link already used")
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
@@ -116,8 +144,13 @@ class ChangePasswordRequest(BaseModel):
     current_password: str
     new_password: str
 
+def _current_hash(db, user_id: str):
+    hashed_password = db.query(User.hashed_password).filter(User.id == user_id).scalar()
+    db.rollback()
+    return hashed_password
+
 @router.post("/change-password")
-def change_password(data: ChangePasswordRequest, token: str = Depends(oauth2_scheme)):
+async def change_password(data: ChangePasswordRequest, token: str = Depends(oauth2_scheme), db: SessionRunner = Depends(get_session_runner)):
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
         user_id = payload.get("user_id")
@@ -125,12 +158,8 @@ def change_password(data: ChangePasswordRequest, token: str = Depends(oauth2_sch
             raise HTTPException(status_code=401, detail="Token inválido")
     except JWTError:
         raise HTTPException(status_code=401, detail="Token inválido")
-    db = SessionLocal()
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user or not pwd_context.verify(data.current_password, user.hashed_password):
-        db.close()
+    current_hash = await db.run(_current_hash, user_id)
+    if not (await verify_password_async(data.current_password, current_hash))[0]:
         raise HTTPException(status_code=400, detail="Contraseña actual incorrecta")
-    user.hashed_password = pwd_context.hash(data.new_password)
-    db.commit()
-    db.close()
-    return {"message": "Contraseña cambiada correctamente"} 
\ No newline at end of file
+    await db.run(_store_password, user_id, await hash_password_async(data.new_password))
+    return {"message": "Contraseña cambiada correctamente"}
@@ -1,10 +1,13 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Response
 from pydantic import BaseModel
-from app.db.database import SessionLocal
+from app.db.database import get_db, with_session
+from sqlalchemy.orm import Session
 from app.db.models import Brewery, User, UserRole
 from app.core.auth import get_current_user
+from app.core.etag import cache_headers, etag_matches, make_etag, not_modified
+from app.services.counters import BREWERIES_COUNTER, counter_value, touch_counter
 from sqlalchemy.exc import IntegrityError
-from typing import List
+from typing import List, Optional
 
 router = APIRouter()
 
@@ -19,55 +22,60 @@ class BreweryCreate(BaseModel):
     name: str
 
 @router.get("/", response_model=List[BreweryOut])
-def list_breweries(current_user: User = Depends(get_current_user)):
+@with_session
+def list_breweries(
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
     if current_user.role not in [UserRole.GLOBAL_ADMIN, UserRole.ADMIN, UserRole.MODERATOR]:
         raise HTTPException(status_code=403, detail="Not enough permissions")
-    db = SessionLocal()
+    etag = make_etag("breweries", counter_value(db, BREWERIES_COUNTER))
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    response.headers.update(cache_headers(etag))
     breweries = db.query(Brewery).all()
-    db.close()
     return breweries
 
 @router.post("/", response_model=BreweryOut)
-def create_brewery(data: BreweryCreate, current_user: User = Depends(get_current_user)):
+@with_session
+def create_brewery(data: BreweryCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     if current_user.role != UserRole.GLOBAL_ADMIN:
         raise HTTPException(status_code=403, detail="Not enough permissions")
-    db = SessionLocal()
     brewery = Brewery(name=data.name, active=True)
     db.add(brewery)
+    touch_counter(db, BREWERIES_COUNTER)
     try:
         db.commit()
         db.refresh(brewery)
     except IntegrityError:
         db.rollback()
-        db.close()
         raise HTTPException(status_code=400, detail="Brewery already exists")
-    db.close()
     return brewery
 
 @router.patch("/{brewery_id}/deactivate")
-def deactivate_brewery(brewery_id: str, current_user: User = Depends(get_current_user)):
+@with_session
+def deactivate_brewery(brewery_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     if current_user.role != UserRole.GLOBAL_ADMIN:
         raise HTTPException(status_code=403, detail="Not enough permissions")
-    db = SessionLocal()
     brewery = db.query(Brewery).filter(Brewery.id == brewery_id).first()
     if brewery is None:
-        db.close()
         raise HTTPException(status_code=404, detail="Brewery not found")
     setattr(brewery, 'active', False)
+    touch_counter(db, BREWERIES_COUNTER)
     db.commit()
-    db.close()
     return {"success": True}
 
 @router.delete("/{brewery_id}")
-def delete_brewery(brewery_id: str, current_user: User = Depends(get_current_user)):
+@with_session
+def delete_brewery(brewery_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     if current_user.role != UserRole.GLOBAL_ADMIN:
         raise HTTPException(status_code=403, detail="Not enough permissions")
-    db = SessionLocal()
     brewery = db.query(Brewery).filter(Brewery.id == brewery_id).first()
     if brewery is None:
-        db.close()
         raise HTTPException(status_code=404, detail="Brewery not found")
     db.delete(brewery)
+    touch_counter(db, BREWERIES_COUNTER)
     db.commit()
-    db.close()
     return {"success": True} 
\ No newline at end of file
@@ -1,22 +1,87 @@
 from fastapi import APIRouter, Depends, HTTPException
-from app.core.auth import get_current_user
+from pydantic import ValidationError
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import ArgumentError
+from app.core.auth import get_current_user, principal_cache
+from app.db.database import pool_stats
+from app.core.security import password_pool_stats
+from app.services.keg_stats import stats_cache
+from app.services.labels import qr_cache
 from app.db.models import User, UserRole
-from app.core.config import get_settings
+from app.core.config import Settings, get_settings, reload_settings, write_env, PROCESS_ENV
 from typing import Dict
 
 router = APIRouter()
 
+# Se leen al arrancar (motor, pools, tamaños de caché...): el cambio se guarda pero requiere reiniciar
+STARTUP_ONLY_PREFIXES = ("DB_", "SQLITE_", "THREADPOOL_", "BCRYPT_", "AUTH_CACHE_", "TOKEN_CACHE_", "EMAIL_TEMPLATE_")
+# Nunca se devuelven en claro: GET /api/config las enmascara y PUT ignora el valor enmascarado
+SECRET_FIELDS = {"SECRET_KEY", "SMTP_PASS", "METRICS_TOKEN"}
+REDACTED = "***"
+STARTUP_ONLY = {"KEG_STATS_TTL", "KEG_SEARCH_INDEX_TTL", "PASSWORD_HASH_WORKERS", "PASSWORD_HASH_MAX_PENDING", "EMAIL_WORKER_ENABLED"}
+
+def public_value(key: str, value) -> str:
+    if value is None:
+        return ""
+    if key in SECRET_FIELDS:
+        return REDACTED if value else ""
+    if key == "DB_URL":
+        # La URL se muestra, pero sin la contraseña de la base de datos
+        try:
+            return make_url(value).render_as_string(hide_password=True)
+        except ArgumentError:
+            return REDACTED
+    return str(value)
+
 @router.get("/", response_model=Dict[str, str])
 def get_config(current_user: User = Depends(get_current_user)):
     if current_user.role != UserRole.GLOBAL_ADMIN:
         raise HTTPException(status_code=403, detail="Not enough permissions")
     settings = get_settings()
-    # Devolver solo los campos relevantes
-    return settings.dict()
+    # Devolver solo los campos relevantes, como texto (igual que en .env)
+    return {key: public_value(key, value) for key, value in settings.dict().items()}
+
+@router.get("/cache-stats")
+def get_cache_stats(current_user: User = Depends(get_current_user)):
+    if current_user.role != UserRole.GLOBAL_ADMIN:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    return {
+        "auth": principal_cache.stats(),
+        "keg_stats": stats_cache.stats(),
+        "qr_labels": qr_cache.stats(),
+    }
+
+@router.get("/pool-stats")
+def get_pool_stats(current_user: User = Depends(get_current_user)):
+    if current_user.role != UserRole.GLOBAL_ADMIN:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    stats = pool_stats()
+    stats["password_hashing"] = password_pool_stats()
+    return stats
 
 @router.put("/")
 def update_config(config: Dict[str, str], current_user: User = Depends(get_current_user)):
     if current_user.role != UserRole.GLOBAL_ADMIN:
         raise HTTPException(status_code=403, detail="Not enough permissions")
-    # save_config(config) # This line is removed as per the edit hint
-    return {"message": "Config updated"} 
\ No newline at end of file
+    unknown = sorted(set(config) - set(Settings.model_fields))
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown config keys: {', '.join(unknown)}")
+    # Guardar el formulario tal como se leyó no debe sobrescribir los secretos con el valor enmascarado
+    current = get_settings().dict()
+    config = {
+        key: value for key, value in config.items()
+        if not (value == public_value(key, current[key]) and value != str(current[key]))
+    }
+    try:
+        Settings(**config)
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=[{"key": err["loc"][0], "msg": err["msg"]} for err in e.errors()])
+    # .env es compartido: el resto de workers lo recargan al detectar el cambio (reload_if_changed)
+    write_env(config)
+    reload_settings()
+    return {
+        "message": "Config updated",
+        "restart_required": sorted(k for k in config if k in STARTUP_ONLY or k.startswith(STARTUP_ONLY_PREFIXES)),
+        # Definidas en el entorno del proceso: tienen prioridad sobre .env
+        "overridden_by_environment": sorted(k for k in config if k in PROCESS_ENV),
+    } 
\ No newline at end of file
@@ -1,20 +1,21 @@
 from fastapi import APIRouter, HTTPException, Depends, Query
 from pydantic import BaseModel, EmailStr
-from app.db.database import SessionLocal
+from app.db.database import SessionRunner, get_db, get_session_runner
+from sqlalchemy.orm import Session
 from app.db.models import User, Brewery, UserRole
 from app.core.config import get_settings
-from passlib.context import CryptContext
+from app.core.security import hash_password_async
 from jose import jwt, JWTError
 from sqlalchemy.exc import IntegrityError
 import datetime
 from app.services.email_service import send_invite_email
+from app.services import token_store
+from app.services.counters import USERS_COUNTER, touch_counter
 import asyncio
 from datetime import datetime, timezone
 
 router = APIRouter()
 settings = get_settings()
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-used_invite_tokens = set()
 
 class InviteRequest(BaseModel):
     email: EmailStr
@@ -26,12 +27,15 @@ class RegisterRequest(BaseModel):
     token: str
     password: str
 
+def _brewery_exists(db, brewery_id: str) -> bool:
+    exists = db.query(Brewery.id).filter(Brewery.id == brewery_id).first() is not None
+    # Libera la conexión antes de encolar el email (enqueue usa su propia sesión)
+    db.rollback()
+    return exists
+
 @router.post("/generate")
-async def generate_invite(data: InviteRequest):
-    db = SessionLocal()
-    brewery = db.query(Brewery).filter(Brewery.id == data.brewery_id).first()
-    db.close()
-    if not brewery:
+async def generate_invite(data: InviteRequest, db: SessionRunner = Depends(get_session_runner)):
+    if not await db.run(_brewery_exists, data.brewery_id):
         raise HTTPException(status_code=404, detail="Brewery not found")
     import datetime
     from datetime import timezone
@@ -47,27 +51,18 @@ async def generate_invite(data: InviteRequest):
     await send_invite_email(data.email, invite_link)
     return {"invite_link": invite_link}
 
-@router.post("/register")
-def register_user(data: RegisterRequest):
-    if data.token in used_invite_tokens:
+def _registered(db, token: str, email: str) -> bool:
+    if token_store.is_used(db, token):
         raise HTTPException(status_code=400, detail="Invite link already used")
+    exists = db.query(User.id).filter(User.email == email).first() is not None
+    # Cierra la transacción de lectura antes del hash
+    db.rollback()
+    return exists
+
+def _register(db, token: str, exp, email: str, brewery_id: str, role: str, hashed_password: str):
     try:
-        payload = jwt.decode(data.token, settings.SECRET_KEY, algorithms=["HS256"])
-        email = payload["email"]
-        brewery_id = payload["brewery_id"]
-        role = payload["role"]
-        exp = payload.get("exp")
-        if exp:
-            now = datetime.now(timezone.utc).timestamp()
-            if now > exp:
-                raise HTTPException(status_code=400, detail="Invite link expired")
-    except JWTError:
-        raise HTTPException(status_code=400, detail="Invalid or expired token")
-    db = SessionLocal()
-    try:
-        if db.query(User).filter(User.email == email).first():
-            raise HTTPException(status_code=400, detail="User already exists")
-        hashed_password = pwd_context.hash(data.password)
+        if not token_store.consume(db, token, "invite", exp):
+            raise HTTPException(status_code=400, detail="Invite link already used")
         user = User(
             email=email,
             hashed_password=hashed_password,
@@ -76,18 +71,36 @@ def register_user(data: RegisterRequest):
             brewery_id=brewery_id
         )
         db.add(user)
+        touch_counter(db, USERS_COUNTER)
         db.commit()
-        used_invite_tokens.add(data.token)
-        return {"success": True}
     except IntegrityError:
         db.rollback()
         raise HTTPException(status_code=400, detail="Integrity error")
-    finally:
-        db.close()
+
+@router.post("/register")
+async def register_user(data: RegisterRequest, db: SessionRunner = Depends(get_session_runner)):
+    try:
+        payload = jwt.decode(data.token, settings.SECRET_KEY, algorithms=["HS256"])
+        email = payload["email"]
+        brewery_id = payload["brewery_id"]
+        role = payload["role"]
+        exp = payload.get("exp")
+        if exp:
+            now = datetime.now(timezone.utc).timestamp()
+            if now > exp:
+                raise HTTPException(status_code=400, detail="Invite link expired")
+    except JWTError:
+        raise HTTPException(status_code=400, detail="Invalid or expired token")
+    if await db.run(_registered, data.token, email):
+        raise HTTPException(status_code=400, detail="User already exists")
+    # bcrypt sin sesión abierta; el consumo del token y el alta van en la misma transacción
+    hashed_password = await hash_password_async(data.password)
+    await db.run(_register, data.token, exp, email, brewery_id, role, hashed_password)
+    return {"success": True}
 
 @router.get("/validate")
-def validate_invite_token(token: str = Query(...)):
-    if token in used_invite_tokens:
+def validate_invite_token(token: str = Query(...), db: Session = Depends(get_db)):
+    if token_store.is_used(db, token):
         raise HTTPException(status_code=400, detail="Invite link already used")
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
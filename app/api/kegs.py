@@ -1,12 +1,44 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
-from pydantic import BaseModel
-from app.db.database import SessionLocal
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, UploadFile, File
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ValidationError
+from app.db.database import SessionLocal, SessionRunner, get_db, get_session_runner, with_session
+from sqlalchemy.orm import Session
 from app.db.models import Keg, KegType, KegConnector, KegState, User, UserRole, KegStateHistory, Brewery
-from app.core.auth import get_current_user
+from app.core.auth import get_current_user, get_stream_user
+from app.core.config import get_settings
+from app.core.etag import cache_headers, etag_matches, make_etag, not_modified
+from app.services.labels import build_labels_pdf
+from app.services.keg_stats import get_stats, invalidate_stats
+from app.services.keg_changes import add_tombstones, changes_since, list_version_columns, next_versions
+from app.services.counters import BREWERIES_COUNTER, counter_column
+from app.services.keg_sync import apply_operations
+from app.services import keg_search
+from app.services import events
+from app.services.keg_io import IMPORT_FORMATS, EXPORT_MEDIA_TYPES, detect_format, iter_import_rows, format_validation_error, serialize_rows
+from sqlalchemy import bindparam, insert, update
 from sqlalchemy.exc import IntegrityError
 from typing import List, Optional
+from datetime import datetime
+import base64
+import csv
+import json
 
 router = APIRouter()
+settings = get_settings()
+
+def encode_cursor(keg_id: str) -> str:
+    raw = json.dumps({"id": keg_id}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> str:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        return json.loads(raw)["id"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
 
 class KegOut(BaseModel):
     id: str
@@ -21,6 +53,8 @@ class KegOut(BaseModel):
     brewery_name: Optional[str] = None
     location: Optional[str] = None
     user_email: Optional[str] = None
+    version: Optional[int] = None
+    updated_at: Optional[datetime] = None
     class Config:
         orm_mode = True
         from_attributes = True
@@ -36,188 +70,619 @@ class KegCreate(BaseModel):
     brewery_id: str
     location: Optional[str] = None
 
+# Columnas exactas de KegOut: una sola consulta, sin hidratar objetos ORM ni lazy loads
+KEG_OUT_COLUMNS = (
+    Keg.id,
+    Keg.name,
+    Keg.type,
+    Keg.connector,
+    Keg.capacity,
+    Keg.current_content,
+    Keg.beer_type,
+    Keg.state,
+    Keg.brewery_id,
+    Brewery.name.label("brewery_name"),
+    Keg.location,
+    Keg.version,
+    Keg.updated_at,
+)
+
+def keg_out_query(db, isouter: bool = False):
+    return db.query(*KEG_OUT_COLUMNS).join(Brewery, Keg.brewery_id == Brewery.id, isouter=isouter)
+
+# Tamaño de lote para cláusulas IN (límite de parámetros de SQLite)
+IN_CHUNK_SIZE = 500
+
+def after_kegs_write(brewery_ids, search_changed: bool = True):
+    # Llamar tras cada commit que cree, modifique o elimine barriles.
+    # search_changed: False si solo cambiaron campos que no se buscan (estado, contenido...)
+    invalidate_stats(brewery_ids)
+    if search_changed:
+        keg_search.invalidate(brewery_ids)
+    # Los streams de /api/kegs/events de este proceso leen el cambio ya; los de otros, en su siguiente sondeo
+    events.notify()
+
+def chunked(items, size: int = IN_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+# Filas por transacción en la importación masiva y máximo de errores devueltos
+IMPORT_BATCH_SIZE = 500
+MAX_IMPORT_ERRORS = 1000
+
+# Filas leídas por viaje al servidor en las exportaciones (cursor de servidor en MySQL)
+EXPORT_YIELD_PER = 1000
+KEG_EXPORT_COLUMNS = [column.key for column in KEG_OUT_COLUMNS]
+HISTORY_EXPORT_COLUMNS = ["id", "keg_id", "keg_name", "brewery_id", "old_state", "new_state", "changed_at", "user_email"]
+
+def stream_export(build_query, columns, fmt: str, filename: str):
+    # La sesión vive dentro del generador: la respuesta se envía después de que termine el handler
+    def generate():
+        db = SessionLocal()
+        try:
+            rows = build_query(db).yield_per(EXPORT_YIELD_PER)
+            for chunk in serialize_rows(rows, columns, fmt):
+                yield chunk
+        finally:
+            db.close()
+    return StreamingResponse(
+        generate(),
+        media_type=EXPORT_MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{fmt}"'}
+    )
+
+class KegDeleted(BaseModel):
+    id: str
+    version: int
+
+class KegChanges(BaseModel):
+    # version: pasar como since en la siguiente llamada. reset: el cliente debe descartar su copia local
+    version: int
+    has_more: bool
+    reset: bool
+    upserts: List[KegOut]
+    deleted: List[KegDeleted]
+
+class KegSyncChanges(BaseModel):
+    name: Optional[str] = None
+    state: Optional[KegState] = None
+    current_content: Optional[int] = None
+    beer_type: Optional[str] = None
+    location: Optional[str] = None
+
+class KegSyncOperation(BaseModel):
+    idempotency_key: str  # Generada por el cliente, única por operación
+    keg_id: str
+    client_ts: datetime  # Momento de la acción en el dispositivo
+    base_version: Optional[int] = None  # version del barril que conocía el cliente
+    changes: KegSyncChanges
+
+class KegSyncRequest(BaseModel):
+    operations: List[KegSyncOperation]
+
+class KegSyncResult(BaseModel):
+    idempotency_key: str
+    status: str  # applied | conflict | not_found | forbidden
+    replayed: bool = False
+    keg: Optional[KegOut] = None
+
+MAX_SYNC_OPERATIONS = 1000
+# Reintentos si otra petición registra a la vez la misma clave de idempotencia
+SYNC_ATTEMPTS = 2
+
+class BulkTransitionRequest(BaseModel):
+    keg_ids: Optional[List[str]] = None
+    # Alternativa a keg_ids: todos los barriles de una cervecería, opcionalmente filtrados por estado
+    brewery_id: Optional[str] = None
+    state: Optional[KegState] = None
+    target_state: KegState
+
+class BulkTransitionResult(BaseModel):
+    keg_id: str
+    status: str  # updated | unchanged | conflict | not_found | forbidden
+    old_state: Optional[KegState] = None
+
 @router.get("/", response_model=List[KegOut])
+@with_session
 def list_kegs(
+    response: Response,
     current_user: User = Depends(get_current_user),
     skip: int = 0,
-    limit: int = Query(10, ge=1, le=100),
+    limit: int = Query(10, ge=1, le=1000),
+    cursor: Optional[str] = None,  # Cursor opaco devuelto en X-Next-Cursor
     brewery_id: Optional[str] = None,  # UUID como string
-    state: Optional[KegState] = None
+    state: Optional[KegState] = None,
+    beer_type: Optional[str] = None,
+    location: Optional[str] = None,
+    connector: Optional[KegConnector] = None,
+    keg_type: Optional[KegType] = Query(None, alias="type"),
+    name_prefix: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
 ):
-    db = SessionLocal()
-    query = db.query(Keg).join(Brewery, Keg.brewery_id == Brewery.id)
+    # ETag a partir de las versiones del ámbito consultado: una consulta a índices, sin leer ni serializar barriles
+    versions = tuple(db.query(*list_version_columns(brewery_id), counter_column(BREWERIES_COUNTER)).one())
+    etag = make_etag("kegs", versions, skip, limit, cursor, brewery_id, state, beer_type, location, connector, keg_type, name_prefix)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    response.headers.update(cache_headers(etag))
+    query = keg_out_query(db)
     if brewery_id:
         query = query.filter(Keg.brewery_id == brewery_id)
     if state:
         query = query.filter(Keg.state == state)
-    kegs = query.offset(skip).limit(limit).all()
-    
-    # Crear respuesta con brewery_name
-    result = []
-    for keg in kegs:
-        keg_dict = {
-            "id": keg.id,
-            "name": keg.name,
-            "type": keg.type,
-            "connector": keg.connector,
-            "capacity": keg.capacity,
-            "current_content": keg.current_content,
-            "beer_type": keg.beer_type,
-            "state": keg.state,
-            "brewery_id": keg.brewery_id,
-            "brewery_name": keg.brewery.name if keg.brewery else None,
-            "location": keg.location,
-            "user_email": None
-        }
-        result.append(keg_dict)
-    
-    db.close()
-    return result
+    if beer_type:
+        query = query.filter(Keg.beer_type == beer_type)
+    if location:
+        query = query.filter(Keg.location == location)
+    if connector:
+        query = query.filter(Keg.connector == connector)
+    if keg_type:
+        query = query.filter(Keg.type == keg_type)
+    if name_prefix:
+        query = query.filter(Keg.name.like(escape_like(name_prefix) + "%", escape="\\"))
+    # Paginación por clave (keyset): el coste de cada página no depende de su profundidad
+    query = query.order_by(Keg.id)
+    if cursor:
+        query = query.filter(Keg.id > decode_cursor(cursor))
+    else:
+        query = query.offset(skip)
+    kegs = query.limit(limit + 1).all()
+    if len(kegs) > limit:
+        kegs = kegs[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(kegs[-1].id)
+    return kegs
 
 @router.post("/", response_model=KegOut)
-def create_keg(data: KegCreate, current_user: User = Depends(get_current_user)):
+@with_session
+def create_keg(data: KegCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     if current_user.role not in [UserRole.GLOBAL_ADMIN, UserRole.ADMIN, UserRole.MODERATOR]:
         raise HTTPException(status_code=403, detail="Not enough permissions")
-    db = SessionLocal()
-    keg = Keg(**data.dict())
+    keg = Keg(**data.dict(), version=next_versions(db), updated_at=datetime.utcnow())
     db.add(keg)
     try:
+        db.flush()
+        keg_id = keg.id
         db.commit()
-        db.refresh(keg)
-        
-        # Obtener brewery_name para la respuesta
-        brewery = db.query(Brewery).filter(Brewery.id == keg.brewery_id).first()
-        keg_response = {
-            "id": keg.id,
-            "name": keg.name,
-            "type": keg.type,
-            "connector": keg.connector,
-            "capacity": keg.capacity,
-            "current_content": keg.current_content,
-            "beer_type": keg.beer_type,
-            "state": keg.state,
-            "brewery_id": keg.brewery_id,
-            "brewery_name": brewery.name if brewery else None,
-            "location": keg.location,
-            "user_email": None
-        }
-        
     except IntegrityError:
         db.rollback()
-        db.close()
         raise HTTPException(status_code=400, detail="Keg already exists")
-    db.close()
+    keg_response = keg_out_query(db, isouter=True).filter(Keg.id == keg_id).first()
+    after_kegs_write([data.brewery_id])
     return keg_response
 
+@router.post("/bulk-transition", response_model=List[BulkTransitionResult])
+@with_session
+def bulk_transition(data: BulkTransitionRequest, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    if data.keg_ids is None and data.brewery_id is None:
+        raise HTTPException(status_code=400, detail="keg_ids or brewery_id is required")
+    rows = []
+    if data.keg_ids is not None:
+        for ids in chunked(list(dict.fromkeys(data.keg_ids))):
+            rows.extend(db.query(Keg.id, Keg.state, Keg.brewery_id).filter(Keg.id.in_(ids)).all())
+    else:
+        query = db.query(Keg.id, Keg.state, Keg.brewery_id).filter(Keg.brewery_id == data.brewery_id)
+        if data.state:
+            query = query.filter(Keg.state == data.state)
+        rows = query.order_by(Keg.id).all()
+    found = {row.id: row for row in rows}
+    keg_ids = data.keg_ids if data.keg_ids is not None else list(found)
+    results = {}
+    to_update = []
+    for keg_id in keg_ids:
+        if keg_id in results:
+            continue
+        row = found.get(keg_id)
+        if row is None:
+            results[keg_id] = BulkTransitionResult(keg_id=keg_id, status="not_found")
+        elif current_user.role == UserRole.USER and row.brewery_id != current_user.brewery_id:
+            results[keg_id] = BulkTransitionResult(keg_id=keg_id, status="forbidden", old_state=row.state)
+        elif row.state == data.target_state:
+            results[keg_id] = BulkTransitionResult(keg_id=keg_id, status="unchanged", old_state=row.state)
+        else:
+            results[keg_id] = BulkTransitionResult(keg_id=keg_id, status="updated", old_state=row.state)
+            to_update.append(row)
+    if to_update:
+        # Una versión por barril: executemany en lugar de un UPDATE ... IN por lote.
+        # Solo si el barril sigue en el estado leído: una transición concurrente no se sobrescribe
+        first_version = next_versions(db, len(to_update))
+        versions = {row.id: first_version + i for i, row in enumerate(to_update)}
+        result = db.execute(
+            update(Keg.__table__).where(
+                Keg.__table__.c.id == bindparam("keg_id"), Keg.__table__.c.state == bindparam("old_state")
+            ).values(state=data.target_state, version=bindparam("new_version"), updated_at=datetime.utcnow()),
+            [{"keg_id": row.id, "old_state": row.state, "new_version": versions[row.id]} for row in to_update]
+        )
+        if not db.get_bind().dialect.supports_sane_multi_rowcount or result.rowcount != len(to_update):
+            # Alguna fila cambió entre la lectura y el UPDATE: releer para saber cuáles
+            current = {}
+            for ids in chunked([row.id for row in to_update]):
+                current.update((row.id, row) for row in db.query(Keg.id, Keg.state, Keg.version).filter(Keg.id.in_(ids)))
+            conflicts = [row for row in to_update if row.id not in current or current[row.id].version != versions[row.id]]
+            for row in conflicts:
+                latest = current.get(row.id)
+                results[row.id] = BulkTransitionResult(
+                    keg_id=row.id, status="conflict" if latest else "not_found", old_state=latest.state if latest else None
+                )
+            to_update = [row for row in to_update if results[row.id].status == "updated"]
+    if to_update:
+        # Un único executemany para todas las filas de historial
+        db.execute(insert(KegStateHistory), [
+            {
+                "keg_id": row.id,
+                "old_state": row.state,
+                "new_state": data.target_state,
+                "user_id": current_user.id,
+            } for row in to_update
+        ])
+        db.commit()
+        after_kegs_write([row.brewery_id for row in to_update], search_changed=False)
+    else:
+        # Sin cambios (todas en conflicto): descartar las versiones reservadas
+        db.rollback()
+    return list(results.values())
+
+@router.post("/sync", response_model=List[KegSyncResult])
+@with_session
+def sync_kegs(data: KegSyncRequest, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    # Cola de operaciones de un dispositivo offline, en orden y en una sola transacción
+    if not data.operations or len(data.operations) > MAX_SYNC_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"Between 1 and {MAX_SYNC_OPERATIONS} operations are required")
+    for attempt in range(SYNC_ATTEMPTS):
+        try:
+            results, touched = apply_operations(db, data.operations, current_user, keg_out_query(db, isouter=True), chunked)
+            db.commit()
+            break
+        except IntegrityError:
+            db.rollback()
+            if attempt == SYNC_ATTEMPTS - 1:
+                raise HTTPException(status_code=409, detail="Concurrent sync with the same idempotency keys")
+    search_changed = any(
+        result["status"] == "applied" and not result.get("replayed") and set(op.changes.dict(exclude_unset=True)) & set(keg_search.SEARCH_FIELDS)
+        for op, result in zip(data.operations, results)
+    )
+    after_kegs_write([keg["brewery_id"] for keg in touched], search_changed)
+    return results
+
+@router.post("/import")
+def import_kegs(
+    file: UploadFile = File(...),
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson)$"),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    if current_user.role not in [UserRole.GLOBAL_ADMIN, UserRole.ADMIN, UserRole.MODERATOR]:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    fmt = detect_format(file.filename, file.content_type, format)
+    if fmt not in IMPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Unsupported format")
+    known_breweries = {}
+    created = 0
+    failed = 0
+    errors = []
+
+    def add_error(row_num, error):
+        nonlocal failed
+        failed += 1
+        if len(errors) < MAX_IMPORT_ERRORS:
+            errors.append({"row": row_num, "error": error})
+
+    def flush_batch(batch):
+        nonlocal created
+        if not batch:
+            return
+        try:
+            first_version = next_versions(db, len(batch))
+            now = datetime.utcnow()
+            db.execute(insert(Keg), [dict(values, version=first_version + i, updated_at=now) for i, (_, values) in enumerate(batch)])
+            db.commit()
+            created += len(batch)
+            after_kegs_write({values["brewery_id"] for _, values in batch})
+        except IntegrityError:
+            db.rollback()
+            # Reintentar fila a fila solo este lote para localizar las filas conflictivas
+            for row_num, values in batch:
+                try:
+                    db.execute(insert(Keg), dict(values, version=next_versions(db), updated_at=datetime.utcnow()))
+                    db.commit()
+                    created += 1
+                    after_kegs_write([values["brewery_id"]])
+                except IntegrityError as e:
+                    db.rollback()
+                    add_error(row_num, f"Integrity error: {e.orig}")
+
+    try:
+        batch = []
+        for row_num, row, error in iter_import_rows(file.file, fmt):
+            if error:
+                add_error(row_num, error)
+                continue
+            try:
+                values = KegCreate(**row).dict()
+            except ValidationError as e:
+                add_error(row_num, format_validation_error(e))
+                continue
+            brewery_id = values["brewery_id"]
+            if brewery_id not in known_breweries:
+                known_breweries[brewery_id] = db.query(Brewery.id).filter(Brewery.id == brewery_id).first() is not None
+            if not known_breweries[brewery_id]:
+                add_error(row_num, "brewery_id: Brewery not found")
+                continue
+            batch.append((row_num, values))
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                flush_batch(batch)
+                batch = []
+        flush_batch(batch)
+    except (UnicodeDecodeError, csv.Error) as e:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=f"Invalid file: {e}")
+    return {"created": created, "failed": failed, "errors": errors}
+
+@router.get("/stats")
+@with_session
+def keg_stats(brewery_id: Optional[str] = None, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    # Solo el admin global ve todas las cervecerías
+    if current_user.role != UserRole.GLOBAL_ADMIN:
+        if brewery_id and brewery_id != current_user.brewery_id:
+            raise HTTPException(status_code=403, detail="Not enough permissions")
+        brewery_id = current_user.brewery_id
+    return get_stats(db, brewery_id)
+
+def _search(db, q: str, brewery_id: Optional[str], limit: int):
+    return keg_search.search(db, keg_out_query(db), q, brewery_id, limit)
+
+def _fuzzy_search(db, index, q: str, limit: int):
+    return keg_search.fuzzy_search(db, keg_out_query(db), q, limit=limit, index=index)
+
+@router.get("/search", response_model=List[KegOut])
+async def search_kegs(
+    q: str = Query(..., min_length=1, max_length=200),
+    brewery_id: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    fuzzy: Optional[bool] = None,  # None: difusa solo si la búsqueda exacta no encuentra nada
+    current_user: User = Depends(get_current_user),
+    db: SessionRunner = Depends(get_session_runner)
+):
+    if current_user.role == UserRole.USER:
+        if brewery_id and brewery_id != current_user.brewery_id:
+            raise HTTPException(status_code=403, detail="Not enough permissions")
+        brewery_id = current_user.brewery_id
+    results = [] if fuzzy else await db.run(_search, q, brewery_id, limit)
+    if fuzzy or (fuzzy is None and not results):
+        # El índice de trigramas se obtiene fuera de la sesión: su construcción no bloquea el event loop
+        index = await keg_search.trigram_index_async(brewery_id)
+        results = await db.run(_fuzzy_search, index, q, limit)
+    return results
+
+@router.get("/changes", response_model=KegChanges)
+@with_session
+def keg_changes(
+    since: int = Query(0, ge=0),
+    brewery_id: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=5000),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    # Sincronización incremental: barriles creados o modificados y eliminados desde la versión since
+    if current_user.role == UserRole.USER:
+        if brewery_id and brewery_id != current_user.brewery_id:
+            raise HTTPException(status_code=403, detail="Not enough permissions")
+        brewery_id = current_user.brewery_id
+    upserts, deleted, version, has_more, reset = changes_since(db, keg_out_query(db, isouter=True), since, brewery_id, limit)
+    return {"version": version, "has_more": has_more, "reset": reset, "upserts": upserts, "deleted": deleted}
+
+@router.get("/events")
+async def keg_events(
+    brewery_id: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None),
+    current_user: User = Depends(get_stream_user)
+):
+    # Server-Sent Events con los cambios de barriles; EventSource reenvía Last-Event-ID al reconectar
+    if current_user.role == UserRole.USER:
+        if brewery_id and brewery_id != current_user.brewery_id:
+            raise HTTPException(status_code=403, detail="Not enough permissions")
+        brewery_id = current_user.brewery_id
+    return StreamingResponse(
+        events.stream(lambda session: keg_out_query(session, isouter=True), brewery_id, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.get("/export")
+def export_kegs(
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    brewery_id: Optional[str] = None,
+    state: Optional[KegState] = None,
+    current_user: User = Depends(get_current_user)
+):
+    # Un usuario común solo exporta su cervecería
+    if current_user.role == UserRole.USER:
+        brewery_id = current_user.brewery_id
+
+    def build_query(db):
+        query = keg_out_query(db)
+        if brewery_id:
+            query = query.filter(Keg.brewery_id == brewery_id)
+        if state:
+            query = query.filter(Keg.state == state)
+        return query.order_by(Keg.id)
+    return stream_export(build_query, KEG_EXPORT_COLUMNS, format, "kegs")
+
+@router.get("/history/export")
+def export_keg_history(
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    brewery_id: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role == UserRole.USER:
+        brewery_id = current_user.brewery_id
+
+    def build_query(db):
+        query = (
+            db.query(
+                KegStateHistory.id,
+                KegStateHistory.keg_id,
+                Keg.name.label("keg_name"),
+                Keg.brewery_id,
+                KegStateHistory.old_state,
+                KegStateHistory.new_state,
+                KegStateHistory.changed_at,
+                User.email.label("user_email"),
+            )
+            .join(Keg, KegStateHistory.keg_id == Keg.id)
+            .outerjoin(User, KegStateHistory.user_id == User.id)
+        )
+        if brewery_id:
+            query = query.filter(Keg.brewery_id == brewery_id)
+        if since:
+            query = query.filter(KegStateHistory.changed_at >= since)
+        if until:
+            query = query.filter(KegStateHistory.changed_at < until)
+        return query.order_by(KegStateHistory.changed_at, KegStateHistory.id)
+    return stream_export(build_query, HISTORY_EXPORT_COLUMNS, format, "keg_history")
+
+@router.get("/labels")
+def keg_labels(
+    brewery_id: Optional[str] = None,
+    keg_ids: Optional[List[str]] = Query(None),
+    content: str = Query("url", pattern="^(url|id)$"),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    if not brewery_id and not keg_ids:
+        raise HTTPException(status_code=400, detail="brewery_id or keg_ids is required")
+    if current_user.role == UserRole.USER:
+        if brewery_id and brewery_id != current_user.brewery_id:
+            raise HTTPException(status_code=403, detail="Not enough permissions")
+        brewery_id = current_user.brewery_id
+
+    def content_for(keg):
+        # El QR apunta a la ficha del barril en el frontend, o solo contiene su id
+        return f"{settings.FRONTEND_FQDN}/kegs/{keg.id}" if content == "url" else keg.id
+
+    def iter_kegs(db):
+        columns = (Keg.id, Keg.name, Keg.beer_type, Keg.type, Keg.connector, Keg.capacity)
+        if keg_ids:
+            for ids in chunked(list(dict.fromkeys(keg_ids))):
+                query = db.query(*columns).filter(Keg.id.in_(ids))
+                if brewery_id:
+                    query = query.filter(Keg.brewery_id == brewery_id)
+                yield from query.order_by(Keg.name, Keg.id)
+        else:
+            yield from db.query(*columns).filter(Keg.brewery_id == brewery_id).order_by(Keg.name, Keg.id).yield_per(EXPORT_YIELD_PER)
+
+    output, count = build_labels_pdf(iter_kegs(db), content_for)
+    if count == 0:
+        output.close()
+        raise HTTPException(status_code=404, detail="No kegs found")
+
+    def stream():
+        try:
+            while True:
+                data = output.read(64 * 1024)
+                if not data:
+                    break
+                yield data
+        finally:
+            output.close()
+    return StreamingResponse(
+        stream(),
+        media_type="application/pdf",
+        headers={"Content-Disposition": 'attachment; filename="keg_labels.pdf"'}
+    )
+
 @router.patch("/{keg_id}", response_model=KegOut)
-def update_keg(keg_id: str, data: KegCreate, current_user: User = Depends(get_current_user)):
-    db = SessionLocal()
+@with_session
+def update_keg(keg_id: str, data: KegCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     keg = db.query(Keg).filter(Keg.id == keg_id).first()
     if keg is None:
-        db.close()
         raise HTTPException(status_code=404, detail="Keg not found")
     # Permitir editar a global_admin, admin, moderator, y usuario común solo si es de su cervecería
     if current_user.role == UserRole.USER and keg.brewery_id != current_user.brewery_id:
-        db.close()
         raise HTTPException(status_code=403, detail="No tienes permiso para editar este barril")
     old_state = keg.state
+    old_brewery_id = keg.brewery_id
+    old_search = [getattr(keg, field) for field in keg_search.SEARCH_FIELDS]
+    # Antes de modificar el objeto, para que el autoflush no emita el UPDATE del barril dos veces
+    keg.version = next_versions(db)
+    keg.updated_at = datetime.utcnow()
     for key, value in data.dict().items():
         setattr(keg, key, value)
-    db.commit()
-    db.refresh(keg)
-    # Registrar historial si cambió el estado
-    if old_state != keg.state:
+    new_state = keg.state
+    if old_brewery_id != keg.brewery_id:
+        add_tombstones(db, [(keg_id, old_brewery_id)])
+    # Registrar historial si cambió el estado, en la misma transacción
+    if old_state != new_state:
         history = KegStateHistory(
-            keg_id=keg.id,
+            keg_id=keg_id,
             old_state=old_state,
-            new_state=keg.state,
+            new_state=new_state,
             user_id=current_user.id
         )
         db.add(history)
-        db.commit()
-    
-    # Obtener brewery_name para la respuesta
-    brewery = db.query(Brewery).filter(Brewery.id == keg.brewery_id).first()
-    keg_response = {
-        "id": keg.id,
-        "name": keg.name,
-        "type": keg.type,
-        "connector": keg.connector,
-        "capacity": keg.capacity,
-        "current_content": keg.current_content,
-        "beer_type": keg.beer_type,
-        "state": keg.state,
-        "brewery_id": keg.brewery_id,
-        "brewery_name": brewery.name if brewery else None,
-        "location": keg.location,
-        "user_email": None
-    }
-    
-    db.close()
+    db.commit()
+    keg_response = keg_out_query(db, isouter=True).filter(Keg.id == keg_id).first()
+    search_changed = old_brewery_id != data.brewery_id or old_search != [getattr(data, field) for field in keg_search.SEARCH_FIELDS]
+    after_kegs_write([old_brewery_id, data.brewery_id], search_changed)
     return keg_response
 
 @router.get("/{keg_id}/history")
-def get_keg_history(keg_id: str, current_user: User = Depends(get_current_user)):
-    db = SessionLocal()
-    history = db.query(KegStateHistory).filter(KegStateHistory.keg_id == keg_id).order_by(KegStateHistory.changed_at.desc()).all()
-    # Obtener emails de los usuarios
-    user_ids = list({h.user_id for h in history if h.user_id})
-    users = db.query(User).filter(User.id.in_(user_ids)).all() if user_ids else []
-    user_map = {u.id: u.email for u in users}
-    db.close()
+@with_session
+def get_keg_history(keg_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    # Emails resueltos con un outer join en la misma consulta
+    history = (
+        db.query(
+            KegStateHistory.old_state,
+            KegStateHistory.new_state,
+            KegStateHistory.changed_at,
+            User.email.label("user_email"),
+        )
+        .outerjoin(User, KegStateHistory.user_id == User.id)
+        .filter(KegStateHistory.keg_id == keg_id)
+        .order_by(KegStateHistory.changed_at.desc())
+        .all()
+    )
     return [
         {
             "old_state": h.old_state,
             "new_state": h.new_state,
             "changed_at": h.changed_at,
-            "user_email": user_map.get(h.user_id) if h.user_id else None
+            "user_email": h.user_email
         } for h in history
     ]
 
 @router.delete("/{keg_id}")
-def delete_keg(keg_id: str, current_user: User = Depends(get_current_user)):
-    db = SessionLocal()
+@with_session
+def delete_keg(keg_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     keg = db.query(Keg).filter(Keg.id == keg_id).first()
     if keg is None:
-        db.close()
         raise HTTPException(status_code=404, detail="Keg not found")
+    brewery_id = keg.brewery_id
     db.delete(keg)
+    add_tombstones(db, [(keg_id, brewery_id)])
     db.commit()
-    db.close()
+    after_kegs_write([brewery_id])
     return {"success": True}
 
 @router.get("/{keg_id}", response_model=KegOut)
-def get_keg(keg_id: str, current_user: User = Depends(get_current_user)):
-    db = SessionLocal()
-    keg = db.query(Keg).join(Brewery, Keg.brewery_id == Brewery.id).filter(Keg.id == keg_id).first()
+@with_session
+def get_keg(
+    keg_id: str,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    keg = keg_out_query(db).add_columns(counter_column(BREWERIES_COUNTER)).filter(Keg.id == keg_id).first()
     if not keg:
-        db.close()
         raise HTTPException(status_code=404, detail="Keg not found")
     if current_user.role == UserRole.USER and keg.brewery_id != current_user.brewery_id:
-        db.close()
         raise HTTPException(status_code=403, detail="No tienes acceso a este barril")
-    
-    # Obtener email del usuario asignado si existe
-    user_email = None
-    if hasattr(keg, 'user_id') and keg.user_id:
-        user = db.query(User).filter(User.id == keg.user_id).first()
-        if user:
-            user_email = user.email
-    
-    keg_response = {
-        "id": keg.id,
-        "name": keg.name,
-        "type": keg.type,
-        "connector": keg.connector,
-        "capacity": keg.capacity,
-        "current_content": keg.current_content,
-        "beer_type": keg.beer_type,
-        "state": keg.state,
-        "brewery_id": keg.brewery_id,
-        "brewery_name": keg.brewery.name if keg.brewery else None,
-        "location": keg.location,
-        "user_email": user_email
-    }
-    
-    db.close()
-    return keg_response 
\ No newline at end of file
+    # Sin cambios: 304 sin validar ni serializar el barril
+    etag = make_etag("keg", keg_id, keg.version, keg.breweries_counter)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag, keg.updated_at)
+    response.headers.update(cache_headers(etag, keg.updated_at))
+    return keg
\ No newline at end of file
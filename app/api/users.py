@@ -1,8 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Body
+from fastapi import APIRouter, Depends, Header, HTTPException, Response, status, Body
 from pydantic import BaseModel, EmailStr
-from app.db.database import SessionLocal
+from app.db.database import SessionRunner, get_db, get_session_runner, with_session
+from sqlalchemy.orm import Session
 from app.db.models import User, UserRole
-from app.core.auth import get_current_user
+from app.core.auth import get_current_user, invalidate_user
+from app.core.security import hash_password_async
+from app.core.etag import cache_headers, etag_matches, make_etag, not_modified
+from app.services.counters import USERS_COUNTER, counter_value, touch_counter
 from sqlalchemy.exc import IntegrityError
 from typing import List, Optional
 
@@ -30,25 +34,29 @@ class UserCreate(BaseModel):
     brewery_id: Optional[str] = None
 
 @router.get("/", response_model=List[UserOut])
-def list_users(current_user: User = Depends(get_current_user)):
+@with_session
+def list_users(
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
     if current_user.role not in [UserRole.GLOBAL_ADMIN, UserRole.ADMIN, UserRole.MODERATOR]:
         raise HTTPException(status_code=403, detail="Not enough permissions")
-    db = SessionLocal()
+    etag = make_etag("users", counter_value(db, USERS_COUNTER))
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    response.headers.update(cache_headers(etag))
     users = db.query(User).all()
-    db.close()
     return users
 
-@router.post("/", response_model=UserOut)
-def create_user(data: UserCreate, current_user: User = Depends(get_current_user)):
-    if current_user.role != UserRole.GLOBAL_ADMIN:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    db = SessionLocal()
-    if db.query(User).filter(User.email == data.email).first():
-        db.close()
-        raise HTTPException(status_code=400, detail="User already exists")
-    from passlib.context import CryptContext
-    pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-    hashed_password = pwd_context.hash(data.password)
+def _user_exists(db, email: str) -> bool:
+    exists = db.query(User.id).filter(User.email == email).first() is not None
+    # Cierra la transacción de lectura: sin ella la conexión seguiría ocupada durante el hash
+    db.rollback()
+    return exists
+
+def _insert_user(db, data: UserCreate, hashed_password: str):
     user = User(
         email=data.email,
         hashed_password=hashed_password,
@@ -57,67 +65,72 @@ def create_user(data: UserCreate, current_user: User = Depends(get_current_user)
         brewery_id=data.brewery_id
     )
     db.add(user)
+    touch_counter(db, USERS_COUNTER)
     db.commit()
     db.refresh(user)
-    db.close()
     return user
 
+@router.post("/", response_model=UserOut)
+async def create_user(data: UserCreate, current_user: User = Depends(get_current_user), db: SessionRunner = Depends(get_session_runner)):
+    if current_user.role != UserRole.GLOBAL_ADMIN:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    if await db.run(_user_exists, data.email):
+        raise HTTPException(status_code=400, detail="User already exists")
+    # bcrypt fuera de la sesión: no ocupa hilo ni conexión mientras se calcula el hash
+    hashed_password = await hash_password_async(data.password)
+    return await db.run(_insert_user, data, hashed_password)
+
 @router.patch("/{user_id}/deactivate")
-def deactivate_user(user_id: str, current_user: User = Depends(get_current_user)):
+@with_session
+def deactivate_user(user_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     if current_user.role not in [UserRole.GLOBAL_ADMIN, UserRole.ADMIN, UserRole.MODERATOR]:
         raise HTTPException(status_code=403, detail="Not enough permissions")
-    db = SessionLocal()
     user = db.query(User).filter(User.id == user_id).first()
     if user is None:
-        db.close()
         raise HTTPException(status_code=404, detail="User not found")
     
     # SEGURIDAD: Solo global_admin puede desactivar a otro global_admin
     if user.role == UserRole.GLOBAL_ADMIN and current_user.role != UserRole.GLOBAL_ADMIN:
-        db.close()
         raise HTTPException(status_code=403, detail="Only global admin can deactivate global admin users")
     
     # SEGURIDAD: Un global_admin no puede desactivarse a sí mismo
     if user.id == current_user.id and current_user.role == UserRole.GLOBAL_ADMIN:
-        db.close()
         raise HTTPException(status_code=403, detail="Global admin cannot deactivate themselves")
     
     setattr(user, 'active', False)
+    touch_counter(db, USERS_COUNTER)
     db.commit()
-    db.close()
+    invalidate_user(user_id)
     return {"success": True}
 
 @router.patch("/{user_id}/activate")
-def activate_user(user_id: str, current_user: User = Depends(get_current_user)):
+@with_session
+def activate_user(user_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     if current_user.role not in [UserRole.GLOBAL_ADMIN, UserRole.ADMIN, UserRole.MODERATOR]:
         raise HTTPException(status_code=403, detail="Not enough permissions")
-    db = SessionLocal()
     user = db.query(User).filter(User.id == user_id).first()
     if user is None:
-        db.close()
         raise HTTPException(status_code=404, detail="User not found")
     
     # SEGURIDAD: Solo global_admin puede activar a otro global_admin
     if user.role == UserRole.GLOBAL_ADMIN and current_user.role != UserRole.GLOBAL_ADMIN:
-        db.close()
         raise HTTPException(status_code=403, detail="Only global admin can activate global admin users")
     
     setattr(user, 'active', True)
+    touch_counter(db, USERS_COUNTER)
     db.commit()
-    db.close()
+    invalidate_user(user_id)
     return {"success": True}
 
 @router.patch("/{user_id}")
-def update_user(user_id: str, data: UserUpdate = Body(...), current_user: User = Depends(get_current_user)):
-    db = SessionLocal()
+@with_session
+def update_user(user_id: str, data: UserUpdate = Body(...), current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     user = db.query(User).filter(User.id == user_id).first()
     if user is None:
-        db.close()
         raise HTTPException(status_code=404, detail="User not found")
     
     # SEGURIDAD: Solo global_admin puede modificar a otro global_admin
     if user.role == UserRole.GLOBAL_ADMIN and current_user.role != UserRole.GLOBAL_ADMIN:
-        db.close()
         raise HTTPException(status_code=403, detail="Only global admin can modify global admin users")
     
     # Permisos
@@ -125,13 +138,10 @@ def update_user(user_id: str, data: UserUpdate = Body(...), current_user: User =
         pass  # Puede editar cualquier campo
     elif current_user.role in [UserRole.ADMIN, UserRole.MODERATOR]:
         if user.brewery_id != current_user.brewery_id:
-            db.close()
             raise HTTPException(status_code=403, detail="No puedes editar usuarios de otra cervecería")
         if data.role == UserRole.GLOBAL_ADMIN:
-            db.close()
             raise HTTPException(status_code=403, detail="No puedes asignar rol de admin global")
     else:
-        db.close()
         raise HTTPException(status_code=403, detail="No tienes permisos para editar usuarios")
     # Actualizar campos
     if data.email is not None:
@@ -142,32 +152,29 @@ def update_user(user_id: str, data: UserUpdate = Body(...), current_user: User =
         user.brewery_id = data.brewery_id
     if data.active is not None:
         user.active = data.active
+    touch_counter(db, USERS_COUNTER)
     try:
         db.commit()
         db.refresh(user)
     except IntegrityError:
         db.rollback()
-        db.close()
         raise HTTPException(status_code=400, detail="Integrity error")
-    db.close()
+    invalidate_user(user_id)
     return {"success": True}
 
 @router.delete("/{user_id}")
-def delete_user(user_id: str, current_user: User = Depends(get_current_user)):
-    db = SessionLocal()
+@with_session
+def delete_user(user_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     user = db.query(User).filter(User.id == user_id).first()
     if user is None:
-        db.close()
         raise HTTPException(status_code=404, detail="User not found")
     
     # SEGURIDAD: Solo global_admin puede eliminar a otro global_admin
     if user.role == UserRole.GLOBAL_ADMIN and current_user.role != UserRole.GLOBAL_ADMIN:
-        db.close()
         raise HTTPException(status_code=403, detail="Only global admin can delete global admin users")
     
     # SEGURIDAD: Un global_admin no puede eliminarse a sí mismo
     if user.id == current_user.id and current_user.role == UserRole.GLOBAL_ADMIN:
-        db.close()
         raise HTTPException(status_code=403, detail="Global admin cannot delete themselves")
     
     # Permitir solo si es global_admin o admin de la misma cervecería
@@ -176,9 +183,9 @@ def delete_user(user_id: str, current_user: User = Depends(get_current_user)):
     elif current_user.role == UserRole.ADMIN and user.brewery_id == current_user.brewery_id:
         pass
     else:
-        db.close()
         raise HTTPException(status_code=403, detail="Not enough permissions")
     db.delete(user)
+    touch_counter(db, USERS_COUNTER)
     db.commit()
-    db.close()
+    invalidate_user(user_id)
     return {"success": True} 
\ No newline at end of file
@@ -1,11 +1,12 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Depends
 from pydantic import BaseModel, EmailStr
-from app.db.database import SessionLocal
+from app.db.database import SessionRunner, get_db, get_session_runner
+from sqlalchemy.orm import Session
 from app.db.models import Brewery, User, UserRole
-from passlib.context import CryptContext
+from app.core.security import hash_password_async
+from app.services.counters import BREWERIES_COUNTER, USERS_COUNTER, touch_counter
 
 router = APIRouter()
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 class InitRequest(BaseModel):
     brewery_name: str
@@ -13,26 +14,24 @@ class InitRequest(BaseModel):
     admin_password: str
 
 @router.get("/status")
-def status():
-    db = SessionLocal()
+def status(db: Session = Depends(get_db)):
     initialized = db.query(Brewery).count() > 0 or db.query(User).count() > 0
-    db.close()
     return {"initialized": initialized}
 
-@router.post("/initialize")
-def initialize(data: InitRequest):
-    db = SessionLocal()
-    # Solo permitir si no hay cervecerías ni usuarios
+def _initialized(db) -> bool:
+    initialized = db.query(Brewery).count() > 0 or db.query(User).count() > 0
+    db.rollback()
+    return initialized
+
+def _initialize(db, data: InitRequest, hashed_password: str):
+    # Se vuelve a comprobar: otra petición pudo inicializar la app mientras se calculaba el hash
     if db.query(Brewery).count() > 0 or db.query(User).count() > 0:
-        db.close()
         raise HTTPException(status_code=403, detail="La app ya fue inicializada")
     # Crear cervecería
     brewery = Brewery(name=data.brewery_name, active=True)
     db.add(brewery)
-    db.commit()
-    db.refresh(brewery)
+    db.flush()
     # Crear usuario admin
-    hashed_password = pwd_context.hash(data.admin_password)
     user = User(
         email=data.admin_email,
         hashed_password=hashed_password,
@@ -41,9 +40,17 @@ def initialize(data: InitRequest):
         brewery_id=brewery.id
     )
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    touch_counter(db, BREWERIES_COUNTER)
+    touch_counter(db, USERS_COUNTER)
     brewery_id = brewery.id
-    admin_email = user.email
-    db.close()
-    return {"success": True, "brewery_id": brewery_id, "admin_email": admin_email} 
\ No newline at end of file
+    db.commit()
+    return {"success": True, "brewery_id": brewery_id, "admin_email": data.admin_email}
+
+@router.post("/initialize")
+async def initialize(data: InitRequest, db: SessionRunner = Depends(get_session_runner)):
+    # Solo permitir si no hay cervecerías ni usuarios
+    if await db.run(_initialized):
+        raise HTTPException(status_code=403, detail="La app ya fue inicializada")
+    # bcrypt sin sesión abierta
+    hashed_password = await hash_password_async(data.admin_password)
+    return await db.run(_initialize, data, hashed_password)
@@ -1,14 +1,51 @@
-from fastapi import Depends, HTTPException, status
+import threading
+from typing import Optional
+from fastapi import Depends, HTTPException, Query, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
-from app.db.database import SessionLocal
+from starlette.concurrency import run_in_threadpool
+from app.db.database import SessionLocal, SessionRunner, get_session_runner
 from app.db.models import User
 from app.core.config import get_settings
+from app.core.cache import TTLCache
 
 settings = get_settings()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login", auto_error=False)
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
+class CurrentUser:
+    # Principal verificado; se cachea en lugar de la fila ORM para no compartir instancias entre sesiones
+    __slots__ = ("id", "email", "role", "brewery_id", "active")
+
+    def __init__(self, id, email, role, brewery_id, active):
+        self.id = id
+        self.email = email
+        self.role = role
+        self.brewery_id = brewery_id
+        self.active = active
+
+    @classmethod
+    def from_user(cls, user: User):
+        return cls(user.id, user.email, user.role, user.brewery_id, bool(user.active))
+
+principal_cache = TTLCache(maxsize=settings.AUTH_CACHE_SIZE, ttl=settings.AUTH_CACHE_TTL)
+# Se incrementa al invalidar: un principal leído antes de la invalidación no se guarda en la cache
+_generations = {}
+_generations_lock = threading.Lock()
+
+def invalidate_user(user_id: str):
+    # Llamar siempre que se modifique, desactive o elimine un usuario
+    with _generations_lock:
+        _generations[user_id] = _generations.get(user_id, 0) + 1
+        principal_cache.invalidate(user_id)
+
+def _load_principal(db, user_id: str):
+    user = db.query(User).filter(User.id == user_id).first()
+    if user is None or not bool(getattr(user, 'active', False)):
+        return None
+    return CurrentUser.from_user(user)
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: SessionRunner = Depends(get_session_runner)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -21,9 +58,27 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
             raise credentials_exception
     except JWTError:
         raise credentials_exception
+    principal = principal_cache.get(user_id)
+    if principal is None:
+        generation = _generations.get(user_id, 0)
+        # Misma sesión que el handler; nunca bloquea el event loop (motor async o threadpool)
+        principal = await db.run(_load_principal, user_id)
+        if principal is None:
+            raise credentials_exception
+        with _generations_lock:
+            if _generations.get(user_id, 0) == generation:
+                principal_cache.set(user_id, principal)
+    return principal 
+
+async def user_from_token(token: str):
+    # Sesión propia y cerrada al momento, para quien no tiene la de la petición (streams, middleware)
     db = SessionLocal()
-    user = db.query(User).filter(User.id == user_id).first()
-    db.close()
-    if user is None or not bool(getattr(user, 'active', False)):
-        raise credentials_exception
-    return user 
\ No newline at end of file
+    try:
+        return await get_current_user(token, SessionRunner(db))
+    finally:
+        await run_in_threadpool(db.close)
+
+async def get_stream_user(token: Optional[str] = Depends(optional_oauth2_scheme), access_token: Optional[str] = Query(None)):
+    # EventSource no permite cabeceras: el token puede ir también como parámetro access_token.
+    # La sesión de la petición viviría lo que dure el stream
+    return await user_from_token(token or access_token or "")
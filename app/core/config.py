@@ -1,27 +1,165 @@
 import os
+import tempfile
+import threading
+import time
 from pydantic_settings import BaseSettings
-from dotenv import load_dotenv
+from dotenv import dotenv_values, load_dotenv
 
-load_dotenv()
+ENV_FILE = ".env"
+# Variables definidas por el entorno del proceso (docker, systemd...): tienen prioridad sobre .env
+PROCESS_ENV = set(os.environ)
+
+load_dotenv(ENV_FILE)
 
 # No importar get_settings de sí mismo aquí, para evitar import circular
 
-def get_settings():
-    class Settings(BaseSettings):
-        DB_ENGINE: str = os.getenv("DB_ENGINE", "sqlite")
-        DB_URL: str = os.getenv("DB_URL", "sqlite:///./kegtracker.db")
-        SMTP_HOST: str = os.getenv("SMTP_HOST", "localhost")
-        SMTP_PORT: int = int(os.getenv("SMTP_PORT", 25))
-        SMTP_USER: str = os.getenv("SMTP_USER", "")
-        SMTP_PASS: str = os.getenv("SMTP_PASS", "")
-        SMTP_FROM: str = os.getenv("SMTP_FROM", "")
-        SECRET_KEY: str = os.getenv("SECRET_KEY", "changeme")
-        DEBUG: bool = True
-        BACKEND_HOST: str = os.getenv("BACKEND_HOST", "0.0.0.0")
-        BACKEND_PORT: int = int(os.getenv("BACKEND_PORT", 8000))
-        FRONTEND_HOST: str = os.getenv("FRONTEND_HOST", "0.0.0.0")
-        FRONTEND_PORT: int = int(os.getenv("FRONTEND_PORT", 8080))
-        FRONTEND_FQDN: str = os.getenv("FRONTEND_FQDN", "http://localhost:8080")
-        class Config:
-            env_file = ".env"
-    return Settings() 
\ No newline at end of file
+class Settings(BaseSettings):
+    DB_ENGINE: str = os.getenv("DB_ENGINE", "sqlite")
+    DB_URL: str = os.getenv("DB_URL", "sqlite:///./kegtracker.db")
+    SMTP_HOST: str = os.getenv("SMTP_HOST", "localhost")
+    SMTP_PORT: int = int(os.getenv("SMTP_PORT", 25))
+    SMTP_USER: str = os.getenv("SMTP_USER", "")
+    SMTP_PASS: str = os.getenv("SMTP_PASS", "")
+    SMTP_FROM: str = os.getenv("SMTP_FROM", "")
+    SMTP_STARTTLS: bool = os.getenv("SMTP_STARTTLS", "true").lower() in ("1", "true", "yes")
+    SMTP_USE_TLS: bool = os.getenv("SMTP_USE_TLS", "false").lower() in ("1", "true", "yes")
+    SMTP_TIMEOUT: int = int(os.getenv("SMTP_TIMEOUT", 30))
+    EMAIL_TEMPLATE_CACHE_DIR: str = os.getenv("EMAIL_TEMPLATE_CACHE_DIR", "")
+    EMAIL_WORKER_ENABLED: bool = os.getenv("EMAIL_WORKER_ENABLED", "true").lower() in ("1", "true", "yes")
+    EMAIL_BATCH_SIZE: int = int(os.getenv("EMAIL_BATCH_SIZE", 20))
+    EMAIL_POLL_INTERVAL: int = int(os.getenv("EMAIL_POLL_INTERVAL", 5))
+    EMAIL_MAX_ATTEMPTS: int = int(os.getenv("EMAIL_MAX_ATTEMPTS", 8))
+    EMAIL_RETRY_BASE_SECONDS: int = int(os.getenv("EMAIL_RETRY_BASE_SECONDS", 30))
+    EMAIL_RETRY_MAX_SECONDS: int = int(os.getenv("EMAIL_RETRY_MAX_SECONDS", 3600))
+    EMAIL_RETENTION_DAYS: int = int(os.getenv("EMAIL_RETENTION_DAYS", 30))
+    SECRET_KEY: str = os.getenv("SECRET_KEY", "changeme")
+    DEBUG: bool = True
+    BACKEND_HOST: str = os.getenv("BACKEND_HOST", "0.0.0.0")
+    BACKEND_PORT: int = int(os.getenv("BACKEND_PORT", 8000))
+    FRONTEND_HOST: str = os.getenv("FRONTEND_HOST", "0.0.0.0")
+    FRONTEND_PORT: int = int(os.getenv("FRONTEND_PORT", 8080))
+    FRONTEND_FQDN: str = os.getenv("FRONTEND_FQDN", "http://localhost:8080")
+    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", 5))
+    DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", 10))
+    DB_POOL_TIMEOUT: int = int(os.getenv("DB_POOL_TIMEOUT", 30))
+    DB_POOL_RECYCLE: int = int(os.getenv("DB_POOL_RECYCLE", 1800))
+    DB_POOL_PRE_PING: bool = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+    DB_ASYNC: bool = os.getenv("DB_ASYNC", "false").lower() in ("1", "true", "yes")
+    DB_ASYNC_URL: str = os.getenv("DB_ASYNC_URL", "")
+    THREADPOOL_SIZE: int = int(os.getenv("THREADPOOL_SIZE", 40))
+    SQLITE_WAL: bool = os.getenv("SQLITE_WAL", "true").lower() in ("1", "true", "yes")
+    SQLITE_BUSY_TIMEOUT_MS: int = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+    # Espera máxima de un worker mientras otro aplica las migraciones al arrancar
+    MIGRATION_LOCK_TIMEOUT: int = int(os.getenv("MIGRATION_LOCK_TIMEOUT", 600))
+    SQLITE_MMAP_SIZE: int = int(os.getenv("SQLITE_MMAP_SIZE", 268435456))
+    SQLITE_CACHE_SIZE: int = int(os.getenv("SQLITE_CACHE_SIZE", -65536))
+    SQLITE_SERIALIZE_WRITES: bool = os.getenv("SQLITE_SERIALIZE_WRITES", "true").lower() in ("1", "true", "yes")
+    BCRYPT_ROUNDS: int = int(os.getenv("BCRYPT_ROUNDS", 12))
+    PASSWORD_HASH_WORKERS: int = int(os.getenv("PASSWORD_HASH_WORKERS", 2))
+    PASSWORD_HASH_MAX_PENDING: int = int(os.getenv("PASSWORD_HASH_MAX_PENDING", 32))
+    PASSWORD_HASH_TIMEOUT: int = int(os.getenv("PASSWORD_HASH_TIMEOUT", 10))
+    TOKEN_CACHE_SIZE: int = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+    TOKEN_PURGE_INTERVAL: int = int(os.getenv("TOKEN_PURGE_INTERVAL", 3600))
+    METRICS_ENABLED: bool = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+    # Bearer token para que Prometheus lea /metrics; sin él, solo un admin global
+    METRICS_TOKEN: str = os.getenv("METRICS_TOKEN", "")
+    SLOW_QUERY_MS: int = int(os.getenv("SLOW_QUERY_MS", 200))
+    SLOW_REQUEST_MS: int = int(os.getenv("SLOW_REQUEST_MS", 1000))
+    PROFILING_ENABLED: bool = os.getenv("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+    PROFILE_DIR: str = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "kegtracker-profiles"))
+    PROFILE_INTERVAL_MS: int = int(os.getenv("PROFILE_INTERVAL_MS", 5))
+    AUTH_CACHE_TTL: int = int(os.getenv("AUTH_CACHE_TTL", 30))
+    AUTH_CACHE_SIZE: int = int(os.getenv("AUTH_CACHE_SIZE", 1024))
+    KEG_STATS_TTL: int = int(os.getenv("KEG_STATS_TTL", 15))
+    ANALYTICS_REFRESH_INTERVAL: int = int(os.getenv("ANALYTICS_REFRESH_INTERVAL", 60))
+    ANALYTICS_REFRESH_MAX_BATCHES: int = int(os.getenv("ANALYTICS_REFRESH_MAX_BATCHES", 4))
+    ANALYTICS_WORKER_ENABLED: bool = os.getenv("ANALYTICS_WORKER_ENABLED", "true").lower() in ("1", "true", "yes")
+    KEG_TOMBSTONE_DAYS: int = int(os.getenv("KEG_TOMBSTONE_DAYS", 90))
+    KEG_SEARCH_INDEX_TTL: int = int(os.getenv("KEG_SEARCH_INDEX_TTL", 300))
+    IDEMPOTENCY_KEY_DAYS: int = int(os.getenv("IDEMPOTENCY_KEY_DAYS", 7))
+    # Cada cuánto comprueba un stream SSE los cambios hechos por otros workers, y cambios por lectura
+    EVENTS_POLL_INTERVAL: float = float(os.getenv("EVENTS_POLL_INTERVAL", 1))
+    EVENTS_BATCH_SIZE: int = int(os.getenv("EVENTS_BATCH_SIZE", 500))
+    EVENTS_KEEPALIVE_SECONDS: int = int(os.getenv("EVENTS_KEEPALIVE_SECONDS", 15))
+    class Config:
+        env_file = ".env"
+
+# Cada cuánto se comprueba como mucho si .env cambió (lo escribe update_config en cualquier worker)
+RELOAD_CHECK_INTERVAL = 1.0
+
+_settings = None
+_env_mtime = None
+_last_check = 0.0
+_lock = threading.Lock()
+
+def _read_env_mtime():
+    try:
+        return os.stat(ENV_FILE).st_mtime_ns
+    except OSError:
+        return None
+
+def get_settings() -> Settings:
+    # Un único objeto por proceso: los módulos que lo guardan a nivel de módulo ven las recargas
+    if _settings is None:
+        with _lock:
+            if _settings is None:
+                _load()
+    return _settings
+
+def _load():
+    global _settings, _env_mtime
+    _env_mtime = _read_env_mtime()
+    _settings = Settings()
+
+def reload_settings() -> Settings:
+    # Relee .env y actualiza el objeto existente en sitio
+    global _settings, _env_mtime
+    with _lock:
+        _env_mtime = _read_env_mtime()
+        for key, value in dotenv_values(ENV_FILE).items():
+            if key not in PROCESS_ENV and value is not None:
+                os.environ[key] = value
+        fresh = Settings()
+        if _settings is None:
+            _settings = fresh
+        else:
+            for name in Settings.model_fields:
+                setattr(_settings, name, getattr(fresh, name))
+    return _settings
+
+def reload_if_changed() -> bool:
+    # Barato para llamarlo en cada petición: un stat() de .env como mucho cada RELOAD_CHECK_INTERVAL
+    global _last_check
+    now = time.monotonic()
+    if now - _last_check < RELOAD_CHECK_INTERVAL:
+        return False
+    _last_check = now
+    if _read_env_mtime() == _env_mtime:
+        return False
+    reload_settings()
+    return True
+
+def _env_value(value: str) -> str:
+    if value and any(c in value for c in ' #"\'\\$'):
+        return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    return value
+
+def write_env(updates: dict):
+    # Reescribe solo las claves indicadas, conservando el resto del fichero; reemplazo atómico
+    lines = []
+    if os.path.exists(ENV_FILE):
+        with open(ENV_FILE) as f:
+            lines = f.read().splitlines()
+    pending = dict(updates)
+    output = []
+    for line in lines:
+        key = line.split("=", 1)[0].strip()
+        if "=" in line and not line.lstrip().startswith("#") and key in pending:
+            output.append(f"{key}={_env_value(pending.pop(key))}")
+        else:
+            output.append(line)
+    output.extend(f"{key}={_env_value(value)}" for key, value in pending.items())
+    tmp_path = ENV_FILE + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(output) + "\n")
+    os.replace(tmp_path, ENV_FILE)
@@ -0,0 +1,26 @@
+import hashlib
+from datetime import timezone
+from email.utils import format_datetime
+from fastapi import Response
+
+def make_etag(*parts) -> str:
+    # ETag fuerte a partir de versiones baratas de leer, sin serializar la respuesta
+    return '"' + hashlib.sha1(repr(parts).encode()).hexdigest() + '"'
+
+def etag_matches(if_none_match, etag: str) -> bool:
+    # If-None-Match usa comparación débil: W/"x" equivale a "x"
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+def cache_headers(etag: str, last_modified=None) -> dict:
+    # no-cache: el cliente puede guardar la respuesta pero debe revalidarla siempre
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(last_modified.replace(tzinfo=timezone.utc), usegmt=True)
+    return headers
+
+def not_modified(etag: str, last_modified=None) -> Response:
+    return Response(status_code=304, headers=cache_headers(etag, last_modified))
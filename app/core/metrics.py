@@ -0,0 +1,190 @@
+import bisect
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from sqlalchemy import event
+from app.core.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# Límites de los buckets de latencia, en segundos
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class RequestStats:
+    __slots__ = ("queries", "db_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+# Objeto mutable por petición: el threadpool y los greenlets del motor async trabajan sobre una copia del
+# contexto, pero comparten la misma instancia
+current_request = contextvars.ContextVar("current_request", default=None)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(Histogram)  # (method, route)
+        self.requests = Counter()  # (method, route, status)
+        self.request_queries = Counter()  # (method, route)
+        self.request_db_seconds = Counter()  # (method, route)
+        self.slow_requests = 0
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.slow_queries = 0
+
+    def record_request(self, method: str, route: str, status: int, seconds: float, stats: RequestStats):
+        key = (method, route)
+        with self.lock:
+            self.latency[key].observe(seconds)
+            self.requests[(method, route, status)] += 1
+            self.request_queries[key] += stats.queries
+            self.request_db_seconds[key] += stats.db_seconds
+        if seconds * 1000 >= settings.SLOW_REQUEST_MS:
+            with self.lock:
+                self.slow_requests += 1
+            logger.warning(
+                "Petición lenta: %s %s %.1f ms (%s consultas, %.1f ms en BD)",
+                method, route, seconds * 1000, stats.queries, stats.db_seconds * 1000,
+            )
+
+    def record_query(self, statement: str, seconds: float):
+        with self.lock:
+            self.queries += 1
+            self.query_seconds += seconds
+            slow = seconds * 1000 >= settings.SLOW_QUERY_MS
+            if slow:
+                self.slow_queries += 1
+        stats = current_request.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += seconds
+        if slow:
+            logger.warning("Consulta lenta (%.1f ms): %s", seconds * 1000, " ".join(statement.split())[:500])
+
+registry = Registry()
+
+def instrument_engine(engine):
+    # Para el motor async pasar engine.sync_engine
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        registry.record_query(statement, time.perf_counter() - conn.info["query_start"].pop())
+
+    @event.listens_for(engine, "handle_error")
+    def _error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("query_start"):
+            conn.info["query_start"].pop()
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(**labels) -> str:
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+def render_prometheus(gauges: dict = None) -> str:
+    # Formato de exposición de texto de Prometheus
+    lines = []
+    with registry.lock:
+        lines += ["# TYPE kegtracker_request_duration_seconds histogram"]
+        for (method, route), hist in sorted(registry.latency.items()):
+            cumulative = 0
+            for bound, count in zip(hist.buckets + ("+Inf",), hist.counts):
+                cumulative += count
+                lines.append(f"kegtracker_request_duration_seconds_bucket{_labels(method=method, route=route, le=bound)} {cumulative}")
+            lines.append(f"kegtracker_request_duration_seconds_sum{_labels(method=method, route=route)} {hist.sum!r}")
+            lines.append(f"kegtracker_request_duration_seconds_count{_labels(method=method, route=route)} {hist.count}")
+        lines.append("# TYPE kegtracker_requests_total counter")
+        for (method, route, status), count in sorted(registry.requests.items()):
+            lines.append(f"kegtracker_requests_total{_labels(method=method, route=route, status=status)} {count}")
+        lines.append("# TYPE kegtracker_request_sql_queries_total counter")
+        for (method, route), count in sorted(registry.request_queries.items()):
+            lines.append(f"kegtracker_request_sql_queries_total{_labels(method=method, route=route)} {count}")
+        lines.append("# TYPE kegtracker_request_db_seconds_total counter")
+        for (method, route), seconds in sorted(registry.request_db_seconds.items()):
+            lines.append(f"kegtracker_request_db_seconds_total{_labels(method=method, route=route)} {seconds!r}")
+        totals = {
+            "kegtracker_slow_requests_total": registry.slow_requests,
+            "kegtracker_sql_queries_total": registry.queries,
+            "kegtracker_sql_seconds_total": registry.query_seconds,
+            "kegtracker_slow_queries_total": registry.slow_queries,
+        }
+    for name, value in totals.items():
+        lines += [f"# TYPE {name} counter", f"{name} {_number(value)}"]
+    for name, value in sorted((gauges or {}).items()):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines += [f"# TYPE {name} gauge", f"{name} {_number(value)}"]
+    return "\n".join(lines) + "\n"
+
+def flatten(prefix: str, stats: dict) -> dict:
+    return {f"{prefix}_{key}": value for key, value in stats.items()}
+
+# Ficheros que indican un hilo parado esperando trabajo: no aportan al perfil
+_IDLE_FILES = ("threading.py", "selectors.py", "queue.py", "thread.py")
+
+class StackSampler:
+    # Perfilador por muestreo: cada intervalo captura la pila de todos los hilos (event loop y threadpool,
+    # donde corren los handlers síncronos). Salida en formato "collapsed stacks" (flamegraph.pl, speedscope).
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="stack-sampler")
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own or frame.f_code.co_filename.endswith(_IDLE_FILES):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.samples
+
+    def dump(self, path: str):
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+def profile_path(method: str, route: str):
+    # Devuelve (id, ruta): al cliente solo se le da el id, la ruta del servidor no sale en la respuesta
+    os.makedirs(settings.PROFILE_DIR, mode=0o700, exist_ok=True)
+    profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:12]}"
+    name = f"{profile_id}-{method}-{route.strip('/').replace('/', '_') or 'root'}.txt"
+    return profile_id, os.path.join(settings.PROFILE_DIR, name.replace("{", "").replace("}", ""))
@@ -0,0 +1,108 @@
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+from passlib.context import CryptContext
+from app.core.config import get_settings
+
+settings = get_settings()
+
+# Contexto único de la app: si cambia BCRYPT_ROUNDS, los hashes antiguos se regeneran en el siguiente login
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.BCRYPT_ROUNDS)
+
+# Segundos sugeridos al cliente cuando la cola de hashing está llena
+RETRY_AFTER_SECONDS = 2
+
+_pool = None
+_pool_lock = threading.Lock()
+# Hashes en curso o en cola; por encima del límite se responde 503 en lugar de acumular hilos esperando
+_pending = threading.BoundedSemaphore(max(1, settings.PASSWORD_HASH_MAX_PENDING))
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+def _verify_and_update(password: str, hashed: str):
+    try:
+        return pwd_context.verify_and_update(password, hashed)
+    except (ValueError, TypeError):
+        # Hash vacío o irreconocible: credenciales inválidas, no un error del servidor
+        return False, None
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=settings.PASSWORD_HASH_WORKERS)
+        return _pool
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+def _busy():
+    return HTTPException(
+        status_code=503,
+        detail="Servidor ocupado, inténtalo de nuevo",
+        headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+    )
+
+def _submit(fn, *args):
+    if not _pending.acquire(blocking=False):
+        raise _busy()
+    try:
+        future = get_pool().submit(fn, *args)
+    except Exception:
+        _pending.release()
+        raise
+    future.add_done_callback(lambda _: _pending.release())
+    return future
+
+def _run(fn, *args):
+    # Bloquea el hilo que llama (handlers síncronos, en el threadpool) pero no su CPU:
+    # bcrypt corre en el pool de procesos. Desde el event loop usar las variantes async.
+    if settings.PASSWORD_HASH_WORKERS <= 0:
+        return fn(*args)
+    future = _submit(fn, *args)
+    try:
+        return future.result(timeout=settings.PASSWORD_HASH_TIMEOUT)
+    except TimeoutError:
+        future.cancel()
+        raise _busy()
+
+async def _run_async(fn, *args):
+    if settings.PASSWORD_HASH_WORKERS <= 0:
+        return await run_in_threadpool(fn, *args)
+    future = _submit(fn, *args)
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), settings.PASSWORD_HASH_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise _busy()
+
+def hash_password(password: str) -> str:
+    return _run(_hash, password)
+
+def verify_password(password: str, hashed: str):
+    # Devuelve (válida, nuevo_hash); nuevo_hash no es None si el hash debe regenerarse con los parámetros actuales
+    if not hashed:
+        return False, None
+    return _run(_verify_and_update, password, hashed)
+
+async def hash_password_async(password: str) -> str:
+    return await _run_async(_hash, password)
+
+async def verify_password_async(password: str, hashed: str):
+    if not hashed:
+        return False, None
+    return await _run_async(_verify_and_update, password, hashed)
+
+def password_pool_stats() -> dict:
+    return {
+        "workers": settings.PASSWORD_HASH_WORKERS,
+        "max_pending": settings.PASSWORD_HASH_MAX_PENDING,
+        "pending": settings.PASSWORD_HASH_MAX_PENDING - _pending._value,
+        "rounds": settings.BCRYPT_ROUNDS,
+    }
@@ -1,8 +1,274 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import functools
+import inspect
+import threading
+import time
+from fastapi import Depends
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from starlette.concurrency import run_in_threadpool
 from app.core.config import get_settings
 
 settings = get_settings()
 
-engine = create_engine(settings.DB_URL, connect_args={"check_same_thread": False} if "sqlite" in settings.DB_URL else {})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine) 
\ No newline at end of file
+class PoolMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+
+    def record_wait(self, seconds: float, timed_out: bool = False):
+        with self.lock:
+            self.waits += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+pool_metrics = PoolMetrics()
+
+class TimedQueuePool(QueuePool):
+    # Mide cuánto espera cada checkout a que haya una conexión libre en el pool
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            pool_metrics.record_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_metrics.record_wait(time.perf_counter() - start)
+        return connection
+
+def engine_options(db_url: str) -> dict:
+    if "sqlite" in db_url:
+        options = {"connect_args": {"check_same_thread": False}}
+        if not is_sqlite_file(db_url):
+            return options
+    else:
+        options = {
+            "pool_pre_ping": settings.DB_POOL_PRE_PING,
+            "pool_recycle": settings.DB_POOL_RECYCLE,
+        }
+    options.update(
+        poolclass=TimedQueuePool,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+    )
+    return options
+
+class SQLiteWriteGate:
+    # Serializa las transacciones de escritura del proceso: los escritores esperan en un lock de Python
+    # en lugar de competir por el lock de SQLite; con WAL los lectores nunca esperan.
+    def __init__(self, timeout: float):
+        self.lock = threading.Lock()
+        self.timeout = timeout
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.timeouts = 0
+
+    def acquire(self, info: dict):
+        if info.get("sqlite_write_lock"):
+            return
+        start = time.perf_counter()
+        acquired = self.lock.acquire(timeout=self.timeout)
+        self.waits += 1
+        self.wait_seconds += time.perf_counter() - start
+        if acquired:
+            info["sqlite_write_lock"] = True
+        else:
+            # Sin lock: queda en manos del busy_timeout de SQLite
+            self.timeouts += 1
+
+    def release(self, info: dict):
+        if info.pop("sqlite_write_lock", False):
+            self.lock.release()
+
+SQLITE_WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE", "REPLACE", "CREATE", "DROP", "ALTER")
+
+def is_sqlite_file(db_url: str) -> bool:
+    return "sqlite" in db_url and ":memory:" not in db_url and not db_url.rstrip("/").endswith("sqlite:")
+
+def configure_sqlite(engine, wal: bool = True, serialize_writes: bool = True):
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if wal:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT_MS)}")
+        cursor.execute(f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}")
+        cursor.execute(f"PRAGMA cache_size={int(settings.SQLITE_CACHE_SIZE)}")
+        cursor.close()
+
+    if not serialize_writes:
+        return None
+    gate = SQLiteWriteGate(timeout=settings.SQLITE_BUSY_TIMEOUT_MS / 1000)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _acquire_write(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip()[:7].upper().startswith(SQLITE_WRITE_STATEMENTS):
+            gate.acquire(conn.info)
+
+    @event.listens_for(engine, "commit")
+    def _release_on_commit(conn):
+        gate.release(conn.info)
+
+    @event.listens_for(engine, "rollback")
+    def _release_on_rollback(conn):
+        gate.release(conn.info)
+
+    @event.listens_for(engine, "reset")
+    def _release_on_reset(dbapi_connection, connection_record, reset_state):
+        # Red de seguridad: una conexión nunca vuelve al pool con el lock tomado
+        gate.release(connection_record.info)
+
+    return gate
+
+def instrument_pool(engine):
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        with pool_metrics.lock:
+            pool_metrics.connects += 1
+
+    @event.listens_for(engine, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        with pool_metrics.lock:
+            pool_metrics.checkouts += 1
+
+    @event.listens_for(engine, "checkin")
+    def _on_checkin(dbapi_connection, connection_record):
+        with pool_metrics.lock:
+            pool_metrics.checkins += 1
+
+def create_db_engine(db_url: str, sqlite_profile: bool = True):
+    engine = create_engine(db_url, **engine_options(db_url))
+    instrument_pool(engine)
+    engine.sqlite_write_gate = None
+    if sqlite_profile and is_sqlite_file(db_url):
+        engine.sqlite_write_gate = configure_sqlite(
+            engine, wal=settings.SQLITE_WAL, serialize_writes=settings.SQLITE_SERIALIZE_WRITES
+        )
+    return engine
+
+# Drivers asyncio por dialecto: aiosqlite (requirements.txt) o aiomysql (instalar aparte para MySQL)
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "mysql": "mysql+aiomysql"}
+
+def async_db_url(db_url: str) -> str:
+    scheme, sep, rest = db_url.partition(":")
+    dialect = scheme.split("+")[0]
+    if dialect not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for '{scheme}'; set DB_ASYNC_URL")
+    return ASYNC_DRIVERS[dialect] + sep + rest
+
+def create_async_db_engine(db_url: str, async_url: str = None):
+    from sqlalchemy.ext.asyncio import create_async_engine
+    options = engine_options(db_url)
+    if options.get("poolclass") is TimedQueuePool:
+        options["poolclass"] = AsyncAdaptedQueuePool
+    engine = create_async_engine(async_url or async_db_url(db_url), **options)
+    instrument_pool(engine.sync_engine)
+    if is_sqlite_file(db_url):
+        # Solo pragmas: el lock de escritores es un threading.Lock y bloquearía el event loop;
+        # las escrituras concurrentes esperan en el busy_timeout, dentro del hilo de aiosqlite
+        configure_sqlite(engine.sync_engine, wal=settings.SQLITE_WAL, serialize_writes=False)
+    return engine
+
+engine = create_db_engine(settings.DB_URL)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def get_db():
+    # Una sesión por petición, compartida por la autenticación y el handler; siempre se cierra
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+async_engine = create_async_db_engine(settings.DB_URL, settings.DB_ASYNC_URL) if settings.DB_ASYNC else None
+
+class SessionRunner:
+    # Ejecuta código ORM síncrono sin ocupar el event loop: con el motor async corre en un greenlet
+    # sobre AsyncSession (la E/S es del driver asyncio); si no, en el threadpool con la sesión de get_db
+    def __init__(self, session, is_async: bool = False):
+        self.session = session
+        self.is_async = is_async
+
+    async def run(self, fn, *args, **kwargs):
+        if self.is_async:
+            return await self.session.run_sync(fn, *args, **kwargs)
+        return await run_in_threadpool(fn, self.session, *args, **kwargs)
+
+def async_session_dependency(session_factory):
+    async def get_async_session_runner():
+        async with session_factory() as session:
+            yield SessionRunner(session, is_async=True)
+    return get_async_session_runner
+
+async def get_sync_session_runner(db: Session = Depends(get_db)):
+    yield SessionRunner(db)
+
+if async_engine is not None:
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+    # expire_on_commit=False: la respuesta se serializa fuera del greenlet, sin poder recargar atributos
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    get_session_runner = async_session_dependency(AsyncSessionLocal)
+else:
+    AsyncSessionLocal = None
+    get_session_runner = get_sync_session_runner
+
+def with_session(endpoint):
+    # Convierte un handler síncrono que recibe `db: Session` en un endpoint async que lo ejecuta con
+    # get_session_runner; el cuerpo del handler no cambia entre el modo síncrono y DB_ASYNC
+    signature = inspect.signature(endpoint)
+    parameters = [
+        p.replace(annotation=SessionRunner, default=Depends(get_session_runner)) if p.name == "db" else p
+        for p in signature.parameters.values()
+    ]
+
+    @functools.wraps(endpoint)
+    async def wrapper(*args, db: SessionRunner, **kwargs):
+        return await db.run(lambda session: endpoint(*args, db=session, **kwargs))
+
+    wrapper.__signature__ = signature.replace(parameters=parameters)
+    return wrapper
+
+def pool_stats() -> dict:
+    pool = engine.pool
+    stats = {
+        "connects": pool_metrics.connects,
+        "checkouts": pool_metrics.checkouts,
+        "checkins": pool_metrics.checkins,
+        "waits": pool_metrics.waits,
+        "wait_seconds_total": round(pool_metrics.wait_seconds, 6),
+        "wait_seconds_max": round(pool_metrics.max_wait_seconds, 6),
+        "timeouts": pool_metrics.timeouts,
+    }
+    gate = getattr(engine, "sqlite_write_gate", None)
+    if gate is not None:
+        stats.update(
+            sqlite_write_waits=gate.waits,
+            sqlite_write_wait_seconds_total=round(gate.wait_seconds, 6),
+            sqlite_write_timeouts=gate.timeouts,
+        )
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+            checked_in=pool.checkedin(),
+        )
+    if async_engine is not None and isinstance(async_engine.pool, QueuePool):
+        async_pool = async_engine.pool
+        stats["async"] = {
+            "size": async_pool.size(),
+            "checked_out": async_pool.checkedout(),
+            "overflow": async_pool.overflow(),
+            "checked_in": async_pool.checkedin(),
+        }
+    return stats
@@ -1,8 +1,10 @@
 from .database import engine
-from .models import Base
+from .migrations import upgrade
 
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    # Crea las tablas que falten y añade columnas e índices nuevos a bases de datos ya existentes,
+    # bajo el lock de migraciones (create_all por separado compite entre workers)
+    upgrade(engine)
 
 if __name__ == "__main__":
     init_db() 
\ No newline at end of file
@@ -0,0 +1,237 @@
+import argparse
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, bindparam, func, inspect, select, text, update
+from sqlalchemy.exc import OperationalError
+from app.core.config import get_settings
+from .models import Base, ChangeCounter, Keg, KegStateHistory
+
+# Registro de migraciones aplicadas, fuera de Base para no mezclarlo con el modelo de la app
+migration_metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    migration_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String(255)),
+    Column("applied_at", DateTime, default=datetime.utcnow),
+)
+
+# Migraciones de datos versionadas: (versión, nombre, función(conn)).
+# Las columnas e índices nuevos del modelo no necesitan entrada: los añade sync_schema.
+MIGRATIONS = []
+
+def migration(version: int, name: str):
+    def register(fn):
+        MIGRATIONS.append((version, name, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return register
+
+# Filas por UPDATE executemany en los rellenos de datos
+BACKFILL_BATCH_SIZE = 1000
+
+@migration(1, "keg change versions")
+def backfill_keg_versions(conn):
+    # Barriles anteriores a la sincronización incremental: versiones 1..N y el contador "kegs" en N
+    kegs = Keg.__table__
+    counters = ChangeCounter.__table__
+    current = conn.execute(select(counters.c.value).where(counters.c.name == "kegs")).scalar()
+    if current is None:
+        current = conn.execute(select(func.coalesce(func.max(kegs.c.version), 0))).scalar()
+        conn.execute(counters.insert().values(name="kegs", value=current))
+    ids = conn.execute(select(kegs.c.id).where(kegs.c.version.is_(None)).order_by(kegs.c.id)).scalars().all()
+    now = datetime.utcnow()
+    statement = update(kegs).where(kegs.c.id == bindparam("keg_id")).values(version=bindparam("new_version"), updated_at=now)
+    for start in range(0, len(ids), BACKFILL_BATCH_SIZE):
+        conn.execute(statement, [
+            {"keg_id": keg_id, "new_version": current + start + i + 1} for i, keg_id in enumerate(ids[start:start + BACKFILL_BATCH_SIZE])
+        ])
+    conn.execute(update(counters).where(counters.c.name == "kegs").values(value=current + len(ids)))
+
+@migration(2, "list change counters")
+def create_list_counters(conn):
+    counters = ChangeCounter.__table__
+    existing = set(conn.execute(select(counters.c.name)).scalars())
+    for name in ("breweries", "users"):
+        if name not in existing:
+            conn.execute(counters.insert().values(name=name, value=0))
+
+# Índice de búsqueda de texto de barriles (app/services/keg_search.py)
+SQLITE_SEARCH_INDEX = [
+    # Copia de los campos buscables con rowid propio (INTEGER PRIMARY KEY, estable en VACUUM), enlazada
+    # con kegs por keg_id: el rowid implícito de kegs (clave TEXT) puede renumerarse
+    "CREATE TABLE IF NOT EXISTS kegs_search (rowid INTEGER PRIMARY KEY, keg_id TEXT NOT NULL UNIQUE, "
+    "brewery_id TEXT, name TEXT, beer_type TEXT, location TEXT)",
+    "CREATE INDEX IF NOT EXISTS ix_kegs_search_brewery ON kegs_search (brewery_id)",
+    # Tabla FTS5 de contenido externo sobre kegs_search: solo guarda el índice.
+    # Índice de prefijos de 2 y 3 letras para la última palabra mientras se escribe ("po" -> "porter")
+    "CREATE VIRTUAL TABLE IF NOT EXISTS kegs_fts USING fts5(name, beer_type, location, "
+    "content='kegs_search', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS kegs_search_ai AFTER INSERT ON kegs BEGIN "
+    "INSERT INTO kegs_search(keg_id, brewery_id, name, beer_type, location) VALUES (new.id, new.brewery_id, new.name, new.beer_type, new.location); END",
+    "CREATE TRIGGER IF NOT EXISTS kegs_search_ad AFTER DELETE ON kegs BEGIN "
+    "DELETE FROM kegs_search WHERE keg_id = old.id; END",
+    "CREATE TRIGGER IF NOT EXISTS kegs_search_au AFTER UPDATE OF id, brewery_id, name, beer_type, location ON kegs BEGIN "
+    "UPDATE kegs_search SET keg_id = new.id, brewery_id = new.brewery_id, name = new.name, beer_type = new.beer_type, "
+    "location = new.location WHERE keg_id = old.id; END",
+    "CREATE TRIGGER IF NOT EXISTS kegs_fts_ai AFTER INSERT ON kegs_search BEGIN "
+    "INSERT INTO kegs_fts(rowid, name, beer_type, location) VALUES (new.rowid, new.name, new.beer_type, new.location); END",
+    "CREATE TRIGGER IF NOT EXISTS kegs_fts_ad AFTER DELETE ON kegs_search BEGIN "
+    "INSERT INTO kegs_fts(kegs_fts, rowid, name, beer_type, location) VALUES ('delete', old.rowid, old.name, old.beer_type, old.location); END",
+    "CREATE TRIGGER IF NOT EXISTS kegs_fts_au AFTER UPDATE OF name, beer_type, location ON kegs_search BEGIN "
+    "INSERT INTO kegs_fts(kegs_fts, rowid, name, beer_type, location) VALUES ('delete', old.rowid, old.name, old.beer_type, old.location); "
+    "INSERT INTO kegs_fts(rowid, name, beer_type, location) VALUES (new.rowid, new.name, new.beer_type, new.location); END",
+]
+# Primera versión del índice, con kegs como contenido externo enlazado por su rowid implícito
+LEGACY_SQLITE_SEARCH_INDEX = [
+    "DROP TRIGGER IF EXISTS kegs_fts_ai",
+    "DROP TRIGGER IF EXISTS kegs_fts_ad",
+    "DROP TRIGGER IF EXISTS kegs_fts_au",
+    "DROP TABLE IF EXISTS kegs_fts",
+]
+
+def rebuild_search_index(conn):
+    # Vuelve a copiar kegs en kegs_search (los triggers mantienen kegs_fts) y reconstruye el índice
+    if conn.dialect.name == "sqlite":
+        conn.execute(text("DELETE FROM kegs_search"))
+        conn.execute(text(
+            "INSERT INTO kegs_search(keg_id, brewery_id, name, beer_type, location) "
+            "SELECT id, brewery_id, name, beer_type, location FROM kegs"
+        ))
+        conn.execute(text("INSERT INTO kegs_fts(kegs_fts) VALUES ('rebuild')"))
+
+@migration(3, "keg search index")
+def create_search_index(conn):
+    if conn.dialect.name == "sqlite":
+        for statement in SQLITE_SEARCH_INDEX:
+            conn.execute(text(statement))
+        rebuild_search_index(conn)
+    elif conn.dialect.name == "mysql":
+        conn.execute(text("ALTER TABLE kegs ADD FULLTEXT INDEX ft_kegs_search (name, beer_type, location)"))
+
+@migration(4, "keg dwell pending history")
+def mark_history_pending(conn):
+    # Historial anterior a dwell_pending: refresh_dwell lo vuelve a materializar entero una vez
+    history = KegStateHistory.__table__
+    conn.execute(update(history).where(history.c.dwell_pending.is_(None)).values(dwell_pending=True))
+
+@migration(5, "keg search index by keg id")
+def relink_search_index(conn):
+    # Bases de datos que aplicaron la primera versión de la migración 3
+    if conn.dialect.name == "sqlite" and not inspect(conn).has_table("kegs_search"):
+        for statement in LEGACY_SQLITE_SEARCH_INDEX:
+            conn.execute(text(statement))
+        create_search_index(conn)
+
+def schema_changes(conn):
+    # Columnas e índices declarados en los modelos que faltan en la base de datos
+    inspector = inspect(conn)
+    existing_tables = set(inspector.get_table_names())
+    changes = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            changes.append((f"create table {table.name}", lambda c, t=table: t.create(c)))
+            continue
+        existing_columns = {col["name"] for col in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                changes.append((f"add column {table.name}.{column.name}", lambda c, t=table, col=column: _add_column(c, t, col)))
+        existing_indexes = {idx["name"] for idx in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                changes.append((f"create index {index.name}", lambda c, i=index: i.create(c)))
+    return changes
+
+def _add_column(conn, table, column):
+    preparer = conn.dialect.identifier_preparer
+    column_type = column.type.compile(dialect=conn.dialect)
+    conn.execute(text(
+        f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} {column_type}"
+    ))
+
+def pending_migrations(conn, dry_run: bool = False):
+    if not inspect(conn).has_table(schema_migrations.name):
+        if dry_run:
+            return list(MIGRATIONS)
+        schema_migrations.create(conn)
+    applied = set(conn.execute(select(schema_migrations.c.version)).scalars())
+    return [m for m in MIGRATIONS if m[0] not in applied]
+
+# Nombre del lock de MySQL y clave del advisory lock de PostgreSQL
+MIGRATION_LOCK_NAME = "kegtracker_migrations"
+MIGRATION_LOCK_KEY = 727210
+
+@contextmanager
+def migration_lock(conn, timeout: float):
+    # Un solo proceso migra a la vez (cada worker llama a upgrade al arrancar); el resto espera y después
+    # vuelve a calcular los cambios pendientes, que ya estarán aplicados
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        # Lock de escritura de SQLite hasta el commit; busy_timeout puede ser más corto que una migración
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                conn.exec_driver_sql("BEGIN IMMEDIATE")
+                break
+            except OperationalError as error:
+                if "locked" not in str(error) or time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        yield
+    elif dialect == "mysql":
+        # GET_LOCK es de sesión: se mantiene aunque los DDL de MySQL hagan commit implícito
+        if conn.execute(text("SELECT GET_LOCK(:name, :timeout)"), {"name": MIGRATION_LOCK_NAME, "timeout": int(timeout)}).scalar() != 1:
+            raise RuntimeError("Timeout waiting for the migration lock")
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT RELEASE_LOCK(:name)"), {"name": MIGRATION_LOCK_NAME})
+    elif dialect == "postgresql":
+        # Se libera con el commit
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        yield
+    else:
+        yield
+
+def _apply_pending(conn, dry_run: bool):
+    applied = []
+    for description, apply in schema_changes(conn):
+        applied.append(description)
+        if not dry_run:
+            apply(conn)
+    for version, name, fn in pending_migrations(conn, dry_run):
+        applied.append(f"migration {version}: {name}")
+        if not dry_run:
+            fn(conn)
+            conn.execute(schema_migrations.insert().values(version=version, name=name))
+    return applied
+
+def upgrade(engine, dry_run: bool = False):
+    # Seguro para ejecutar en cada arranque y desde varios workers a la vez: solo aplica lo que falte
+    with engine.connect() as conn:
+        if dry_run:
+            return _apply_pending(conn, dry_run)
+        with migration_lock(conn, get_settings().MIGRATION_LOCK_TIMEOUT):
+            applied = _apply_pending(conn, dry_run)
+            conn.commit()
+    return applied
+
+def main():
+    parser = argparse.ArgumentParser(description="Aplica cambios de esquema e índices pendientes")
+    parser.add_argument("--dry-run", action="store_true", help="Solo mostrar los cambios pendientes")
+    parser.add_argument("--rebuild-search", action="store_true", help="Reconstruir el índice de búsqueda de barriles")
+    args = parser.parse_args()
+    from .database import engine
+    changes = upgrade(engine, dry_run=args.dry_run)
+    if not changes:
+        print("Base de datos al día")
+    for change in changes:
+        print(("[pendiente] " if args.dry_run else "[aplicado] ") + change)
+    if args.rebuild_search and not args.dry_run:
+        with engine.begin() as conn:
+            rebuild_search_index(conn)
+        print("[aplicado] rebuild search index")
+
+if __name__ == "__main__":
+    main()
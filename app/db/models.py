@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Enum, DateTime
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, ForeignKey, Enum, DateTime, Index, Text
 from sqlalchemy.orm import declarative_base, relationship
 import enum
 from datetime import datetime
@@ -27,7 +27,7 @@ class User(Base):
     hashed_password = Column(String)
     active = Column(Boolean, default=True)
     role = Column(Enum(UserRole), default=UserRole.USER)
-    brewery_id = Column(String, ForeignKey("breweries.id"))
+    brewery_id = Column(String, ForeignKey("breweries.id"), index=True)
     brewery = relationship("Brewery", back_populates="users")
 
 class KegType(str, enum.Enum):
@@ -61,6 +61,38 @@ class Keg(Base):
     brewery_id = Column(String, ForeignKey("breweries.id"))
     brewery = relationship("Brewery", back_populates="kegs")
     location = Column(String, nullable=True)
+    # Versión de cambio: valor del contador global "kegs" (ChangeCounter) asignado en cada escritura
+    version = Column(BigInteger)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    # Índices de las rutas calientes: listados por cervecería/estado, paginación por clave y filtros
+    __table_args__ = (
+        Index("ix_kegs_brewery_state", "brewery_id", "state"),
+        Index("ix_kegs_brewery_id_id", "brewery_id", "id"),
+        Index("ix_kegs_brewery_name", "brewery_id", "name"),
+        Index("ix_kegs_beer_type", "beer_type"),
+        Index("ix_kegs_location", "location"),
+        Index("ix_kegs_version", "version"),
+        Index("ix_kegs_brewery_version", "brewery_id", "version"),
+    )
+
+class KegTombstone(Base):
+    # Barriles eliminados (o movidos a otra cervecería) para la sincronización incremental
+    __tablename__ = "keg_tombstones"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    keg_id = Column(String, index=True)
+    brewery_id = Column(String)
+    version = Column(BigInteger)
+    deleted_at = Column(DateTime, default=datetime.utcnow, index=True)
+    __table_args__ = (
+        Index("ix_keg_tombstones_version", "version"),
+        Index("ix_keg_tombstones_brewery_version", "brewery_id", "version"),
+    )
+
+class ChangeCounter(Base):
+    # Contadores monótonos por nombre; el UPDATE que los incrementa serializa a los escritores hasta el commit
+    __tablename__ = "change_counters"
+    name = Column(String(64), primary_key=True)
+    value = Column(BigInteger, default=0)
 
 class KegStateHistory(Base):
     __tablename__ = "keg_state_history"
@@ -70,5 +102,68 @@ class KegStateHistory(Base):
     new_state = Column(Enum(KegState))
     changed_at = Column(DateTime, default=datetime.utcnow)
     user_id = Column(String, ForeignKey("users.id"), nullable=True)
+    # True hasta que refresh_dwell lo materializa en keg_state_dwell (luego NULL), sin importar changed_at:
+    # recoge también transiciones con fecha en el pasado (sincronización offline)
+    dwell_pending = Column(Boolean, default=True, nullable=True)
     keg = relationship("Keg", backref="state_history")
-    user = relationship("User") 
\ No newline at end of file
+    user = relationship("User")
+    __table_args__ = (
+        Index("ix_keg_state_history_keg_changed", "keg_id", "changed_at"),
+        Index("ix_keg_state_history_changed_at", "changed_at"),
+        Index("ix_keg_state_history_dwell_pending", "dwell_pending"),
+    )
+
+class KegStateDwell(Base):
+    # Vista materializada de KegStateHistory: un registro por estado ocupado por un barril.
+    # id coincide con el KegStateHistory que abrió el estado; se cierra con la siguiente transición.
+    __tablename__ = "keg_state_dwell"
+    id = Column(String, primary_key=True)
+    # Sin claves foráneas: es un derivado y no debe bloquear el borrado de barriles
+    keg_id = Column(String)
+    brewery_id = Column(String)
+    state = Column(Enum(KegState))
+    next_state = Column(Enum(KegState), nullable=True)
+    started_at = Column(DateTime, index=True)
+    ended_at = Column(DateTime, nullable=True, index=True)
+    seconds = Column(Integer, nullable=True)
+    __table_args__ = (
+        Index("ix_keg_state_dwell_brewery_state_seconds", "brewery_id", "state", "seconds"),
+        Index("ix_keg_state_dwell_keg_started", "keg_id", "started_at"),
+    )
+
+class UsedToken(Base):
+    # Enlaces de un solo uso ya consumidos (invitaciones, reset de contraseña), por hash SHA-256 del token
+    __tablename__ = "used_tokens"
+    token_hash = Column(String(64), primary_key=True)
+    purpose = Column(String(20))
+    used_at = Column(DateTime, default=datetime.utcnow)
+    # Tras la expiración del token la fila ya no hace falta: el JWT se rechaza por sí solo
+    expires_at = Column(DateTime, index=True)
+
+class IdempotencyKey(Base):
+    # Resultado de cada operación de POST /api/kegs/sync por clave de idempotencia (SHA-256 de usuario + clave)
+    __tablename__ = "idempotency_keys"
+    key_hash = Column(String(64), primary_key=True)
+    result = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, index=True)
+
+class EmailOutbox(Base):
+    # Cola persistente de emails; la vacía el worker de app/services/email_outbox.py
+    __tablename__ = "email_outbox"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    to_address = Column(String(255))
+    subject = Column(String(255))
+    body = Column(Text)
+    status = Column(String(20), default="pending")  # pending | sending | sent | failed
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    claimed_by = Column(String(36), nullable=True)
+    claimed_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)
+    __table_args__ = (
+        Index("ix_email_outbox_status_next_attempt", "status", "next_attempt_at"),
+        Index("ix_email_outbox_claimed_by", "claimed_by"),
+    )
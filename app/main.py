@@ -1,14 +1,110 @@
-from fastapi import FastAPI
-from app.core.config import get_settings
-from app.api import wizard, auth, invite, users, breweries, kegs
+import hmac
+import time
+from typing import Optional
+import anyio.to_thread
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+from app.core.auth import optional_oauth2_scheme, principal_cache, user_from_token
+from app.core.config import get_settings, reload_if_changed
+from app.core.metrics import RequestStats, StackSampler, current_request, flatten, instrument_engine, profile_path, registry, render_prometheus
+from app.api import wizard, auth, invite, users, breweries, kegs, analytics
 from app.api import config as config_api
+from app.db.database import async_engine, engine, pool_stats
 from app.db.init_db import init_db
+from app.db.models import UserRole
+from app.core.security import shutdown_pool as shutdown_password_pool
+from app.services import analytics as analytics_service, email_outbox, events
+from app.services.email_service import preload_templates
+from app.services.keg_stats import stats_cache
+from app.services.labels import qr_cache, shutdown_pool
 
 app = FastAPI(title="KegTracker Backend")
 
+instrument_engine(engine)
+if async_engine is not None:
+    instrument_engine(async_engine.sync_engine)
+
+async def is_global_admin(token: Optional[str]) -> bool:
+    try:
+        return (await user_from_token(token or "")).role == UserRole.GLOBAL_ADMIN
+    except HTTPException:
+        return False
+
+@app.middleware("http")
+async def request_metrics(request: Request, call_next):
+    settings = get_settings()
+    if not settings.METRICS_ENABLED:
+        return await call_next(request)
+    stats = RequestStats()
+    token = current_request.set(stats)
+    # Perfilado opcional (staging): PROFILING_ENABLED=true y cabecera X-Profile en la petición de un admin global
+    sampler = None
+    if settings.PROFILING_ENABLED and request.headers.get("X-Profile"):
+        scheme, _, credentials = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() == "bearer" and await is_global_admin(credentials):
+            sampler = StackSampler(settings.PROFILE_INTERVAL_MS / 1000).start()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        elapsed = time.perf_counter() - start
+        current_request.reset(token)
+        # Plantilla de la ruta (/api/kegs/{keg_id}) para no crear una serie por id
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        registry.record_request(request.method, route, status, elapsed, stats)
+        if sampler is not None:
+            sampler.stop()
+            profile_id, profile_file = profile_path(request.method, route)
+            sampler.dump(profile_file)
+    if sampler is not None:
+        response.headers["X-Profile-Id"] = profile_id
+    response.headers["Server-Timing"] = f'app;dur={elapsed * 1000:.1f}, db;dur={stats.db_seconds * 1000:.1f};desc="{stats.queries} queries"'
+    return response
+
+@app.middleware("http")
+async def reload_config(request: Request, call_next):
+    # Recoge cambios de .env guardados por otro worker (PUT /api/config)
+    reload_if_changed()
+    return await call_next(request)
+
 @app.on_event("startup")
 def on_startup():
     init_db()
+    preload_templates()
+
+@app.on_event("startup")
+async def configure_threadpool():
+    # Hilos para los handlers síncronos y el modo sin DB_ASYNC (anyio trae 40 por defecto)
+    anyio.to_thread.current_default_thread_limiter().total_tokens = get_settings().THREADPOOL_SIZE
+
+@app.on_event("startup")
+async def start_email_worker():
+    await email_outbox.start_worker()
+
+@app.on_event("shutdown")
+async def stop_email_worker():
+    await email_outbox.stop_worker()
+
+@app.on_event("startup")
+async def start_analytics_worker():
+    # Materializa KegStateDwell en segundo plano (las peticiones solo procesan unos pocos lotes)
+    await analytics_service.start_worker()
+
+@app.on_event("shutdown")
+async def stop_analytics_worker():
+    await analytics_service.stop_worker()
+
+@app.on_event("shutdown")
+def on_shutdown():
+    shutdown_pool()
+    shutdown_password_pool()
+
+@app.on_event("shutdown")
+async def dispose_async_engine():
+    if async_engine is not None:
+        await async_engine.dispose()
 
 app.include_router(wizard.router, prefix="/api/wizard")  # Endpoint de inicialización: solo disponible si la app no tiene cervecerías ni usuarios
 app.include_router(auth.router, prefix="/api/auth")
@@ -16,8 +112,27 @@ app.include_router(invite.router, prefix="/api/invite")
 app.include_router(users.router, prefix="/api/users")
 app.include_router(breweries.router, prefix="/api/breweries")
 app.include_router(kegs.router, prefix="/api/kegs")
+app.include_router(analytics.router, prefix="/api/analytics")
 app.include_router(config_api.router, prefix="/api/config")
 
+async def metrics_access(token: Optional[str] = Depends(optional_oauth2_scheme)):
+    # METRICS_TOKEN (scraper de Prometheus) o el token de un admin global
+    expected = get_settings().METRICS_TOKEN
+    if expected and token and hmac.compare_digest(token.encode(), expected.encode()):
+        return
+    if not token:
+        raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    if not await is_global_admin(token):
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+
+@app.get("/metrics", include_in_schema=False, dependencies=[Depends(metrics_access)])
+def metrics():
+    gauges = flatten("kegtracker_db_pool", pool_stats())
+    for name, cache in (("auth", principal_cache), ("keg_stats", stats_cache), ("qr_labels", qr_cache)):
+        gauges.update(flatten(f"kegtracker_cache_{name}", cache.stats()))
+    gauges.update(flatten("kegtracker_events", events.notifier.stats()))
+    return PlainTextResponse(render_prometheus(gauges), media_type="text/plain; version=0.0.4")
+
 @app.get("/ping")
 def ping():
     return {"message": "pong"} 
\ No newline at end of file
@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import func, insert, update
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+from app.core.config import get_settings
+from app.db.database import SessionLocal
+from app.db.models import Keg, KegState, KegStateHistory, KegStateDwell
+
+# Barriles procesados por lote (todo su historial va en una consulta)
+REFRESH_KEGS_PER_BATCH = 500
+IN_CHUNK_SIZE = 500
+PERCENTILES = (50, 90)
+
+logger = logging.getLogger(__name__)
+
+_refresh_lock = threading.Lock()
+_last_refresh = 0.0
+
+def _pending_kegs(db):
+    # Barriles con historial sin materializar (índice por dwell_pending), paginados por clave
+    last = None
+    while True:
+        query = db.query(KegStateHistory.keg_id).filter(KegStateHistory.dwell_pending.is_(True), KegStateHistory.keg_id.isnot(None))
+        if last is not None:
+            query = query.filter(KegStateHistory.keg_id > last)
+        keg_ids = [row.keg_id for row in query.distinct().order_by(KegStateHistory.keg_id).limit(REFRESH_KEGS_PER_BATCH)]
+        if not keg_ids:
+            return
+        yield keg_ids
+        last = keg_ids[-1]
+
+def _transitions_query(db, keg_ids):
+    # LEAD sobre todo el historial de cada barril: una transición atrasada también corrige la anterior
+    window = {
+        "partition_by": KegStateHistory.keg_id,
+        "order_by": (KegStateHistory.changed_at, KegStateHistory.id),
+    }
+    return db.query(
+        KegStateHistory.id,
+        KegStateHistory.keg_id,
+        KegStateHistory.dwell_pending,
+        Keg.brewery_id,
+        KegStateHistory.new_state,
+        KegStateHistory.changed_at,
+        func.lead(KegStateHistory.changed_at, type_=KegStateHistory.changed_at.type).over(**window).label("next_at"),
+        func.lead(KegStateHistory.new_state, type_=KegStateHistory.new_state.type).over(**window).label("next_state"),
+    ).join(Keg, KegStateHistory.keg_id == Keg.id).filter(KegStateHistory.keg_id.in_(keg_ids))
+
+def _apply_batch(db, batch):
+    existing = {}
+    ids = [r.id for r in batch]
+    for i in range(0, len(ids), IN_CHUNK_SIZE):
+        query = db.query(KegStateDwell.id, KegStateDwell.ended_at, KegStateDwell.next_state, KegStateDwell.seconds).filter(
+            KegStateDwell.id.in_(ids[i:i + IN_CHUNK_SIZE])
+        )
+        existing.update((row.id, (row.ended_at, row.next_state, row.seconds)) for row in query)
+    inserts = []
+    updates = []
+    for row in batch:
+        values = {
+            "id": row.id,
+            "ended_at": row.next_at,
+            "next_state": row.next_state,
+            "seconds": int((row.next_at - row.changed_at).total_seconds()) if row.next_at else None,
+        }
+        if row.id not in existing:
+            values.update(keg_id=row.keg_id, brewery_id=row.brewery_id, state=row.new_state, started_at=row.changed_at)
+            inserts.append(values)
+        elif existing[row.id] != (values["ended_at"], values["next_state"], values["seconds"]):
+            updates.append(values)
+    if inserts:
+        db.execute(insert(KegStateDwell), inserts)
+    if updates:
+        db.execute(update(KegStateDwell), updates)
+    # Solo las filas leídas como pendientes: las que lleguen mientras tanto quedan para el siguiente refresco
+    pending = [row.id for row in batch if row.dwell_pending]
+    history = KegStateHistory.__table__
+    for i in range(0, len(pending), IN_CHUNK_SIZE):
+        db.execute(update(history).where(history.c.id.in_(pending[i:i + IN_CHUNK_SIZE])).values(dwell_pending=None))
+    return len(inserts), len(updates)
+
+def _refresh(db, max_batches: int = None):
+    # Un commit por lote: el lock de escritura se suelta entre lotes y dwell_pending permite continuar
+    # donde se quedó (un refresco interrumpido o limitado por max_batches)
+    inserted = updated = 0
+    for batches, keg_ids in enumerate(_pending_kegs(db), 1):
+        try:
+            i, u = _apply_batch(db, _transitions_query(db, keg_ids).all())
+            db.commit()
+            inserted, updated = inserted + i, updated + u
+        except IntegrityError:
+            # Otro worker materializó las mismas filas a la vez
+            db.rollback()
+        if max_batches is not None and batches >= max_batches:
+            break
+    return {"inserted": inserted, "updated": updated}
+
+def refresh_dwell(db):
+    # Actualización incremental: solo los barriles con historial pendiente, aunque su changed_at sea antiguo
+    with _refresh_lock:
+        return _refresh(db)
+
+def maybe_refresh_dwell(db):
+    # Desde las peticiones: como mucho cada ANALYTICS_REFRESH_INTERVAL segundos por proceso, sin esperar
+    # a un refresco en curso y hasta ANALYTICS_REFRESH_MAX_BATCHES lotes; el resto (p. ej. todo el
+    # historial tras la migración 4) lo procesa el worker en segundo plano
+    global _last_refresh
+    settings = get_settings()
+    now = time.monotonic()
+    if now - _last_refresh < settings.ANALYTICS_REFRESH_INTERVAL or not _refresh_lock.acquire(blocking=False):
+        return None
+    try:
+        _last_refresh = now
+        return _refresh(db, settings.ANALYTICS_REFRESH_MAX_BATCHES)
+    finally:
+        _refresh_lock.release()
+
+def _refresh_in_session():
+    db = SessionLocal()
+    try:
+        return refresh_dwell(db)
+    finally:
+        db.close()
+
+async def _run_worker():
+    while True:
+        try:
+            await run_in_threadpool(_refresh_in_session)
+        except Exception:
+            logger.exception("Error materializando KegStateDwell")
+        await asyncio.sleep(get_settings().ANALYTICS_REFRESH_INTERVAL)
+
+_worker = None
+
+async def start_worker():
+    global _worker
+    if get_settings().ANALYTICS_WORKER_ENABLED and _worker is None:
+        _worker = asyncio.get_running_loop().create_task(_run_worker())
+
+async def stop_worker():
+    global _worker
+    if _worker is not None:
+        _worker.cancel()
+        try:
+            await _worker
+        except asyncio.CancelledError:
+            pass
+        _worker = None
+
+def _percentile(db, base_filter, state, count, pct):
+    offset = min(count - 1, int(round((pct / 100) * (count - 1))))
+    return (
+        db.query(KegStateDwell.seconds)
+        .filter(*base_filter, KegStateDwell.state == state, KegStateDwell.seconds.isnot(None))
+        .order_by(KegStateDwell.seconds)
+        .offset(offset)
+        .limit(1)
+        .scalar()
+    )
+
+def dwell_summary(db, *base_filter):
+    # Tiempo en cada estado (media y percentiles) y transiciones más frecuentes
+    closed = KegStateDwell.seconds.isnot(None)
+    by_state = (
+        db.query(KegStateDwell.state, func.count(KegStateDwell.id), func.avg(KegStateDwell.seconds))
+        .filter(*base_filter, closed)
+        .group_by(KegStateDwell.state)
+        .all()
+    )
+    states = []
+    for state, count, avg in by_state:
+        entry = {"state": state.value, "count": count, "avg_seconds": float(avg) if avg is not None else None}
+        for pct in PERCENTILES:
+            entry[f"p{pct}_seconds"] = _percentile(db, base_filter, state, count, pct)
+        states.append(entry)
+    transitions = (
+        db.query(
+            KegStateDwell.state,
+            KegStateDwell.next_state,
+            func.count(KegStateDwell.id),
+            func.avg(KegStateDwell.seconds),
+        )
+        .filter(*base_filter, closed)
+        .group_by(KegStateDwell.state, KegStateDwell.next_state)
+        .all()
+    )
+    cycles = db.query(func.count(KegStateDwell.id)).filter(*base_filter, KegStateDwell.state == KegState.IN_USE).scalar()
+    return {
+        "states": states,
+        "transitions": [
+            {"from": s.value, "to": n.value if n else None, "count": c, "avg_seconds": float(a) if a is not None else None}
+            for s, n, c, a in transitions
+        ],
+        "cycles": cycles,
+    }
+
+def brewery_summary(db, brewery_id: str):
+    return dwell_summary(db, KegStateDwell.brewery_id == brewery_id)
+
+def keg_summary(db, keg_id: str):
+    summary = dwell_summary(db, KegStateDwell.keg_id == keg_id)
+    current = (
+        db.query(KegStateDwell.state, KegStateDwell.started_at)
+        .filter(KegStateDwell.keg_id == keg_id, KegStateDwell.ended_at.is_(None))
+        .order_by(KegStateDwell.started_at.desc())
+        .first()
+    )
+    summary["current_state"] = current.state.value if current else None
+    summary["current_since"] = current.started_at if current else None
+    return summary
+
+def idle_kegs(db, brewery_id: str, days: int, limit: int = 500):
+    # Barriles cuyo estado actual empezó hace más de `days` días
+    threshold = datetime.utcnow() - timedelta(days=days)
+    rows = (
+        db.query(Keg.id, Keg.name, KegStateDwell.state, KegStateDwell.started_at)
+        .join(Keg, Keg.id == KegStateDwell.keg_id)
+        .filter(
+            KegStateDwell.brewery_id == brewery_id,
+            KegStateDwell.ended_at.is_(None),
+            KegStateDwell.started_at < threshold,
+        )
+        .order_by(KegStateDwell.started_at)
+        .limit(limit)
+        .all()
+    )
+    now = datetime.utcnow()
+    return [
+        {
+            "keg_id": r.id,
+            "name": r.name,
+            "state": r.state.value,
+            "since": r.started_at,
+            "idle_seconds": int((now - r.started_at).total_seconds()),
+        } for r in rows
+    ]
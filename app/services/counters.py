@@ -0,0 +1,21 @@
+from sqlalchemy import select, update
+from app.db.models import ChangeCounter
+
+# Contadores de cambios (tabla change_counters). "kegs" lo gestiona app/services/keg_changes.py;
+# "breweries" y "users" solo sirven para validar cachés (ETag) de los listados.
+BREWERIES_COUNTER = "breweries"
+USERS_COUNTER = "users"
+
+def counter_value(db, name: str) -> int:
+    value = db.query(ChangeCounter.value).filter(ChangeCounter.name == name).scalar()
+    return value or 0
+
+def counter_column(name: str):
+    # Subconsulta escalar para leer el contador en la misma consulta que los datos
+    return select(ChangeCounter.value).where(ChangeCounter.name == name).scalar_subquery().label(f"{name}_counter")
+
+def touch_counter(db, name: str):
+    # Llamar en la transacción de cada escritura, antes del commit
+    result = db.execute(update(ChangeCounter).where(ChangeCounter.name == name).values(value=ChangeCounter.value + 1))
+    if result.rowcount == 0:
+        db.add(ChangeCounter(name=name, value=1))
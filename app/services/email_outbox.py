@@ -0,0 +1,269 @@
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+import aiosmtplib
+from sqlalchemy import and_, insert, or_
+from starlette.concurrency import run_in_threadpool
+from app.core.config import get_settings
+from app.db.database import SessionLocal
+from app.db.models import EmailOutbox
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# Un envío en estado "sending" sin actividad durante más de esto se considera abandonado (worker caído) y se
+# reintenta. El worker renueva claimed_at tras cada mensaje, así que basta con que supere un envío.
+CLAIM_TIMEOUT = timedelta(minutes=5)
+# Segundos sin trabajo tras los que se cierra la conexión SMTP
+SMTP_IDLE_TIMEOUT = 60
+OUTBOX_PURGE_INTERVAL = 3600
+
+_last_purge = 0.0
+_purge_lock = threading.Lock()
+
+def send_timeout() -> float:
+    # Límite por mensaje: conexión y envío, más un reintento con conexión nueva
+    return 4 * settings.SMTP_TIMEOUT
+
+def claim_timeout() -> timedelta:
+    return max(CLAIM_TIMEOUT, timedelta(seconds=2 * send_timeout()))
+
+def enqueue(to: str, subject: str, body: str) -> int:
+    db = SessionLocal()
+    try:
+        message = EmailOutbox(to_address=to, subject=subject, body=body, status="pending", next_attempt_at=datetime.utcnow())
+        db.add(message)
+        db.commit()
+        return message.id
+    finally:
+        db.close()
+
+def enqueue_many(messages) -> int:
+    # messages: lista de (destinatario, asunto, cuerpo); un único INSERT multi-fila
+    now = datetime.utcnow()
+    rows = [
+        {"to_address": to, "subject": subject, "body": body, "status": "pending", "attempts": 0, "next_attempt_at": now, "created_at": now}
+        for to, subject, body in messages
+    ]
+    if not rows:
+        return 0
+    db = SessionLocal()
+    try:
+        db.execute(insert(EmailOutbox), rows)
+        db.commit()
+        return len(rows)
+    finally:
+        db.close()
+
+def _claimable(now):
+    return or_(
+        and_(EmailOutbox.status == "pending", EmailOutbox.next_attempt_at <= now),
+        and_(EmailOutbox.status == "sending", EmailOutbox.claimed_at < now - claim_timeout()),
+    )
+
+def claim_batch(limit: int):
+    # Marca un lote con un id de reclamo propio: con varios workers cada mensaje lo envía uno solo
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        ids = [row.id for row in db.query(EmailOutbox.id).filter(_claimable(now)).order_by(EmailOutbox.id).limit(limit)]
+        if not ids:
+            return []
+        claim = str(uuid.uuid4())
+        db.query(EmailOutbox).filter(EmailOutbox.id.in_(ids), _claimable(now)).update(
+            {"status": "sending", "claimed_by": claim, "claimed_at": now}, synchronize_session=False
+        )
+        db.commit()
+        rows = db.query(
+            EmailOutbox.id, EmailOutbox.to_address, EmailOutbox.subject, EmailOutbox.body, EmailOutbox.attempts, EmailOutbox.claimed_by
+        ).filter(
+            EmailOutbox.claimed_by == claim
+        ).all()
+        return [row._asdict() for row in rows]
+    finally:
+        db.close()
+
+def backoff(attempts: int) -> timedelta:
+    return timedelta(seconds=min(settings.EMAIL_RETRY_BASE_SECONDS * 2 ** (attempts - 1), settings.EMAIL_RETRY_MAX_SECONDS))
+
+def renew_claim(claim: str):
+    # Latido tras cada mensaje: el lote no se da por abandonado mientras avanza
+    db = SessionLocal()
+    try:
+        db.query(EmailOutbox).filter(EmailOutbox.claimed_by == claim, EmailOutbox.status == "sending").update(
+            {"claimed_at": datetime.utcnow()}, synchronize_session=False
+        )
+        db.commit()
+    finally:
+        db.close()
+
+def purge_delivered(db) -> int:
+    # Los enviados y descartados guardan el cuerpo completo (enlaces de recuperación de contraseña incluidos)
+    cutoff = datetime.utcnow() - timedelta(days=settings.EMAIL_RETENTION_DAYS)
+    return db.query(EmailOutbox).filter(
+        or_(
+            and_(EmailOutbox.status == "sent", EmailOutbox.sent_at < cutoff),
+            and_(EmailOutbox.status == "failed", EmailOutbox.created_at < cutoff),
+        )
+    ).delete(synchronize_session=False)
+
+def _maybe_purge(db):
+    global _last_purge
+    now = time.monotonic()
+    with _purge_lock:
+        if now - _last_purge < OUTBOX_PURGE_INTERVAL:
+            return
+        _last_purge = now
+    purge_delivered(db)
+
+def record_results(claim: str, sent_ids, failures):
+    # failures: lista de (mensaje, error). Solo filas que siguen reclamadas por este worker:
+    # si otro reclamó el lote, su resultado es el que vale
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        if sent_ids:
+            db.query(EmailOutbox).filter(EmailOutbox.id.in_(sent_ids), EmailOutbox.claimed_by == claim).update(
+                {"status": "sent", "sent_at": now, "claimed_by": None}, synchronize_session=False
+            )
+        for message, error in failures:
+            attempts = message["attempts"] + 1
+            values = {"attempts": attempts, "last_error": str(error)[:1000], "claimed_by": None}
+            if attempts >= settings.EMAIL_MAX_ATTEMPTS:
+                values["status"] = "failed"
+                logger.error("Email %s a %s descartado tras %s intentos: %s", message["id"], message["to_address"], attempts, error)
+            else:
+                values.update(status="pending", next_attempt_at=now + backoff(attempts))
+            db.query(EmailOutbox).filter(EmailOutbox.id == message["id"], EmailOutbox.claimed_by == claim).update(
+                values, synchronize_session=False
+            )
+        _maybe_purge(db)
+        db.commit()
+    finally:
+        db.close()
+
+def build_message(message) -> EmailMessage:
+    email = EmailMessage()
+    email["From"] = settings.SMTP_FROM or settings.SMTP_USER
+    email["To"] = message["to_address"]
+    email["Subject"] = message["subject"]
+    email.set_content(message["body"], subtype="html")
+    return email
+
+class OutboxWorker:
+    # Vacía el outbox en segundo plano reutilizando una única conexión SMTP autenticada
+    def __init__(self):
+        self.smtp = None
+        self.last_used = 0.0
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    async def connect(self):
+        if self.smtp is not None and self.smtp.is_connected:
+            return self.smtp
+        self.smtp = aiosmtplib.SMTP(
+            hostname=settings.SMTP_HOST,
+            port=settings.SMTP_PORT,
+            username=settings.SMTP_USER or None,
+            password=settings.SMTP_PASS or None,
+            use_tls=settings.SMTP_USE_TLS,
+            start_tls=settings.SMTP_STARTTLS and not settings.SMTP_USE_TLS,
+            timeout=settings.SMTP_TIMEOUT,
+        )
+        await self.smtp.connect()
+        return self.smtp
+
+    async def disconnect(self):
+        if self.smtp is not None and self.smtp.is_connected:
+            try:
+                await self.smtp.quit()
+            except aiosmtplib.SMTPException:
+                self.smtp.close()
+        self.smtp = None
+
+    async def send(self, message):
+        try:
+            smtp = await self.connect()
+            await smtp.send_message(build_message(message))
+        except aiosmtplib.SMTPServerDisconnected:
+            # El servidor cerró la conexión reutilizada: un reintento con conexión nueva
+            self.smtp = None
+            smtp = await self.connect()
+            await smtp.send_message(build_message(message))
+        self.last_used = time.monotonic()
+
+    async def run_once(self) -> int:
+        batch = await run_in_threadpool(claim_batch, settings.EMAIL_BATCH_SIZE)
+        if not batch:
+            return 0
+        claim = batch[0]["claimed_by"]
+        sent, failures = [], []
+        for message in batch:
+            try:
+                await asyncio.wait_for(self.send(message), send_timeout())
+                sent.append(message["id"])
+            except (aiosmtplib.SMTPException, OSError, asyncio.TimeoutError) as error:
+                failures.append((message, error))
+                if isinstance(error, (aiosmtplib.SMTPConnectError, aiosmtplib.SMTPServerDisconnected, OSError, asyncio.TimeoutError)):
+                    # Servidor inaccesible: el resto del lote se reintenta más tarde
+                    await self.disconnect()
+                    failures.extend((m, error) for m in batch[len(sent) + len(failures):])
+                    break
+            if len(sent) + len(failures) < len(batch):
+                await run_in_threadpool(renew_claim, claim)
+        await run_in_threadpool(record_results, claim, sent, failures)
+        return len(sent)
+
+    async def run(self):
+        while True:
+            try:
+                if await self.run_once():
+                    continue
+            except Exception:
+                logger.exception("Error procesando el outbox de emails")
+            if self.smtp is not None and time.monotonic() - self.last_used > SMTP_IDLE_TIMEOUT:
+                await self.disconnect()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), settings.EMAIL_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    def notify(self):
+        self.wakeup.set()
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.disconnect()
+
+worker = None
+
+async def start_worker():
+    global worker
+    if settings.EMAIL_WORKER_ENABLED and worker is None:
+        worker = OutboxWorker()
+        worker.start()
+
+async def stop_worker():
+    global worker
+    if worker is not None:
+        await worker.stop()
+        worker = None
+
+def notify_worker():
+    # Despierta al worker de este proceso; los de otros procesos lo verán en su siguiente sondeo
+    if worker is not None:
+        worker.notify()
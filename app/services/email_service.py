@@ -1,37 +1,60 @@
-import aiosmtplib
-from email.message import EmailMessage
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from starlette.concurrency import run_in_threadpool
 from app.core.config import get_settings
+from app.services.email_outbox import enqueue, enqueue_many, notify_worker
+import logging
 import os
 
+logger = logging.getLogger(__name__)
 settings = get_settings()
-FROM_ADDRESS = getattr(settings, 'SMTP_FROM', settings.SMTP_USER)
 TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), '../email/templates')
-env = Environment(loader=FileSystemLoader(TEMPLATES_DIR))
+PRELOAD_TEMPLATES = ("register_user.html", "reset_password.html")
+
+def create_environment(templates_dir: str = TEMPLATES_DIR, cache_dir: str = None) -> Environment:
+    # Sin auto_reload: cada plantilla se compila una vez por proceso y no se vuelve a hacer stat() en cada envío.
+    # El bytecode en disco evita recompilar al arrancar otros workers o tras un reinicio.
+    # Sin directorio configurado, el de Jinja por usuario: comprueba que sea nuestro y 0700 antes de cargar
+    # bytecode (se carga con marshal; un directorio compartido en /tmp permitiría inyectar código)
+    cache_dir = cache_dir or settings.EMAIL_TEMPLATE_CACHE_DIR
+    if cache_dir:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    return Environment(
+        loader=FileSystemLoader(templates_dir),
+        bytecode_cache=FileSystemBytecodeCache(cache_dir or None),
+        auto_reload=False,
+        cache_size=100,
+    )
+
+env = create_environment()
+
+def preload_templates():
+    for template_name in PRELOAD_TEMPLATES:
+        env.get_template(template_name)
 
 def render_template(template_name: str, context: dict) -> str:
     template = env.get_template(template_name)
     return template.render(**context)
 
+def render_many(template_name: str, contexts) -> list:
+    # Una sola búsqueda de plantilla para todos los destinatarios
+    template = env.get_template(template_name)
+    return [template.render(**context) for context in contexts]
+
 async def send_email(to: str, subject: str, template_name: str, context: dict):
+    # Encola en el outbox y vuelve enseguida: el envío SMTP lo hace el worker en segundo plano
     content = render_template(template_name, context)
-    message = EmailMessage()
-    message["From"] = FROM_ADDRESS
-    message["To"] = to
-    message["Subject"] = subject
-    message.set_content(content, subtype="html")
-    print('SMTP_HOST:', settings.SMTP_HOST)
-    print('SMTP_PORT:', settings.SMTP_PORT)
-    print('SMTP_USER:', settings.SMTP_USER)
-    print('SMTP_FROM:', settings.SMTP_FROM)
-    await aiosmtplib.send(
-        message,
-        hostname=settings.SMTP_HOST,
-        port=settings.SMTP_PORT,
-        username=settings.SMTP_USER,
-        password=settings.SMTP_PASS,
-        start_tls=True,
-    )
+    message_id = await run_in_threadpool(enqueue, to, subject, content)
+    logger.debug("Email %s a %s encolado (%s)", message_id, to, template_name)
+    notify_worker()
+    return message_id
+
+async def send_bulk_email(subject: str, template_name: str, recipients):
+    # recipients: lista de (email, contexto); p. ej. avisar a todos los usuarios de una cervecería
+    recipients = list(recipients)
+    bodies = await run_in_threadpool(render_many, template_name, [context for _, context in recipients])
+    count = await run_in_threadpool(enqueue_many, [(to, subject, body) for (to, _), body in zip(recipients, bodies)])
+    notify_worker()
+    return count
 
 async def send_invite_email(to: str, invite_link: str):
     await send_email(
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import threading
+import time
+from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
+from app.core.config import get_settings
+from app.db.database import SessionLocal
+from app.services.counters import counter_value
+from app.services.keg_changes import KEGS_COUNTER, changes_since
+
+# Los eventos salen del feed de cambios compartido (changes_since), no de memoria del proceso: el id de cada
+# evento es la versión del cambio, así que un Last-Event-ID vale en cualquier worker y tras un reinicio.
+# Milisegundos que espera EventSource antes de reconectar
+RETRY_MS = 3000
+
+def frame(kind: str, data, version: int = None) -> str:
+    lines = [f"id: {version}"] if version is not None else []
+    lines += [f"event: {kind}", f"data: {json.dumps(data, separators=(',', ':'))}"]
+    return "\n".join(lines) + "\n\n"
+
+def parse_event_id(value: str):
+    value = (value or "").strip()
+    return int(value) if value.isdigit() else None
+
+class ChangeNotifier:
+    # Despierta los streams de este proceso tras una escritura local; los cambios de otros workers llegan
+    # en el siguiente sondeo (EVENTS_POLL_INTERVAL). También cachea la versión actual del contador "kegs"
+    # para que los streams abiertos no la lean cada uno por su cuenta.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = set()
+        self.version = None
+        self.read_at = 0.0
+        self.polls = 0
+
+    def notify(self):
+        with self.lock:
+            self.version = None
+            waiters = list(self.waiters)
+        for waiter in waiters:
+            loop, wakeup = waiter
+            try:
+                loop.call_soon_threadsafe(wakeup.set)
+            except RuntimeError:
+                # Loop cerrado
+                self.unsubscribe(waiter)
+
+    def subscribe(self):
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self.lock:
+            self.waiters.add(waiter)
+        return waiter
+
+    def unsubscribe(self, waiter):
+        with self.lock:
+            self.waiters.discard(waiter)
+
+    def current_version(self, max_age: float) -> int:
+        # Se ejecuta en el threadpool; como mucho una lectura del contador por max_age en todo el proceso
+        with self.lock:
+            if self.version is not None and time.monotonic() - self.read_at < max_age:
+                return self.version
+            db = SessionLocal()
+            try:
+                self.version = counter_value(db, KEGS_COUNTER)
+            finally:
+                db.close()
+            self.read_at = time.monotonic()
+            self.polls += 1
+            return self.version
+
+    def stats(self):
+        with self.lock:
+            return {"subscribers": len(self.waiters), "polls": self.polls}
+
+notifier = ChangeNotifier()
+
+def notify():
+    notifier.notify()
+
+def read_changes(keg_query, since: int, brewery_id):
+    # Devuelve (tramas, versión alcanzada, hay más) con una sesión propia y cerrada al momento:
+    # el stream no ocupa una conexión del pool mientras espera
+    db = SessionLocal()
+    try:
+        upserts, deleted, reached, has_more, reset = changes_since(db, keg_query(db), since, brewery_id, get_settings().EVENTS_BATCH_SIZE)
+    finally:
+        db.close()
+    if reset:
+        # Last-Event-ID de otra base de datos o anterior a las tombstones purgadas: recargar el listado
+        return [frame("reset", {}, reached)], reached, False
+    events = [(row.version, "upsert", jsonable_encoder(dict(row._mapping))) for row in upserts]
+    events += [(row["version"], "deleted", {"id": row["id"]}) for row in deleted]
+    frames = []
+    for version, kind, data in sorted(events, key=lambda event: event[0]):
+        data.update(type=kind, brewery_id=data.get("brewery_id", brewery_id))
+        frames.append(frame(kind, data, version))
+    return frames, reached, has_more
+
+async def stream(keg_query, brewery_id, last_event_id: str = None):
+    # keg_query(db): consulta de barriles con las columnas de KegOut (la de GET /api/kegs/changes)
+    waiter = notifier.subscribe()
+    loop, wakeup = waiter
+    try:
+        since = parse_event_id(last_event_id)
+        unknown_id = since is None and bool(last_event_id)
+        if since is None:
+            # Sin Last-Event-ID (o con uno que no es una versión) se empieza por los cambios a partir de ahora,
+            # leído antes del primer yield para no perder lo que se confirme mientras el cliente conecta
+            since = await run_in_threadpool(notifier.current_version, 0)
+        yield f"retry: {RETRY_MS}\n\n"
+        if unknown_id:
+            yield frame("reset", {}, since)
+        last_sent = loop.time()
+        while True:
+            settings = get_settings()
+            current = await run_in_threadpool(notifier.current_version, settings.EVENTS_POLL_INTERVAL)
+            if current != since:
+                frames, since, has_more = await run_in_threadpool(read_changes, keg_query, since, brewery_id)
+                for event in frames:
+                    yield event
+                if frames:
+                    last_sent = loop.time()
+                if has_more:
+                    continue
+            if loop.time() - last_sent >= settings.EVENTS_KEEPALIVE_SECONDS:
+                # Comentario SSE: mantiene abierta la conexión a través de proxies
+                yield ": keepalive\n\n"
+                last_sent = loop.time()
+            try:
+                await asyncio.wait_for(wakeup.wait(), settings.EVENTS_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+    finally:
+        notifier.unsubscribe(waiter)
@@ -0,0 +1,114 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import exists, func, select, update
+from app.core.config import get_settings
+from app.db.models import ChangeCounter, Keg, KegTombstone
+from app.services.counters import counter_column, counter_value
+
+settings = get_settings()
+
+KEGS_COUNTER = "kegs"
+# Versión más alta de las tombstones purgadas: un cliente con since anterior tiene que resincronizar entero
+TOMBSTONES_PURGED_COUNTER = "keg_tombstones_purged"
+TOMBSTONE_PURGE_INTERVAL = 3600
+
+_last_purge = 0.0
+_purge_lock = threading.Lock()
+
+def next_versions(db, count: int = 1) -> int:
+    # Reserva count versiones consecutivas en la transacción del llamador y devuelve la primera.
+    # El UPDATE bloquea la fila del contador hasta el commit, así que las versiones se confirman en orden
+    # y un cliente que ya leyó hasta la versión N no puede perder cambios con versión <= N.
+    statement = update(ChangeCounter).where(ChangeCounter.name == KEGS_COUNTER).values(value=ChangeCounter.value + count)
+    if db.get_bind().dialect.update_returning:
+        # SQLite >= 3.35: una sola sentencia
+        value = db.execute(statement.returning(ChangeCounter.value)).scalar()
+    else:
+        value = counter_value(db, KEGS_COUNTER) if db.execute(statement).rowcount else None
+    if value is None:
+        db.add(ChangeCounter(name=KEGS_COUNTER, value=count))
+        db.flush()
+        value = count
+    return value - count + 1
+
+def add_tombstones(db, kegs):
+    # kegs: lista de (keg_id, brewery_id) eliminados o que salen de esa cervecería
+    if not kegs:
+        return
+    first = next_versions(db, len(kegs))
+    now = datetime.utcnow()
+    db.add_all(
+        KegTombstone(keg_id=keg_id, brewery_id=brewery_id, version=first + i, deleted_at=now)
+        for i, (keg_id, brewery_id) in enumerate(kegs)
+    )
+    _maybe_purge(db)
+
+def purge_tombstones(db) -> int:
+    cutoff = datetime.utcnow() - timedelta(days=settings.KEG_TOMBSTONE_DAYS)
+    purged_version = db.query(KegTombstone.version).filter(KegTombstone.deleted_at < cutoff).order_by(KegTombstone.version.desc()).limit(1).scalar()
+    if purged_version is None:
+        return 0
+    result = db.execute(
+        update(ChangeCounter).where(ChangeCounter.name == TOMBSTONES_PURGED_COUNTER).values(value=purged_version)
+    )
+    if result.rowcount == 0:
+        db.add(ChangeCounter(name=TOMBSTONES_PURGED_COUNTER, value=purged_version))
+    return db.query(KegTombstone).filter(KegTombstone.version <= purged_version).delete(synchronize_session=False)
+
+def _maybe_purge(db):
+    global _last_purge
+    now = time.monotonic()
+    with _purge_lock:
+        if now - _last_purge < TOMBSTONE_PURGE_INTERVAL:
+            return
+        _last_purge = now
+    purge_tombstones(db)
+
+def list_version_columns(brewery_id: str = None):
+    # Lo que determina el contenido de un listado de barriles: con brewery_id, la versión más alta de sus
+    # barriles y tombstones (índices por cervecería y versión); sin él, el contador global
+    if brewery_id:
+        return (
+            select(func.max(Keg.version)).where(Keg.brewery_id == brewery_id).scalar_subquery(),
+            select(func.max(KegTombstone.version)).where(KegTombstone.brewery_id == brewery_id).scalar_subquery(),
+            counter_column(TOMBSTONES_PURGED_COUNTER),
+        )
+    return (counter_column(KEGS_COUNTER),)
+
+def changes_since(db, keg_query, since: int, brewery_id: str = None, limit: int = 1000):
+    # Cambios con versión > since, en orden de versión. Devuelve (upserts, deleted, versión alcanzada, hay más, reset).
+    # El contador se lee primero: lo que se confirme después queda para la siguiente llamada.
+    current = counter_value(db, KEGS_COUNTER)
+    reset = since > 0 and since < counter_value(db, TOMBSTONES_PURGED_COUNTER)
+    if reset or since > current:
+        # Tombstones ya purgadas o versión desconocida (otra base de datos): resincronización completa
+        reset, since = True, 0
+    query = keg_query.filter(Keg.version > since, Keg.version <= current)
+    if brewery_id:
+        query = query.filter(Keg.brewery_id == brewery_id)
+    upserts = query.order_by(Keg.version).limit(limit + 1).all()
+    # Una tombstone deja de valer si el barril existe (de nuevo) en el ámbito consultado
+    alive = exists().where(Keg.id == KegTombstone.keg_id)
+    if brewery_id:
+        alive = alive.where(Keg.brewery_id == brewery_id)
+    deleted = []
+    if since > 0:
+        tombstones = db.query(KegTombstone.keg_id, KegTombstone.version).filter(
+            KegTombstone.version > since, KegTombstone.version <= current, ~alive
+        )
+        if brewery_id:
+            tombstones = tombstones.filter(KegTombstone.brewery_id == brewery_id)
+        deleted = tombstones.order_by(KegTombstone.version).limit(limit + 1).all()
+    # Mezcla por versión de las dos listas; las versiones son únicas entre ambas
+    merged = sorted([(row.version, "upsert", row) for row in upserts] + [(row.version, "deleted", row) for row in deleted], key=lambda item: item[0])
+    has_more = len(merged) > limit
+    merged = merged[:limit]
+    reached = merged[-1][0] if has_more else current
+    return (
+        [row for _, kind, row in merged if kind == "upsert"],
+        [{"id": row.keg_id, "version": row.version} for _, kind, row in merged if kind == "deleted"],
+        reached,
+        has_more,
+        reset,
+    )
@@ -0,0 +1,76 @@
+import csv
+import io
+import json
+
+IMPORT_FORMATS = ("csv", "ndjson")
+
+def detect_format(filename: str, content_type: str, requested: str = None) -> str:
+    if requested:
+        return requested
+    name = (filename or "").lower()
+    if name.endswith((".ndjson", ".jsonl")) or "ndjson" in (content_type or ""):
+        return "ndjson"
+    return "csv"
+
+def iter_import_rows(fileobj, fmt: str):
+    # Genera (número de línea, fila, error) leyendo el fichero de forma incremental
+    text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+    try:
+        if fmt == "csv":
+            reader = csv.DictReader(text)
+            for row in reader:
+                # Celdas vacías -> ausentes, para que apliquen los valores por defecto
+                yield reader.line_num, {k: v for k, v in row.items() if k and v not in ("", None)}, None
+        else:
+            for line_num, line in enumerate(text, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError as e:
+                    yield line_num, None, f"Invalid JSON: {e}"
+                    continue
+                if not isinstance(row, dict):
+                    yield line_num, None, "Expected a JSON object"
+                    continue
+                yield line_num, row, None
+    finally:
+        # No cerrar el fichero subyacente, es de UploadFile
+        text.detach()
+
+def format_validation_error(exc) -> str:
+    return "; ".join(
+        f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" for err in exc.errors()
+    )
+
+EXPORT_MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+# Tamaño aproximado de cada trozo enviado al cliente
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+def _plain(value):
+    if hasattr(value, "value"):
+        return value.value
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+def serialize_rows(rows, columns, fmt: str):
+    # Convierte un iterable de filas en trozos de texto CSV/NDJSON sin acumular el resultado
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == "csv" else None
+    if writer:
+        writer.writerow(columns)
+    for row in rows:
+        values = [_plain(getattr(row, column)) for column in columns]
+        if writer:
+            writer.writerow(values)
+        else:
+            buffer.write(json.dumps(dict(zip(columns, values)), ensure_ascii=False))
+            buffer.write("\n")
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,207 @@
+import asyncio
+import heapq
+import re
+import threading
+import unicodedata
+from collections import Counter
+from concurrent.futures import Future
+from sqlalchemy import bindparam, column, func, literal_column, or_, select, table, text
+from starlette.concurrency import run_in_threadpool
+from app.core.cache import TTLCache
+from app.core.config import get_settings
+from app.db.database import SessionLocal
+from app.db.models import Keg
+
+settings = get_settings()
+
+# Índices de trigramas en memoria por cervecería (None: todas), para búsquedas tolerantes a erratas
+trigram_cache = TTLCache(maxsize=64, ttl=settings.KEG_SEARCH_INDEX_TTL)
+# Campos indexados: solo un cambio en ellos (o un barril nuevo o eliminado) invalida los índices
+SEARCH_FIELDS = ("name", "beer_type", "location")
+
+kegs_fts = table("kegs_fts", column("rowid"))
+# Contenido de kegs_fts, enlazado con kegs por keg_id (el rowid implícito de kegs puede cambiar con VACUUM)
+kegs_search = table("kegs_search", column("rowid"), column("keg_id"), column("brewery_id"))
+MYSQL_MATCH = "MATCH (kegs.name, kegs.beer_type, kegs.location) AGAINST (:search_terms IN BOOLEAN MODE)"
+# Peso de cada columna de kegs_fts en bm25: nombre > tipo de cerveza > ubicación
+BM25_WEIGHTS = (10.0, 5.0, 1.0)
+# Coincidencias (las más recientes) que se puntúan con bm25: puntuar todas las de un término muy común
+# ("ipa" en una flota de 100k) cuesta decenas de ms
+FTS_RANK_CANDIDATES = 1000
+# Fracción mínima de trigramas de la consulta que debe contener un barril en la búsqueda difusa
+MIN_TRIGRAM_MATCH = 0.5
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+def normalize(value: str) -> str:
+    value = unicodedata.normalize("NFKD", value or "")
+    return "".join(c for c in value if not unicodedata.combining(c)).lower()
+
+def terms(q: str):
+    return _WORD.findall(normalize(q))
+
+def _fts_query(words) -> str:
+    # Todos los términos obligatorios; solo la última palabra (la que se está escribiendo) como prefijo:
+    # "porter bar" -> "porter" "bar"*
+    return " ".join([f'"{word}"' for word in words[:-1]] + [f'"{words[-1]}"*'])
+
+def _fulltext_query(words) -> str:
+    return " ".join([f"+{word}" for word in words[:-1]] + [f"+{words[-1]}*"])
+
+_fts_ready = set()
+
+def _has_fts(db) -> bool:
+    bind = db.get_bind()
+    key = str(bind.url)
+    if key not in _fts_ready:
+        if db.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'kegs_search'")).first() is None:
+            return False
+        _fts_ready.add(key)
+    return True
+
+def search(db, keg_query, q: str, brewery_id: str = None, limit: int = 20):
+    # Búsqueda por índice de texto con ranking (prefijo de palabra); en otros motores, LIKE por subcadena
+    words = terms(q)
+    if not words:
+        return []
+    dialect = db.get_bind().dialect.name
+    query = keg_query
+    if dialect == "sqlite" and _has_fts(db):
+        # bm25 solo sobre las FTS_RANK_CANDIDATES coincidencias más recientes de la cervecería
+        candidates = select(
+            kegs_search.c.keg_id, func.bm25(literal_column("kegs_fts"), *BM25_WEIGHTS).label("score")
+        ).select_from(kegs_fts.join(kegs_search, kegs_search.c.rowid == kegs_fts.c.rowid)).where(
+            literal_column("kegs_fts").op("MATCH")(_fts_query(words))
+        )
+        if brewery_id:
+            candidates = candidates.where(kegs_search.c.brewery_id == brewery_id)
+        candidates = candidates.order_by(kegs_fts.c.rowid.desc()).limit(FTS_RANK_CANDIDATES).subquery("candidates")
+        # La cervecería ya está filtrada en los candidatos: sin filtro sobre kegs, la consulta parte de ellos
+        return query.join(candidates, candidates.c.keg_id == Keg.id).order_by(candidates.c.score).limit(limit).all()
+    if dialect == "mysql":
+        # Índice FULLTEXT ft_kegs_search; el mismo parámetro para el filtro y la puntuación
+        search_terms = bindparam("search_terms", _fulltext_query(words))
+        query = query.filter(text(MYSQL_MATCH).bindparams(search_terms)).order_by(text(f"{MYSQL_MATCH} DESC").bindparams(search_terms))
+    else:
+        for word in words:
+            pattern = f"%{word}%"
+            query = query.filter(or_(Keg.name.ilike(pattern), Keg.beer_type.ilike(pattern), Keg.location.ilike(pattern)))
+        query = query.order_by(Keg.name)
+    if brewery_id:
+        query = query.filter(Keg.brewery_id == brewery_id)
+    return query.limit(limit).all()
+
+def trigrams(value: str):
+    padded = f"  {value} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class TrigramIndex:
+    def __init__(self, rows):
+        self.ids = []
+        self.sizes = []
+        self.postings = {}
+        for position, row in enumerate(rows):
+            grams = set()
+            for field in (row.name, row.beer_type, row.location):
+                for word in terms(field or ""):
+                    grams |= trigrams(word)
+            self.ids.append(row.id)
+            self.sizes.append(len(grams))
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(position)
+
+    def search(self, q: str, limit: int):
+        grams = set()
+        for word in terms(q):
+            grams |= trigrams(word)
+        if not grams:
+            return []
+        counts = Counter()
+        for gram in grams:
+            postings = self.postings.get(gram)
+            if postings:
+                counts.update(postings)
+        threshold = len(grams) * MIN_TRIGRAM_MATCH
+        # Más trigramas en común primero; a igualdad, el texto más corto (más parecido)
+        ranked = heapq.nsmallest(limit, ((-count, self.sizes[position], position) for position, count in counts.items() if count >= threshold))
+        return [self.ids[position] for _, _, position in ranked]
+
+# Construcción en curso por cervecería (single-flight): las búsquedas concurrentes esperan el mismo Future.
+# _builds_lock solo protege los diccionarios; nunca se mantiene mientras se leen barriles
+_builds = {}
+_builds_lock = threading.Lock()
+# Se incrementa al invalidar: un índice construido con datos anteriores no se guarda en la cache
+_generations = {}
+
+def _claim_build(brewery_id):
+    # Devuelve (future, generación); generación None si otro llamador ya está construyendo el índice
+    with _builds_lock:
+        future = _builds.get(brewery_id)
+        if future is not None:
+            return future, None
+        future = _builds[brewery_id] = Future()
+        return future, _generations.get(brewery_id, 0)
+
+def _build(db, brewery_id, future, generation) -> TrigramIndex:
+    try:
+        query = db.query(Keg.id, Keg.name, Keg.beer_type, Keg.location)
+        if brewery_id:
+            query = query.filter(Keg.brewery_id == brewery_id)
+        index = TrigramIndex(query.yield_per(5000))
+    except BaseException as error:
+        with _builds_lock:
+            if _builds.get(brewery_id) is future:
+                del _builds[brewery_id]
+        future.set_exception(error)
+        raise
+    with _builds_lock:
+        if _builds.get(brewery_id) is future:
+            del _builds[brewery_id]
+        if _generations.get(brewery_id, 0) == generation:
+            trigram_cache.set(brewery_id, index)
+    future.set_result(index)
+    return index
+
+def _build_in_session(brewery_id, future, generation) -> TrigramIndex:
+    db = SessionLocal()
+    try:
+        return _build(db, brewery_id, future, generation)
+    finally:
+        db.close()
+
+def trigram_index(db, brewery_id: str = None) -> TrigramIndex:
+    # Para código síncrono en un hilo (scripts, benchmarks): espera bloqueando a la construcción en curso
+    index = trigram_cache.get(brewery_id)
+    if index is not None:
+        return index
+    future, generation = _claim_build(brewery_id)
+    if generation is None:
+        return future.result()
+    return _build(db, brewery_id, future, generation)
+
+async def trigram_index_async(brewery_id: str = None) -> TrigramIndex:
+    # Desde el event loop (también con DB_ASYNC, donde el handler corre en el hilo del loop): la construcción
+    # va al threadpool con su propia sesión y el resto de búsquedas esperan el Future sin bloquear el loop
+    index = trigram_cache.get(brewery_id)
+    if index is not None:
+        return index
+    future, generation = _claim_build(brewery_id)
+    if generation is None:
+        return await asyncio.wrap_future(future)
+    return await run_in_threadpool(_build_in_session, brewery_id, future, generation)
+
+def fuzzy_search(db, keg_query, q: str, brewery_id: str = None, limit: int = 20, index: TrigramIndex = None):
+    ids = (index or trigram_index(db, brewery_id)).search(q, limit)
+    if not ids:
+        return []
+    rows = {row.id: row for row in keg_query.filter(Keg.id.in_(ids))}
+    return [rows[keg_id] for keg_id in ids if keg_id in rows]
+
+def invalidate(brewery_ids):
+    # Tras crear o eliminar barriles o cambiar SEARCH_FIELDS (after_kegs_write con search_changed).
+    # Una construcción en curso deja de compartirse: la siguiente búsqueda lee los datos nuevos
+    with _builds_lock:
+        for brewery_id in set(brewery_ids) | {None}:
+            _generations[brewery_id] = _generations.get(brewery_id, 0) + 1
+            _builds.pop(brewery_id, None)
+            trigram_cache.invalidate(brewery_id)
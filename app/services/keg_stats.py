@@ -0,0 +1,66 @@
+from sqlalchemy import func
+from app.core.cache import TTLCache
+from app.core.config import get_settings
+from app.db.models import Keg, KegState, Brewery
+
+settings = get_settings()
+
+# Clave: brewery_id, o None para el resumen de todas las cervecerías
+stats_cache = TTLCache(maxsize=1024, ttl=settings.KEG_STATS_TTL)
+
+def invalidate_stats(brewery_ids):
+    for brewery_id in set(brewery_ids):
+        stats_cache.invalidate(brewery_id)
+    stats_cache.invalidate(None)
+
+def _breakdown(db, column, brewery_id):
+    query = db.query(
+        Keg.brewery_id,
+        column,
+        func.count(Keg.id),
+        func.coalesce(func.sum(Keg.current_content), 0),
+    ).group_by(Keg.brewery_id, column)
+    if brewery_id:
+        query = query.filter(Keg.brewery_id == brewery_id)
+    return query.all()
+
+def compute_stats(db, brewery_id: str = None):
+    # Todo se agrega en SQL: tres consultas GROUP BY, independientes del tamaño de la flota
+    query = db.query(
+        Keg.brewery_id,
+        Brewery.name,
+        Keg.state,
+        func.count(Keg.id),
+        func.coalesce(func.sum(Keg.current_content), 0),
+        func.coalesce(func.sum(Keg.capacity), 0),
+    ).join(Brewery, Keg.brewery_id == Brewery.id).group_by(Keg.brewery_id, Brewery.name, Keg.state)
+    if brewery_id:
+        query = query.filter(Keg.brewery_id == brewery_id)
+    result = {}
+    for b_id, b_name, state, count, content, capacity in query.all():
+        entry = result.setdefault(b_id, {
+            "brewery_id": b_id,
+            "brewery_name": b_name,
+            "total": 0,
+            "by_state": {s.value: 0 for s in KegState},
+            "current_content": 0,
+            "capacity": 0,
+            "by_beer_type": [],
+            "by_location": [],
+        })
+        entry["total"] += count
+        entry["by_state"][state.value if state else "unknown"] = count
+        entry["current_content"] += int(content)
+        entry["capacity"] += int(capacity)
+    for column, key, name in ((Keg.beer_type, "by_beer_type", "beer_type"), (Keg.location, "by_location", "location")):
+        for b_id, value, count, content in _breakdown(db, column, brewery_id):
+            if b_id in result:
+                result[b_id][key].append({name: value, "count": count, "current_content": int(content)})
+    return list(result.values())
+
+def get_stats(db, brewery_id: str = None):
+    stats = stats_cache.get(brewery_id)
+    if stats is None:
+        stats = compute_stats(db, brewery_id)
+        stats_cache.set(brewery_id, stats)
+    return stats
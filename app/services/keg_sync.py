@@ -0,0 +1,156 @@
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import bindparam, insert, update
+from app.core.config import get_settings
+from app.db.models import IdempotencyKey, Keg, KegStateHistory, UserRole
+from app.services.keg_changes import next_versions
+
+settings = get_settings()
+
+IDEMPOTENCY_PURGE_INTERVAL = 3600
+
+_last_purge = 0.0
+_purge_lock = threading.Lock()
+
+def key_hash(user_id: str, key: str) -> str:
+    # Las claves las genera cada cliente: se aíslan por usuario
+    return hashlib.sha256(f"{user_id}:{key}".encode()).hexdigest()
+
+def stored_results(db, hashes, chunked):
+    results = {}
+    for chunk in chunked(list(hashes)):
+        for row in db.query(IdempotencyKey.key_hash, IdempotencyKey.result).filter(IdempotencyKey.key_hash.in_(chunk)):
+            results[row.key_hash] = json.loads(row.result)
+    return results
+
+def purge_expired(db) -> int:
+    return db.query(IdempotencyKey).filter(IdempotencyKey.expires_at < datetime.utcnow()).delete(synchronize_session=False)
+
+def _maybe_purge(db):
+    global _last_purge
+    now = time.monotonic()
+    with _purge_lock:
+        if now - _last_purge < IDEMPOTENCY_PURGE_INTERVAL:
+            return
+        _last_purge = now
+    purge_expired(db)
+
+def _utc(value: datetime) -> datetime:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def _is_conflict(original, op) -> bool:
+    # Con base_version: el barril cambió en el servidor desde que el cliente lo leyó.
+    # Sin ella: el servidor tiene un cambio posterior a la acción del cliente (client_ts).
+    if op.base_version is not None:
+        return original["version"] != op.base_version
+    return original["updated_at"] is not None and original["updated_at"] > _utc(op.client_ts)
+
+def apply_operations(db, operations, current_user, keg_query, chunked):
+    # Aplica las operaciones en orden en la transacción del llamador, con un número fijo de sentencias.
+    # Devuelve (resultados en el orden de las operaciones, barriles modificados).
+    now = datetime.utcnow()
+    hashes = [key_hash(current_user.id, op.idempotency_key) for op in operations]
+    stored = stored_results(db, set(hashes), chunked)
+    kegs = {}
+    for ids in chunked(list({op.keg_id for op in operations})):
+        for row in keg_query.filter(Keg.id.in_(ids)):
+            kegs[row.id] = row._asdict()
+    originals = {keg_id: dict(keg) for keg_id, keg in kegs.items()}
+    results, new_keys, history, touched = [], {}, [], {}
+    # Por barril: columnas que cambia el lote y resultados "applied", por si el UPDATE pierde la carrera
+    changed_columns, applied = {}, {}
+    for op, hashed in zip(operations, hashes):
+        previous = stored.get(hashed) or new_keys.get(hashed)
+        if previous is not None:
+            # Reenvío de una operación ya procesada: mismo resultado, sin volver a aplicarla
+            results.append(dict(previous, replayed=True))
+            continue
+        keg = kegs.get(op.keg_id)
+        if keg is None:
+            result = {"status": "not_found"}
+        elif current_user.role == UserRole.USER and keg["brewery_id"] != current_user.brewery_id:
+            result = {"status": "forbidden"}
+        elif _is_conflict(originals[op.keg_id], op):
+            result = {"status": "conflict", "keg": originals[op.keg_id]}
+        else:
+            changes = op.changes.dict(exclude_unset=True)
+            if changes.get("state") is not None and changes["state"] != keg["state"]:
+                history.append({
+                    "keg_id": op.keg_id,
+                    "old_state": keg["state"],
+                    "new_state": changes["state"],
+                    # Momento real del escaneo, nunca en el futuro (refresh_dwell lo recoge por dwell_pending aunque sea antiguo)
+                    "changed_at": min(_utc(op.client_ts), now),
+                    "user_id": current_user.id,
+                })
+            # Solo location admite null
+            changes = {key: value for key, value in changes.items() if value is not None or key == "location"}
+            keg.update(changes)
+            changed_columns.setdefault(op.keg_id, set()).update(changes)
+            touched[op.keg_id] = keg
+            # Referencia al barril: el resultado refleja su estado final tras todo el lote
+            result = {"status": "applied", "keg": keg}
+            applied.setdefault(op.keg_id, []).append(result)
+        result["idempotency_key"] = op.idempotency_key
+        new_keys[hashed] = result
+        results.append(result)
+    if touched:
+        lost = _write_kegs(db, touched, originals, changed_columns, now, chunked)
+        if lost:
+            # Otra escritura confirmó el barril entre la lectura y el UPDATE: sus operaciones pasan a conflicto
+            # con el barril actual y no dejan historial
+            current = {}
+            for ids in chunked(list(lost)):
+                for row in keg_query.filter(Keg.id.in_(ids)):
+                    current[row.id] = row._asdict()
+            for keg_id in lost:
+                for result in applied[keg_id]:
+                    result.update(status="conflict" if keg_id in current else "not_found", keg=current.get(keg_id))
+                del touched[keg_id]
+            history = [entry for entry in history if entry["keg_id"] not in lost]
+    if history:
+        db.execute(insert(KegStateHistory), history)
+    if new_keys:
+        expires_at = now + timedelta(days=settings.IDEMPOTENCY_KEY_DAYS)
+        db.execute(insert(IdempotencyKey), [
+            {"key_hash": hashed, "result": json.dumps(jsonable_encoder(result)), "created_at": now, "expires_at": expires_at}
+            for hashed, result in new_keys.items()
+        ])
+        _maybe_purge(db)
+    return results, list(touched.values())
+
+def _write_kegs(db, touched, originals, changed_columns, now, chunked):
+    # Un executemany por combinación de columnas cambiadas, solo si el barril sigue en la versión leída;
+    # devuelve los ids que no se actualizaron
+    first = next_versions(db, len(touched))
+    for i, keg in enumerate(touched.values()):
+        keg.update(version=first + i, updated_at=now)
+    table = Keg.__table__
+    groups = {}
+    for keg_id, columns in changed_columns.items():
+        groups.setdefault(tuple(sorted(columns)), []).append(touched[keg_id])
+    updated = 0
+    for columns, group in groups.items():
+        result = db.execute(
+            update(table).where(table.c.id == bindparam("keg_id"), table.c.version.is_not_distinct_from(bindparam("read_version"))).values(
+                {column: bindparam(f"new_{column}") for column in columns + ("version", "updated_at")}
+            ),
+            [
+                dict({"keg_id": keg["id"], "read_version": originals[keg["id"]]["version"]},
+                     **{f"new_{column}": keg[column] for column in columns + ("version", "updated_at")})
+                for keg in group
+            ]
+        )
+        updated += result.rowcount
+    if db.get_bind().dialect.supports_sane_multi_rowcount and updated == len(touched):
+        return set()
+    versions = {}
+    for ids in chunked(list(touched)):
+        versions.update(db.query(Keg.id, Keg.version).filter(Keg.id.in_(ids)).all())
+    return {keg_id for keg_id, keg in touched.items() if versions.get(keg_id) != keg["version"]}
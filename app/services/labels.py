@@ -0,0 +1,120 @@
+import io
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import qrcode
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import mm
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+from app.core.cache import TTLCache
+
+# Hoja A4 de 3 x 7 etiquetas
+LABEL_COLUMNS = 3
+LABEL_ROWS = 7
+LABELS_PER_PAGE = LABEL_COLUMNS * LABEL_ROWS
+PAGE_MARGIN = 10 * mm
+QR_SIZE = 28 * mm
+# Por debajo de este número de QR sin cachear no compensa usar el pool de procesos
+POOL_THRESHOLD = 64
+POOL_CHUNK_SIZE = 32
+POOL_WORKERS = 2
+
+# Los QR no cambian para un mismo contenido: reimprimir es casi gratis
+qr_cache = TTLCache(maxsize=20000, ttl=24 * 3600)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def render_qr_png(data: str) -> bytes:
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=8, border=1)
+    qr.add_data(data)
+    qr.make(fit=True)
+    buffer = io.BytesIO()
+    qr.make_image().save(buffer)
+    return buffer.getvalue()
+
+def _render_qr_batch(items):
+    return [render_qr_png(data) for data in items]
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=POOL_WORKERS)
+        return _pool
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+def qr_images(items):
+    # items: lista de (keg_id, contenido); devuelve los PNG en el mismo orden
+    images = {}
+    missing = []
+    for keg_id, data in items:
+        png = qr_cache.get((keg_id, data))
+        if png is None:
+            missing.append((keg_id, data))
+        else:
+            images[keg_id] = png
+    if len(missing) >= POOL_THRESHOLD:
+        chunks = [missing[i:i + POOL_CHUNK_SIZE] for i in range(0, len(missing), POOL_CHUNK_SIZE)]
+        rendered = get_pool().map(_render_qr_batch, [[data for _, data in chunk] for chunk in chunks])
+        pngs = [png for batch in rendered for png in batch]
+    else:
+        pngs = [render_qr_png(data) for _, data in missing]
+    for (keg_id, data), png in zip(missing, pngs):
+        qr_cache.set((keg_id, data), png)
+        images[keg_id] = png
+    return [images[keg_id] for keg_id, _ in items]
+
+def _draw_label(pdf, index, keg, content, png):
+    page_width, page_height = A4
+    cell_width = (page_width - 2 * PAGE_MARGIN) / LABEL_COLUMNS
+    cell_height = (page_height - 2 * PAGE_MARGIN) / LABEL_ROWS
+    column = index % LABEL_COLUMNS
+    row = index // LABEL_COLUMNS
+    x = PAGE_MARGIN + column * cell_width
+    y = page_height - PAGE_MARGIN - (row + 1) * cell_height
+    qr_y = y + (cell_height - QR_SIZE) / 2
+    pdf.drawImage(ImageReader(io.BytesIO(png)), x + 2 * mm, qr_y, QR_SIZE, QR_SIZE)
+    text_x = x + QR_SIZE + 4 * mm
+    text_y = qr_y + QR_SIZE - 4 * mm
+    pdf.setFont("Helvetica-Bold", 9)
+    pdf.drawString(text_x, text_y, (keg.name or "")[:22])
+    pdf.setFont("Helvetica", 7)
+    pdf.drawString(text_x, text_y - 10, (keg.beer_type or "")[:28])
+    pdf.drawString(text_x, text_y - 20, f"{keg.type.value} · {keg.connector.value} · {keg.capacity} L")
+    pdf.drawString(text_x, text_y - 30, keg.id[:8])
+
+def build_labels_pdf(kegs, content_for, chunk_size: int = LABELS_PER_PAGE * 10):
+    # Genera el PDF por bloques de páginas en un fichero temporal (en disco si crece) y lo devuelve rebobinado
+    output = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    pdf = canvas.Canvas(output, pagesize=A4)
+    pdf.setTitle("KegTracker labels")
+    index = 0
+    chunk = []
+
+    def draw_chunk(chunk, index):
+        pngs = qr_images([(keg.id, content_for(keg)) for keg in chunk])
+        for keg, png in zip(chunk, pngs):
+            if index and index % LABELS_PER_PAGE == 0:
+                pdf.showPage()
+            _draw_label(pdf, index % LABELS_PER_PAGE, keg, content_for(keg), png)
+            index += 1
+        return index
+
+    for keg in kegs:
+        chunk.append(keg)
+        if len(chunk) >= chunk_size:
+            index = draw_chunk(chunk, index)
+            chunk = []
+    index = draw_chunk(chunk, index)
+    pdf.showPage()
+    pdf.save()
+    output.seek(0)
+    return output, index
@@ -0,0 +1,69 @@
+import hashlib
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from app.core.cache import TTLCache
+from app.core.config import get_settings
+from app.db.models import UsedToken
+
+settings = get_settings()
+
+# Conservación de tokens sin exp en el payload
+DEFAULT_TOKEN_LIFETIME = timedelta(days=7)
+
+# Solo se cachean tokens consumidos: un "no usado" puede dejar de serlo en otro worker en cualquier momento
+used_cache = TTLCache(maxsize=settings.TOKEN_CACHE_SIZE, ttl=DEFAULT_TOKEN_LIFETIME.total_seconds())
+
+_last_purge = 0.0
+_purge_lock = threading.Lock()
+
+def token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def _expires_at(exp) -> datetime:
+    if exp:
+        return datetime.utcfromtimestamp(exp)
+    return datetime.utcnow() + DEFAULT_TOKEN_LIFETIME
+
+def _remember(key: str, expires_at: datetime):
+    remaining = (expires_at - datetime.utcnow()).total_seconds()
+    if remaining > 0:
+        used_cache.set(key, True, ttl=remaining)
+
+def is_used(db, token: str) -> bool:
+    key = token_hash(token)
+    if used_cache.get(key):
+        return True
+    row = db.query(UsedToken.expires_at).filter(UsedToken.token_hash == key).first()
+    if row is None:
+        return False
+    _remember(key, row.expires_at)
+    return True
+
+def purge_expired(db) -> int:
+    return db.query(UsedToken).filter(UsedToken.expires_at < datetime.utcnow()).delete(synchronize_session=False)
+
+def _maybe_purge(db):
+    # Limpieza periódica de filas caducadas, como mucho una vez por intervalo y proceso
+    global _last_purge
+    now = time.monotonic()
+    with _purge_lock:
+        if now - _last_purge < settings.TOKEN_PURGE_INTERVAL:
+            return
+        _last_purge = now
+    purge_expired(db)
+
+def consume(db, token: str, purpose: str, exp=None) -> bool:
+    # Registra el consumo en la transacción del llamador (que hace el commit junto con el resto de cambios).
+    # Devuelve False si el token ya se usó, aquí o en otro worker; en ese caso la sesión queda revertida.
+    if is_used(db, token):
+        return False
+    _maybe_purge(db)
+    db.add(UsedToken(token_hash=token_hash(token), purpose=purpose, expires_at=_expires_at(exp)))
+    try:
+        db.flush()
+    except IntegrityError:
+        db.rollback()
+        return False
+    return True
@@ -0,0 +1,63 @@
+import os
+import tempfile
+
+# La base de datos de tests debe configurarse antes de importar la app
+_db_dir = tempfile.mkdtemp(prefix="kegtracker-tests-")
+os.environ["DB_URL"] = f"sqlite:///{os.path.join(_db_dir, 'test.db')}"
+# Coste mínimo de bcrypt para que los tests de login sean rápidos
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+
+import uuid
+import pytest
+import pytest_asyncio
+from httpx import AsyncClient, ASGITransport
+from jose import jwt
+from app.main import app
+from app.core.config import get_settings
+from app.db.database import SessionLocal
+from app.db.init_db import init_db
+from app.db.models import Brewery, User, UserRole
+
+init_db()
+
+@pytest_asyncio.fixture
+async def client():
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        yield ac
+
+@pytest.fixture
+def brewery():
+    db = SessionLocal()
+    brewery = Brewery(name=f"Cervecería {uuid.uuid4().hex[:8]}", active=True)
+    db.add(brewery)
+    db.commit()
+    db.refresh(brewery)
+    db.close()
+    return brewery
+
+def make_user(brewery, role=UserRole.USER):
+    db = SessionLocal()
+    user = User(
+        email=f"{uuid.uuid4().hex[:8]}@test.com",
+        hashed_password="",
+        role=role,
+        active=True,
+        brewery_id=brewery.id
+    )
+    db.add(user)
+    db.commit()
+    db.refresh(user)
+    db.close()
+    return user
+
+def auth_headers(user):
+    token = jwt.encode({"sub": user.email, "user_id": user.id}, get_settings().SECRET_KEY, algorithm="HS256")
+    return {"Authorization": f"Bearer {token}"}
+
+@pytest.fixture
+def admin(brewery):
+    return make_user(brewery, UserRole.GLOBAL_ADMIN)
+
+@pytest.fixture
+def admin_headers(admin):
+    return auth_headers(admin)
@@ -0,0 +1,92 @@
+import pytest
+from datetime import datetime, timedelta
+from app.db.database import SessionLocal
+from app.db.models import Keg, KegState, KegStateHistory, KegStateDwell, KegType, KegConnector
+from app.core.config import get_settings
+from app.services import analytics
+from app.services.analytics import maybe_refresh_dwell, refresh_dwell
+from app.tests.test_kegs import count_queries
+
+@pytest.fixture(autouse=True)
+def refresh_every_request(monkeypatch):
+    monkeypatch.setattr(get_settings(), "ANALYTICS_REFRESH_INTERVAL", 0)
+
+def make_keg_with_history(brewery, transitions):
+    db = SessionLocal()
+    start = datetime.utcnow() - timedelta(days=30)
+    keg = Keg(name="Analítica", type=KegType.KEG, connector=KegConnector.S, capacity=20, current_content=0, beer_type="IPA",
+              state=transitions[-1][1], brewery_id=brewery.id, updated_at=start + timedelta(hours=transitions[-1][0]))
+    db.add(keg)
+    db.flush()
+    keg_id = keg.id
+    previous = KegState.READY
+    for hours, state in transitions:
+        db.add(KegStateHistory(keg_id=keg_id, old_state=previous, new_state=state, changed_at=start + timedelta(hours=hours)))
+        previous = state
+    db.commit()
+    db.close()
+    return keg_id
+
+@pytest.mark.asyncio
+async def test_dwell_analytics(client, brewery, admin_headers):
+    keg_id = make_keg_with_history(brewery, [(0, KegState.IN_USE), (10, KegState.DIRTY), (12, KegState.CLEAN)])
+    response = await client.get("/api/analytics/dwell", params={"brewery_id": brewery.id}, headers=admin_headers)
+    assert response.status_code == 200
+    summary = response.json()
+    states = {s["state"]: s for s in summary["states"]}
+    assert states["in_use"]["avg_seconds"] == 10 * 3600
+    assert states["dirty"]["p50_seconds"] == 2 * 3600
+    assert {"from": "dirty", "to": "clean", "count": 1, "avg_seconds": 7200.0} in summary["transitions"]
+    assert summary["cycles"] == 1
+    # Incremental: una nueva transición cierra el estado abierto
+    db = SessionLocal()
+    db.add(KegStateHistory(keg_id=keg_id, old_state=KegState.CLEAN, new_state=KegState.READY))
+    db.commit()
+    assert refresh_dwell(db) == {"inserted": 1, "updated": 1}
+    # Sin historial nuevo: una sola consulta, sin recorrer los estados abiertos
+    with count_queries() as statements:
+        assert refresh_dwell(db) == {"inserted": 0, "updated": 0}
+    assert len(statements) == 1
+    # Una transición con fecha anterior a las ya materializadas también se recoge y corrige la previa
+    db.add(KegStateHistory(keg_id=keg_id, old_state=KegState.DIRTY, new_state=KegState.EMPTY, changed_at=datetime.utcnow() - timedelta(days=29, hours=13)))
+    db.commit()
+    assert refresh_dwell(db) == {"inserted": 1, "updated": 1}
+    db.close()
+    response = await client.get(f"/api/analytics/kegs/{keg_id}", headers=admin_headers)
+    assert response.json()["current_state"] == "ready"
+    response = await client.get("/api/analytics/idle", params={"brewery_id": brewery.id, "days": 7}, headers=admin_headers)
+    assert response.json() == []
+
+@pytest.mark.asyncio
+async def test_dwell_includes_offline_sync(client, brewery, admin_headers):
+    keg_id = make_keg_with_history(brewery, [(0, KegState.DIRTY)])
+    response = await client.get(f"/api/analytics/kegs/{keg_id}", headers=admin_headers)
+    assert response.json()["current_state"] == "dirty"
+    # Escaneo offline de hace una hora, sincronizado ahora
+    scanned_at = datetime.utcnow() - timedelta(hours=1)
+    op = {"idempotency_key": "dwell-1", "keg_id": keg_id, "client_ts": scanned_at.isoformat(), "changes": {"state": "clean"}}
+    response = await client.post("/api/kegs/sync", json={"operations": [op]}, headers=admin_headers)
+    assert response.json()[0]["status"] == "applied"
+    summary = (await client.get(f"/api/analytics/kegs/{keg_id}", headers=admin_headers)).json()
+    assert summary["current_state"] == "clean"
+    assert summary["current_since"].startswith(scanned_at.isoformat()[:16])
+    [dirty] = summary["transitions"]
+    assert (dirty["from"], dirty["to"]) == ("dirty", "clean")
+    assert dirty["avg_seconds"] == pytest.approx(30 * 86400 - 3600, abs=5)
+
+def test_request_refresh_is_capped_and_committed_per_batch(brewery, monkeypatch):
+    db = SessionLocal()
+    refresh_dwell(db)
+    keg_ids = [make_keg_with_history(brewery, [(0, KegState.IN_USE), (5, KegState.EMPTY)]) for _ in range(3)]
+    monkeypatch.setattr(analytics, "REFRESH_KEGS_PER_BATCH", 1)
+    monkeypatch.setattr(get_settings(), "ANALYTICS_REFRESH_MAX_BATCHES", 2)
+    # Una petición procesa como mucho dos lotes y cada lote queda confirmado por separado
+    assert maybe_refresh_dwell(db) == {"inserted": 4, "updated": 0}
+    other = SessionLocal()
+    materialized = other.query(KegStateDwell.keg_id).filter(KegStateDwell.keg_id.in_(keg_ids)).distinct().count()
+    pending = other.query(KegStateHistory.id).filter(KegStateHistory.dwell_pending.is_(True)).count()
+    other.close()
+    assert (materialized, pending) == (2, 2)
+    # El resto lo recoge el siguiente refresco (o el worker en segundo plano)
+    assert refresh_dwell(db) == {"inserted": 2, "updated": 0}
+    db.close()
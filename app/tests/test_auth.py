@@ -0,0 +1,138 @@
+import threading
+from datetime import datetime, timedelta, timezone
+import pytest
+from jose import jwt
+from passlib.context import CryptContext
+from app.core import security
+from app.api import auth
+from app.db.database import SessionLocal, engine
+from app.core import auth as core_auth
+from app.core.auth import principal_cache
+from app.core.config import get_settings
+from app.services import token_store
+from app.tests.conftest import make_user, auth_headers
+from app.db.models import User, UserRole
+
+@pytest.mark.asyncio
+async def test_principal_cache_hit(client, brewery):
+    user = make_user(brewery, UserRole.ADMIN)
+    headers = auth_headers(user)
+    response = await client.get("/api/breweries/", headers=headers)
+    assert response.status_code == 200
+    hits = principal_cache.hits
+    response = await client.get("/api/breweries/", headers=headers)
+    assert response.status_code == 200
+    assert principal_cache.hits == hits + 1
+
+@pytest.mark.asyncio
+async def test_deactivate_invalidates_principal(client, brewery, admin_headers):
+    user = make_user(brewery, UserRole.ADMIN)
+    headers = auth_headers(user)
+    assert (await client.get("/api/breweries/", headers=headers)).status_code == 200
+    response = await client.patch(f"/api/users/{user.id}/deactivate", headers=admin_headers)
+    assert response.status_code == 200
+    assert (await client.get("/api/breweries/", headers=headers)).status_code == 401
+
+@pytest.mark.asyncio
+async def test_invalidation_during_load_is_not_cached(client, brewery, monkeypatch):
+    user = make_user(brewery, UserRole.ADMIN)
+    headers = auth_headers(user)
+    load_principal = core_auth._load_principal
+
+    def load_then_invalidate(db, user_id):
+        # La fila se lee antes de que otra petición desactive al usuario e invalide la cache
+        principal = load_principal(db, user_id)
+        core_auth.invalidate_user(user_id)
+        return principal
+
+    monkeypatch.setattr(core_auth, "_load_principal", load_then_invalidate)
+    assert (await client.get("/api/breweries/", headers=headers)).status_code == 200
+    assert principal_cache.get(user.id) is None
+
+@pytest.mark.asyncio
+async def test_pool_stats(client, admin_headers):
+    response = await client.get("/api/config/pool-stats", headers=admin_headers)
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["checkouts"] >= 1
+    assert stats["size"] == 5
+
+
+@pytest.mark.asyncio
+async def test_login_rehashes_outdated_hash(client, brewery):
+    user = make_user(brewery, UserRole.USER)
+    db = SessionLocal()
+    db.query(User).filter(User.id == user.id).update({"hashed_password": CryptContext(schemes=["bcrypt"], bcrypt__rounds=5).hash("secreto")})
+    db.commit()
+    response = await client.post("/api/auth/login", json={"email": user.email, "password": "malo"})
+    assert response.status_code == 401
+    response = await client.post("/api/auth/login", json={"email": user.email, "password": "secreto"})
+    assert response.status_code == 200
+    db.expire_all()
+    assert db.query(User.hashed_password).filter(User.id == user.id).scalar().startswith("$2b$04$")
+    db.close()
+
+@pytest.mark.asyncio
+async def test_login_releases_connection_while_hashing(client, brewery, monkeypatch):
+    user = make_user(brewery, UserRole.USER)
+    db = SessionLocal()
+    db.query(User).filter(User.id == user.id).update({"hashed_password": security.pwd_context.hash("secreto")})
+    db.commit()
+    db.close()
+    checked_out = []
+
+    async def verify(password, hashed):
+        checked_out.append(engine.pool.checkedout())
+        return await security.verify_password_async(password, hashed)
+    monkeypatch.setattr(auth, "verify_password_async", verify)
+    response = await client.post("/api/auth/login", json={"email": user.email, "password": "secreto"})
+    assert response.status_code == 200
+    # Ninguna conexión ocupada por la petición mientras corre bcrypt
+    assert checked_out == [0]
+
+@pytest.mark.asyncio
+async def test_create_user_then_login(client, brewery, admin_headers):
+    payload = {"email": "nuevo@test.com", "password": "clave123", "role": "user", "brewery_id": brewery.id}
+    response = await client.post("/api/users/", json=payload, headers=admin_headers)
+    assert response.status_code == 200
+    response = await client.post("/api/users/", json=payload, headers=admin_headers)
+    assert response.status_code == 400
+    response = await client.post("/api/auth/login", json={"email": "nuevo@test.com", "password": "clave123"})
+    assert response.status_code == 200
+
+@pytest.mark.asyncio
+async def test_password_hashing_backpressure(client, brewery, monkeypatch):
+    user = make_user(brewery, UserRole.USER)
+    full = threading.BoundedSemaphore(1)
+    full.acquire()
+    monkeypatch.setattr(security, "_pending", full)
+    db = SessionLocal()
+    db.query(User).filter(User.id == user.id).update({"hashed_password": security.pwd_context.hash("secreto")})
+    db.commit()
+    db.close()
+    response = await client.post("/api/auth/login", json={"email": user.email, "password": "secreto"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(security.RETRY_AFTER_SECONDS)
+
+@pytest.mark.asyncio
+async def test_reset_token_single_use(client, brewery):
+    user = make_user(brewery, UserRole.USER)
+    exp = (datetime.now(timezone.utc) + timedelta(minutes=60)).timestamp()
+    token = jwt.encode({"user_id": user.id, "exp": exp}, get_settings().SECRET_KEY, algorithm="HS256")
+    assert (await client.get("/api/auth/reset-password/validate", params={"token": token})).status_code == 200
+    response = await client.post("/api/auth/reset-password", json={"token": token, "password": "nueva"})
+    assert response.status_code == 200
+    token_store.used_cache.clear()  # como si fuera otro worker: la comprobación va a la base de datos
+    response = await client.post("/api/auth/reset-password", json={"token": token, "password": "otra"})
+    assert response.status_code == 400
+    assert (await client.get("/api/auth/reset-password/validate", params={"token": token})).status_code == 400
+
+def test_token_store_purges_expired():
+    db = SessionLocal()
+    past = (datetime.now(timezone.utc) - timedelta(minutes=1)).timestamp()
+    assert token_store.consume(db, "caducado", "reset", past)
+    db.commit()
+    assert token_store.purge_expired(db) >= 1
+    db.commit()
+    assert not token_store.is_used(db, "caducado")
+    db.close()
@@ -0,0 +1,64 @@
+import pytest
+from app.core import config
+from app.core.config import get_settings, reload_if_changed
+
+@pytest.fixture
+def env_file(tmp_path, monkeypatch):
+    path = tmp_path / ".env"
+    monkeypatch.setattr(config, "ENV_FILE", str(path))
+    monkeypatch.setattr(config, "_env_mtime", config._env_mtime)
+    monkeypatch.setattr(config, "_last_check", config._last_check)
+    settings = get_settings()
+    # Restaura el objeto compartido y las variables que escriba la recarga
+    for key in ("FRONTEND_FQDN", "SMTP_FROM", "EMAIL_BATCH_SIZE", "SECRET_KEY", "SMTP_PASS"):
+        monkeypatch.setattr(settings, key, getattr(settings, key))
+        monkeypatch.delenv(key, raising=False)
+    return path
+
+def test_get_settings_is_cached():
+    assert get_settings() is get_settings()
+
+@pytest.mark.asyncio
+async def test_get_and_update_config(client, admin_headers, env_file):
+    response = await client.get("/api/config/", headers=admin_headers)
+    assert response.status_code == 200
+    assert response.json()["SMTP_PORT"] == str(get_settings().SMTP_PORT)
+    response = await client.put("/api/config/", json={"FRONTEND_FQDN": "https://kegs.example.com", "EMAIL_BATCH_SIZE": "50"}, headers=admin_headers)
+    assert response.status_code == 200
+    assert get_settings().FRONTEND_FQDN == "https://kegs.example.com"
+    assert get_settings().EMAIL_BATCH_SIZE == 50
+    assert "FRONTEND_FQDN=https://kegs.example.com" in env_file.read_text()
+    response = await client.put("/api/config/", json={"EMAIL_BATCH_SIZE": "muchos"}, headers=admin_headers)
+    assert response.status_code == 400
+    response = await client.put("/api/config/", json={"NO_EXISTE": "1"}, headers=admin_headers)
+    assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_config_secrets_are_redacted(client, admin_headers, env_file, monkeypatch):
+    settings = get_settings()
+    # También en el entorno: PUT vuelve a leer la configuración
+    for key, value in (("SMTP_PASS", "smtp-secreto"), ("DB_URL", "mysql+pymysql://kegs:db-secreto@db/kegtracker")):
+        monkeypatch.setenv(key, value)
+        monkeypatch.setattr(settings, key, value)
+    response = await client.get("/api/config/", headers=admin_headers)
+    data = response.json()
+    assert data["SECRET_KEY"] == "***"
+    assert data["SMTP_PASS"] == "***"
+    assert data["DB_URL"] == "mysql+pymysql://kegs:***@db/kegtracker"
+    assert "secreto" not in response.text
+    secret_key = settings.SECRET_KEY
+    # Guardar de vuelta los valores enmascarados no cambia los secretos
+    response = await client.put("/api/config/", json={key: data[key] for key in ("SECRET_KEY", "SMTP_PASS", "DB_URL")}, headers=admin_headers)
+    assert response.status_code == 200
+    assert get_settings().SECRET_KEY == secret_key
+    assert get_settings().SMTP_PASS == "smtp-secreto"
+    assert "***" not in env_file.read_text()
+    response = await client.put("/api/config/", json={"SMTP_PASS": "nuevo"}, headers=admin_headers)
+    assert get_settings().SMTP_PASS == "nuevo"
+
+def test_reload_when_another_worker_writes_env(env_file, monkeypatch):
+    env_file.write_text('# guardado por otro worker\nSMTP_FROM="Keg Tracker <no-reply@example.com>"\n')
+    monkeypatch.setattr(config, "_last_check", 0.0)
+    assert reload_if_changed()
+    assert get_settings().SMTP_FROM == "Keg Tracker <no-reply@example.com>"
+    assert not reload_if_changed()  # dentro del intervalo no se vuelve a mirar el fichero
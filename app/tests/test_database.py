@@ -0,0 +1,57 @@
+import pytest
+import pytest_asyncio
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from app.core.auth import principal_cache
+from app.db.database import async_db_url, async_session_dependency, create_async_db_engine, create_db_engine, engine, get_session_runner
+from app.main import app
+
+def test_sqlite_profile_pragmas_and_write_gate(tmp_path):
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'wal.db'}")
+    with engine.begin() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1  # NORMAL
+        conn.execute(text("CREATE TABLE t (x INTEGER)"))
+        assert engine.sqlite_write_gate.lock.locked()
+    assert not engine.sqlite_write_gate.lock.locked()
+    with engine.connect() as conn:
+        conn.execute(text("INSERT INTO t VALUES (1)"))
+        # Sin commit: el rollback al cerrar libera el lock
+    assert not engine.sqlite_write_gate.lock.locked()
+
+@pytest_asyncio.fixture
+async def async_mode():
+    # Mismas rutas sobre el motor asyncio (aiosqlite) contra la base de datos de tests
+    async_engine = create_async_db_engine(engine.url.render_as_string(hide_password=False))
+    app.dependency_overrides[get_session_runner] = async_session_dependency(
+        async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    )
+    principal_cache.clear()
+    yield async_engine
+    app.dependency_overrides.pop(get_session_runner, None)
+    await async_engine.dispose()
+
+@pytest.mark.asyncio
+async def test_async_engine_routes(async_mode, client, brewery, admin, admin_headers):
+    assert async_mode.url.drivername == "sqlite+aiosqlite"
+    payload = {"name": "Async", "type": "keg", "connector": "S", "capacity": 20, "current_content": 0, "beer_type": "IPA", "state": "ready", "brewery_id": brewery.id}
+    response = await client.post("/api/kegs/", json=payload, headers=admin_headers)
+    assert response.status_code == 200, response.text
+    keg_id = response.json()["id"]
+    payload["state"] = "in_use"
+    response = await client.patch(f"/api/kegs/{keg_id}", json=payload, headers=admin_headers)
+    assert response.json()["state"] == "in_use"
+    response = await client.get(f"/api/kegs/{keg_id}/history", headers=admin_headers)
+    assert [h["new_state"] for h in response.json()] == ["in_use"]
+    response = await client.get("/api/users/", headers=admin_headers)
+    assert admin.id in [u["id"] for u in response.json()]
+    response = await client.get("/api/breweries/", headers=admin_headers)
+    assert brewery.id in [b["id"] for b in response.json()]
+    response = await client.get("/api/kegs/missing", headers=admin_headers)
+    assert response.status_code == 404
+
+def test_async_db_url():
+    assert async_db_url("sqlite:///./kegtracker.db") == "sqlite+aiosqlite:///./kegtracker.db"
+    assert async_db_url("mysql+pymysql://u:p@db/keg") == "mysql+aiomysql://u:p@db/keg"
+    with pytest.raises(ValueError):
+        async_db_url("postgresql://db/keg")
@@ -0,0 +1,173 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+import pytest
+import pytest_asyncio
+from app.core.config import get_settings
+from app.db.database import SessionLocal, engine
+from app.db.models import EmailOutbox
+from app.services import email_outbox, email_service
+from app.services.email_outbox import OutboxWorker, enqueue
+from app.services.email_service import create_environment, render_many, send_bulk_email
+from app.tests.conftest import make_user
+
+class LocalSMTP:
+    # Servidor SMTP mínimo para tests: acepta todo y guarda los mensajes recibidos
+    def __init__(self):
+        self.messages = []
+        self.connections = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        writer.write(b"220 localhost ESMTP\r\n")
+        data, lines = False, []
+        while line := await reader.readline():
+            if data:
+                if line == b".\r\n":
+                    data = False
+                    self.messages.append(b"".join(lines).decode())
+                    lines = []
+                    writer.write(b"250 OK\r\n")
+                else:
+                    lines.append(line)
+                    continue
+            elif line[:4].upper() == b"EHLO":
+                writer.write(b"250-localhost\r\n250 8BITMIME\r\n")
+            elif line[:4].upper() == b"DATA":
+                data = True
+                writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+            elif line[:4].upper() == b"QUIT":
+                writer.write(b"221 Bye\r\n")
+                await writer.drain()
+                break
+            else:
+                writer.write(b"250 OK\r\n")
+            await writer.drain()
+        writer.close()
+
+@pytest_asyncio.fixture
+async def smtp_server(monkeypatch):
+    server = LocalSMTP()
+    listener = await asyncio.start_server(server.handle, "127.0.0.1", 0)
+    monkeypatch.setattr(email_outbox.settings, "SMTP_HOST", "127.0.0.1")
+    monkeypatch.setattr(email_outbox.settings, "SMTP_PORT", listener.sockets[0].getsockname()[1])
+    monkeypatch.setattr(email_outbox.settings, "SMTP_STARTTLS", False)
+    monkeypatch.setattr(email_outbox.settings, "SMTP_USER", "")
+    monkeypatch.setattr(email_outbox.settings, "SMTP_FROM", "no-reply@test.com")
+    yield server
+    listener.close()
+    await listener.wait_closed()
+
+def outbox_rows(ids):
+    db = SessionLocal()
+    rows = {row.id: row for row in db.query(EmailOutbox).filter(EmailOutbox.id.in_(ids))}
+    db.close()
+    return rows
+
+@pytest.mark.asyncio
+async def test_forgot_password_enqueues(client, brewery):
+    user = make_user(brewery)
+    response = await client.post("/api/auth/forgot-password", json={"email": user.email})
+    assert response.status_code == 200
+    db = SessionLocal()
+    row = db.query(EmailOutbox).filter(EmailOutbox.to_address == user.email).one()
+    db.close()
+    assert row.status == "pending"
+    assert "reset-password?token=" in row.body
+
+@pytest.mark.asyncio
+async def test_email_endpoints_release_connection_before_enqueue(client, brewery, monkeypatch):
+    user = make_user(brewery)
+    checked_out = []
+
+    def enqueue_after_checkout(*args):
+        # El outbox abre su propia sesión: la de la petición ya no debe ocupar una conexión
+        checked_out.append(engine.pool.checkedout())
+        return enqueue(*args)
+    monkeypatch.setattr(email_service, "enqueue", enqueue_after_checkout)
+    response = await client.post("/api/auth/forgot-password", json={"email": user.email})
+    assert response.status_code == 200
+    response = await client.post("/api/invite/generate", json={"email": "invitado@test.com", "brewery_id": brewery.id})
+    assert response.status_code == 200
+    assert checked_out == [0, 0]
+
+@pytest.mark.asyncio
+async def test_worker_sends_batch_over_one_connection(smtp_server):
+    ids = [enqueue(f"user{i}@test.com", "Hola", f"<p>mensaje {i}</p>") for i in range(3)]
+    worker = OutboxWorker()
+    sent = 0
+    while True:
+        count = await worker.run_once()
+        if not count:
+            break
+        sent += count
+    await worker.disconnect()
+    assert sent >= 3
+    assert smtp_server.connections == 1
+    assert all(row.status == "sent" for row in outbox_rows(ids).values())
+    assert any("user0@test.com" in message for message in smtp_server.messages)
+
+@pytest.mark.asyncio
+async def test_worker_retries_with_backoff(monkeypatch):
+    listener = await asyncio.start_server(lambda r, w: w.close(), "127.0.0.1", 0)
+    port = listener.sockets[0].getsockname()[1]
+    listener.close()
+    await listener.wait_closed()
+    monkeypatch.setattr(email_outbox.settings, "SMTP_HOST", "127.0.0.1")
+    monkeypatch.setattr(email_outbox.settings, "SMTP_PORT", port)
+    message_id = enqueue("retry@test.com", "Hola", "<p>reintento</p>")
+    worker = OutboxWorker()
+    await worker.run_once()
+    row = outbox_rows([message_id])[message_id]
+    assert row.status == "pending"
+    assert row.attempts == 1
+    assert row.last_error
+    assert row.next_attempt_at > row.created_at
+
+def test_stale_claim_cannot_record_results():
+    message_id = enqueue("stale@test.com", "Hola", "<p>lento</p>")
+    [first] = [m for m in email_outbox.claim_batch(1000) if m["id"] == message_id]
+    db = SessionLocal()
+    # El primer worker lleva más que el plazo sin renovar el reclamo: otro reclama el mensaje
+    past = datetime.utcnow() - email_outbox.claim_timeout() - timedelta(seconds=1)
+    db.query(EmailOutbox).filter(EmailOutbox.id == message_id).update({"claimed_at": past})
+    db.commit()
+    [second] = [m for m in email_outbox.claim_batch(1000) if m["id"] == message_id]
+    email_outbox.record_results(first["claimed_by"], [], [(first, "timeout")])
+    row = outbox_rows([message_id])[message_id]
+    assert (row.status, row.claimed_by, row.attempts) == ("sending", second["claimed_by"], 0)
+    email_outbox.record_results(second["claimed_by"], [message_id], [])
+    assert outbox_rows([message_id])[message_id].status == "sent"
+    # Retención: los enviados antiguos se borran con su cuerpo
+    db.query(EmailOutbox).filter(EmailOutbox.id == message_id).update({"sent_at": datetime.utcnow() - timedelta(days=get_settings().EMAIL_RETENTION_DAYS + 1)})
+    assert email_outbox.purge_delivered(db) >= 1
+    db.commit()
+    db.close()
+    assert outbox_rows([message_id]) == {}
+
+def test_render_many_uses_cached_template(tmp_path):
+    env = create_environment(cache_dir=str(tmp_path))
+    first = env.get_template("register_user.html")
+    assert env.get_template("register_user.html") is first
+    assert list(tmp_path.iterdir())  # bytecode en disco
+    links = [f"https://test/register?token={i}" for i in range(3)]
+    bodies = render_many("register_user.html", [{"registration_link": link} for link in links])
+    assert [link in body for link, body in zip(links, bodies)] == [True, True, True]
+
+@pytest.mark.asyncio
+async def test_send_bulk_email_enqueues_all():
+    recipients = [(f"bulk{i}@test.com", {"registration_link": f"https://test/{i}"}) for i in range(5)]
+    assert await send_bulk_email("Aviso", "register_user.html", recipients) == 5
+    db = SessionLocal()
+    rows = db.query(EmailOutbox).filter(EmailOutbox.to_address.like("bulk%@test.com")).all()
+    db.close()
+    assert sorted(row.to_address for row in rows) == sorted(to for to, _ in recipients)
+    assert all(row.status == "pending" for row in rows)
+
+def test_default_bytecode_cache_is_per_user(monkeypatch):
+    monkeypatch.setattr(get_settings(), "EMAIL_TEMPLATE_CACHE_DIR", "")
+    env = create_environment()
+    directory = env.bytecode_cache.directory
+    # El directorio por defecto de Jinja: propio del usuario y 0700, nunca uno fijo compartido
+    assert os.stat(directory).st_uid == os.getuid()
+    assert os.stat(directory).st_mode & 0o077 == 0
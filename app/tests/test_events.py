@@ -0,0 +1,97 @@
+import asyncio
+import json
+import uuid
+import pytest
+from app.api.kegs import keg_out_query
+from app.core.config import get_settings
+from app.db.database import SessionLocal
+from app.db.models import Brewery, Keg, KegConnector, KegState, KegType, UserRole
+from app.services import events
+from app.services.keg_changes import next_versions
+from app.tests.conftest import auth_headers, make_user
+from app.tests.test_kegs import keg_payload
+
+def parse(frame):
+    fields = dict(line.split(": ", 1) for line in frame.strip().split("\n"))
+    return fields.get("id"), fields["event"], json.loads(fields["data"])
+
+async def next_frame(stream):
+    return parse(await asyncio.wait_for(stream.__anext__(), 5))
+
+def keg_stream(brewery_id, last_event_id=None):
+    return events.stream(lambda db: keg_out_query(db, isouter=True), brewery_id, last_event_id)
+
+@pytest.mark.asyncio
+async def test_keg_events_stream_and_resume(client, brewery, admin_headers):
+    stream = keg_stream(brewery.id)
+    assert (await stream.__anext__()).startswith("retry:")
+    response = await client.post("/api/kegs/", json=keg_payload(brewery, name="Evento"), headers=admin_headers)
+    keg_id = response.json()["id"]
+    first_id, kind, data = await next_frame(stream)
+    assert kind == "upsert" and data["id"] == keg_id and data["brewery_id"] == brewery.id
+    assert int(first_id) == response.json()["version"]
+    await client.patch(f"/api/kegs/{keg_id}", json=keg_payload(brewery, name="Evento", state="in_use"), headers=admin_headers)
+    _, kind, data = await next_frame(stream)
+    assert (kind, data["state"]) == ("upsert", "in_use")
+    await client.delete(f"/api/kegs/{keg_id}", headers=admin_headers)
+    _, kind, data = await next_frame(stream)
+    assert (kind, data) == ("deleted", {"id": keg_id, "type": "deleted", "brewery_id": brewery.id})
+    await stream.aclose()
+    assert events.notifier.stats()["subscribers"] == 0
+
+    # Reanudar desde el primer evento (en cualquier worker): el estado final del barril, eliminado
+    resumed = keg_stream(brewery.id, first_id)
+    await resumed.__anext__()
+    _, kind, data = await next_frame(resumed)
+    assert (kind, data["id"]) == ("deleted", keg_id)
+    await resumed.aclose()
+    # Un id que no es una versión de esta base de datos obliga a recargar
+    for unknown_id in ("otroproceso-3", "999999999"):
+        unknown = keg_stream(brewery.id, unknown_id)
+        await unknown.__anext__()
+        assert (await next_frame(unknown))[1] == "reset"
+        await unknown.aclose()
+
+@pytest.mark.asyncio
+async def test_keg_events_include_other_workers(brewery, monkeypatch):
+    monkeypatch.setattr(get_settings(), "EVENTS_POLL_INTERVAL", 0.05)
+    stream = keg_stream(brewery.id)
+    await stream.__anext__()
+    pending = asyncio.ensure_future(stream.__anext__())
+    await asyncio.sleep(0.1)
+    # Escritura confirmada por otro proceso: no pasa por after_kegs_write de este
+    db = SessionLocal()
+    keg = Keg(name="Otro worker", type=KegType.KEG, connector=KegConnector.S, capacity=20, current_content=0,
+              beer_type="IPA", state=KegState.READY, brewery_id=brewery.id, version=next_versions(db))
+    db.add(keg)
+    db.commit()
+    keg_id = keg.id
+    db.close()
+    _, kind, data = parse(await asyncio.wait_for(pending, 5))
+    assert (kind, data["id"], data["name"]) == ("upsert", keg_id, "Otro worker")
+    await stream.aclose()
+
+@pytest.mark.asyncio
+async def test_keg_events_filtered_by_brewery(client, brewery, admin_headers):
+    db = SessionLocal()
+    other = Brewery(name=f"Otra {uuid.uuid4().hex[:8]}", active=True)
+    db.add(other)
+    db.commit()
+    db.refresh(other)
+    db.close()
+    stream = keg_stream(other.id)
+    await stream.__anext__()
+    await client.post("/api/kegs/", json=keg_payload(brewery, name="Ajeno"), headers=admin_headers)
+    await client.post("/api/kegs/", json=keg_payload(other, name="Propio"), headers=admin_headers)
+    _, kind, data = await next_frame(stream)
+    assert (kind, data["name"]) == ("upsert", "Propio")
+    await stream.aclose()
+
+@pytest.mark.asyncio
+async def test_keg_events_permissions(client, brewery):
+    response = await client.get("/api/kegs/events")
+    assert response.status_code == 401
+    user = make_user(brewery, UserRole.USER)
+    token = auth_headers(user)["Authorization"].split()[1]
+    response = await client.get("/api/kegs/events", params={"brewery_id": "otra", "access_token": token})
+    assert response.status_code == 403
@@ -1,37 +1,467 @@
 # Requiere pytest, pytest-asyncio y httpx instalados
+import asyncio
+import json
+import time
 import pytest
-from httpx import AsyncClient
-from app.main import app
-
-@pytest.mark.asyncio
-async def test_keg_crud():
-    async with AsyncClient(app=app, base_url="http://test") as ac:
-        # Crear barril
-        keg_data = {
-            "name": "Barril Test",
-            "type": "keg",
-            "connector": "S",
-            "capacity": 20,
-            "current_content": 10,
-            "beer_type": "IPA",
-            "state": "ready",
-            "brewery_id": 1
-        }
-        # Suponiendo autenticación mockeada o bypass para test
-        response = await ac.post("/api/kegs/", json=keg_data)
-        assert response.status_code == 200
-        keg = response.json()
-        keg_id = keg["id"]
-        # Listar barriles
-        response = await ac.get("/api/kegs/")
-        assert response.status_code == 200
-        # Actualizar barril
-        keg_data["state"] = "in_use"
-        response = await ac.patch(f"/api/kegs/{keg_id}", json=keg_data)
+from contextlib import contextmanager
+from sqlalchemy import event
+from app.db.database import engine
+from app.db.models import UserRole
+from app.services import keg_search
+from app.tests.conftest import auth_headers, make_user
+from app.tests.test_database import async_mode  # noqa: F401
+
+@pytest.mark.asyncio
+async def test_keg_crud(client, brewery, admin_headers):
+    ac = client
+    # Crear barril
+    keg_data = {
+        "name": "Barril Test",
+        "type": "keg",
+        "connector": "S",
+        "capacity": 20,
+        "current_content": 10,
+        "beer_type": "IPA",
+        "state": "ready",
+        "brewery_id": brewery.id
+    }
+    response = await ac.post("/api/kegs/", json=keg_data, headers=admin_headers)
+    assert response.status_code == 200
+    keg = response.json()
+    keg_id = keg["id"]
+    # Listar barriles
+    response = await ac.get("/api/kegs/", headers=admin_headers)
+    assert response.status_code == 200
+    # Actualizar barril
+    keg_data["state"] = "in_use"
+    response = await ac.patch(f"/api/kegs/{keg_id}", json=keg_data, headers=admin_headers)
+    assert response.status_code == 200
+    # Historial
+    response = await ac.get(f"/api/kegs/{keg_id}/history", headers=admin_headers)
+    assert response.status_code == 200
+    # Eliminar barril
+    response = await ac.delete(f"/api/kegs/{keg_id}", headers=admin_headers)
+    assert response.status_code == 200
+
+def keg_payload(brewery, **overrides):
+    data = {
+        "name": "Barril",
+        "type": "keg",
+        "connector": "S",
+        "capacity": 20,
+        "current_content": 10,
+        "beer_type": "IPA",
+        "state": "ready",
+        "brewery_id": brewery.id
+    }
+    data.update(overrides)
+    return data
+
+@pytest.mark.asyncio
+async def test_list_kegs_cursor_pagination(client, brewery, admin_headers):
+    for i in range(5):
+        await client.post("/api/kegs/", json=keg_payload(brewery, name=f"Lote_{i}"), headers=admin_headers)
+    await client.post("/api/kegs/", json=keg_payload(brewery, name="Otro", beer_type="Stout"), headers=admin_headers)
+    seen = []
+    params = {"brewery_id": brewery.id, "name_prefix": "Lote_", "limit": 2}
+    while True:
+        response = await client.get("/api/kegs/", params=params, headers=admin_headers)
         assert response.status_code == 200
-        # Historial
-        response = await ac.get(f"/api/kegs/{keg_id}/history")
+        seen.extend(k["id"] for k in response.json())
+        next_cursor = response.headers.get("X-Next-Cursor")
+        if not next_cursor:
+            break
+        params["cursor"] = next_cursor
+    assert len(seen) == 5
+    assert seen == sorted(seen)
+    response = await client.get("/api/kegs/", params={"brewery_id": brewery.id, "beer_type": "Stout"}, headers=admin_headers)
+    assert [k["name"] for k in response.json()] == ["Otro"]
+    response = await client.get("/api/kegs/", params={"cursor": "%%%"}, headers=admin_headers)
+    assert response.status_code == 400
+
+@contextmanager
+def count_queries():
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+@pytest.mark.asyncio
+async def test_keg_endpoints_query_count(client, brewery, admin_headers):
+    # Primera petición para calentar la cache de autenticación
+    await client.get("/api/kegs/", params={"brewery_id": brewery.id}, headers=admin_headers)
+    with count_queries() as statements:
+        response = await client.post("/api/kegs/", json=keg_payload(brewery), headers=admin_headers)
+    assert response.json()["brewery_name"] == brewery.name
+    assert len(statements) == 3  # UPDATE contador de versiones + INSERT + SELECT
+    keg_id = response.json()["id"]
+    for i in range(3):
+        await client.post("/api/kegs/", json=keg_payload(brewery, name=f"Extra {i}"), headers=admin_headers)
+    with count_queries() as statements:
+        response = await client.get("/api/kegs/", params={"brewery_id": brewery.id}, headers=admin_headers)
+    assert len(response.json()) == 4
+    assert all(k["brewery_name"] == brewery.name for k in response.json())
+    assert len(statements) == 2  # versiones para el ETag + SELECT
+    with count_queries() as statements:
+        response = await client.get(f"/api/kegs/{keg_id}", headers=admin_headers)
+    assert response.json()["brewery_name"] == brewery.name
+    assert len(statements) == 1
+    with count_queries() as statements:
+        response = await client.patch(f"/api/kegs/{keg_id}", json=keg_payload(brewery, state="in_use"), headers=admin_headers)
+    assert response.json()["state"] == "in_use"
+    assert len(statements) == 5  # SELECT + UPDATE contador + UPDATE + INSERT historial + SELECT
+    with count_queries() as statements:
+        response = await client.get(f"/api/kegs/{keg_id}/history", headers=admin_headers)
+    assert len(response.json()) == 1
+    assert len(statements) == 1
+
+@pytest.mark.asyncio
+async def test_bulk_transition(client, brewery, admin_headers):
+    keg_ids = []
+    for i in range(3):
+        response = await client.post("/api/kegs/", json=keg_payload(brewery, state="dirty"), headers=admin_headers)
+        keg_ids.append(response.json()["id"])
+    response = await client.post("/api/kegs/", json=keg_payload(brewery, state="clean"), headers=admin_headers)
+    clean_id = response.json()["id"]
+    body = {"keg_ids": keg_ids + [clean_id, "missing"], "target_state": "clean"}
+    with count_queries() as statements:
+        response = await client.post("/api/kegs/bulk-transition", json=body, headers=admin_headers)
+    assert response.status_code == 200
+    statuses = {r["keg_id"]: r["status"] for r in response.json()}
+    assert [statuses[k] for k in keg_ids] == ["updated"] * 3
+    assert statuses[clean_id] == "unchanged"
+    assert statuses["missing"] == "not_found"
+    assert len(statements) == 4  # SELECT + UPDATE contador + UPDATE executemany + INSERT executemany
+    response = await client.get(f"/api/kegs/{keg_ids[0]}/history", headers=admin_headers)
+    assert response.json()[0]["old_state"] == "dirty"
+    assert response.json()[0]["new_state"] == "clean"
+    body = {"brewery_id": brewery.id, "state": "clean", "target_state": "ready"}
+    response = await client.post("/api/kegs/bulk-transition", json=body, headers=admin_headers)
+    assert sorted(r["keg_id"] for r in response.json()) == sorted(keg_ids + [clean_id])
+
+@pytest.mark.asyncio
+async def test_bulk_transition_concurrent_change(client, brewery, admin_headers, monkeypatch):
+    from app.api import kegs as kegs_api
+    from app.db.database import SessionLocal
+    from app.db.models import Keg, KegState
+    keg_ids = []
+    for i in range(2):
+        response = await client.post("/api/kegs/", json=keg_payload(brewery, state="dirty"), headers=admin_headers)
+        keg_ids.append(response.json()["id"])
+    next_versions = kegs_api.next_versions
+
+    def transition_first_meanwhile(db, count=1):
+        # Otra petición cambia el primer barril entre la lectura y el UPDATE
+        other = SessionLocal()
+        other.query(Keg).filter(Keg.id == keg_ids[0]).update({"state": KegState.IN_USE})
+        other.commit()
+        other.close()
+        return next_versions(db, count)
+
+    monkeypatch.setattr(kegs_api, "next_versions", transition_first_meanwhile)
+    body = {"keg_ids": keg_ids, "target_state": "clean"}
+    response = await client.post("/api/kegs/bulk-transition", json=body, headers=admin_headers)
+    results = {r["keg_id"]: r for r in response.json()}
+    assert results[keg_ids[0]] == {"keg_id": keg_ids[0], "status": "conflict", "old_state": "in_use"}
+    assert results[keg_ids[1]]["status"] == "updated"
+    assert (await client.get(f"/api/kegs/{keg_ids[0]}", headers=admin_headers)).json()["state"] == "in_use"
+    assert (await client.get(f"/api/kegs/{keg_ids[0]}/history", headers=admin_headers)).json() == []
+    assert (await client.get(f"/api/kegs/{keg_ids[1]}", headers=admin_headers)).json()["state"] == "clean"
+
+@pytest.mark.asyncio
+async def test_import_kegs(client, brewery, admin_headers):
+    csv_content = (
+        "name,type,connector,capacity,current_content,beer_type,state,brewery_id,location\n"
+        f"Importado 1,keg,S,50,0,Lager,,{brewery.id},Cámara\n"
+        f"Importado 2,corni,ball_lock,19,19,IPA,in_use,{brewery.id},\n"
+        f"Malo,keg,X,50,0,Lager,,{brewery.id},\n"
+        "Sin cervecería,keg,S,50,0,Lager,,no-existe,\n"
+    )
+    files = {"file": ("kegs.csv", csv_content.encode(), "text/csv")}
+    response = await client.post("/api/kegs/import", files=files, headers=admin_headers)
+    assert response.status_code == 200
+    result = response.json()
+    assert result["created"] == 2
+    assert result["failed"] == 2
+    assert [e["row"] for e in result["errors"]] == [4, 5]
+    ndjson_content = "\n".join([
+        '{"name": "NDJSON", "type": "keg", "connector": "A", "capacity": 30, "current_content": 0, "beer_type": "Stout", "brewery_id": "%s"}' % brewery.id,
+        "no es json",
+    ])
+    files = {"file": ("kegs.ndjson", ndjson_content.encode(), "application/x-ndjson")}
+    response = await client.post("/api/kegs/import", files=files, headers=admin_headers)
+    assert response.json()["created"] == 1
+    assert response.json()["errors"][0]["row"] == 2
+    response = await client.get("/api/kegs/", params={"brewery_id": brewery.id}, headers=admin_headers)
+    assert sorted(k["name"] for k in response.json()) == ["Importado 1", "Importado 2", "NDJSON"]
+
+@pytest.mark.asyncio
+async def test_export_kegs_and_history(client, brewery, admin_headers):
+    response = await client.post("/api/kegs/", json=keg_payload(brewery, name="Exportado"), headers=admin_headers)
+    keg_id = response.json()["id"]
+    await client.patch(f"/api/kegs/{keg_id}", json=keg_payload(brewery, name="Exportado", state="empty"), headers=admin_headers)
+    response = await client.get("/api/kegs/export", params={"brewery_id": brewery.id}, headers=admin_headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    lines = response.text.strip().splitlines()
+    assert lines[0].startswith("id,name,type")
+    assert len(lines) == 2 and "Exportado" in lines[1] and "empty" in lines[1]
+    params = {"brewery_id": brewery.id, "format": "ndjson", "since": "2000-01-01T00:00:00"}
+    response = await client.get("/api/kegs/history/export", params=params, headers=admin_headers)
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [(r["keg_id"], r["old_state"], r["new_state"]) for r in rows] == [(keg_id, "ready", "empty")]
+
+@pytest.mark.asyncio
+async def test_keg_labels_pdf(client, brewery, admin_headers):
+    for i in range(25):
+        await client.post("/api/kegs/", json=keg_payload(brewery, name=f"Etiqueta {i}"), headers=admin_headers)
+    response = await client.get("/api/kegs/labels", params={"brewery_id": brewery.id}, headers=admin_headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/pdf"
+    assert response.content.startswith(b"%PDF")
+    assert response.content.count(b"/Type /Page\n") == 2
+
+@pytest.mark.asyncio
+async def test_keg_stats(client, brewery, admin_headers):
+    await client.post("/api/kegs/", json=keg_payload(brewery, capacity=50, current_content=20, location="Bar"), headers=admin_headers)
+    await client.post("/api/kegs/", json=keg_payload(brewery, state="dirty", capacity=20, current_content=0), headers=admin_headers)
+    response = await client.get("/api/kegs/stats", params={"brewery_id": brewery.id}, headers=admin_headers)
+    assert response.status_code == 200
+    [stats] = response.json()
+    assert stats["total"] == 2
+    assert stats["by_state"]["ready"] == 1 and stats["by_state"]["dirty"] == 1
+    assert (stats["current_content"], stats["capacity"]) == (20, 70)
+    assert stats["by_beer_type"] == [{"beer_type": "IPA", "count": 2, "current_content": 20}]
+    # Una escritura invalida la cache de la cervecería
+    await client.post("/api/kegs/", json=keg_payload(brewery, beer_type="Stout"), headers=admin_headers)
+    response = await client.get("/api/kegs/stats", params={"brewery_id": brewery.id}, headers=admin_headers)
+    assert response.json()[0]["total"] == 3
+
+@pytest.mark.asyncio
+async def test_keg_changes_since_version(client, brewery, admin_headers):
+    base = (await client.get("/api/kegs/changes", params={"brewery_id": brewery.id}, headers=admin_headers)).json()
+    assert base["upserts"] == [] and base["deleted"] == [] and not base["reset"]
+    ids = []
+    for i in range(3):
+        response = await client.post("/api/kegs/", json=keg_payload(brewery, name=f"Sync {i}"), headers=admin_headers)
+        ids.append(response.json()["id"])
+    await client.patch(f"/api/kegs/{ids[0]}", json=keg_payload(brewery, name="Sync 0", state="empty"), headers=admin_headers)
+    await client.delete(f"/api/kegs/{ids[1]}", headers=admin_headers)
+    params = {"brewery_id": brewery.id, "since": base["version"]}
+    changes = (await client.get("/api/kegs/changes", params=params, headers=admin_headers)).json()
+    # Solo el estado final: ids[2] creado, ids[0] modificado después, ids[1] eliminado
+    assert [k["id"] for k in changes["upserts"]] == [ids[2], ids[0]]
+    assert changes["upserts"][1]["state"] == "empty"
+    assert [d["id"] for d in changes["deleted"]] == [ids[1]]
+    assert not changes["has_more"]
+    # Paginación por versión
+    seen, since = [], base["version"]
+    while True:
+        page = (await client.get("/api/kegs/changes", params={"brewery_id": brewery.id, "since": since, "limit": 1}, headers=admin_headers)).json()
+        seen += [k["id"] for k in page["upserts"]] + [d["id"] for d in page["deleted"]]
+        since = page["version"]
+        if not page["has_more"]:
+            break
+    assert seen == [ids[2], ids[0], ids[1]]
+    assert (await client.get("/api/kegs/changes", params={"brewery_id": brewery.id, "since": since}, headers=admin_headers)).json()["upserts"] == []
+    # Versión desconocida: resincronización completa
+    reset = (await client.get("/api/kegs/changes", params={"brewery_id": brewery.id, "since": 10 ** 12}, headers=admin_headers)).json()
+    assert reset["reset"] and {k["id"] for k in reset["upserts"]} == {ids[0], ids[2]}
+
+@pytest.mark.asyncio
+async def test_conditional_get_with_etag(client, brewery, admin_headers):
+    response = await client.post("/api/kegs/", json=keg_payload(brewery, name="Cacheable"), headers=admin_headers)
+    keg_id = response.json()["id"]
+    params = {"brewery_id": brewery.id}
+    first = await client.get("/api/kegs/", params=params, headers=admin_headers)
+    etag = first.headers["ETag"]
+    with count_queries() as statements:
+        response = await client.get("/api/kegs/", params=params, headers={**admin_headers, "If-None-Match": etag})
+    assert response.status_code == 304 and response.content == b""
+    assert len(statements) == 1
+    # Otros parámetros, otro ETag
+    other = await client.get("/api/kegs/", params={**params, "limit": 5}, headers={**admin_headers, "If-None-Match": etag})
+    assert other.status_code == 200
+    keg = await client.get(f"/api/kegs/{keg_id}", headers=admin_headers)
+    assert keg.headers["Last-Modified"].endswith("GMT")
+    response = await client.get(f"/api/kegs/{keg_id}", headers={**admin_headers, "If-None-Match": f'W/{keg.headers["ETag"]}'})
+    assert response.status_code == 304
+    # Un cambio en la cervecería invalida el listado y el barril
+    await client.patch(f"/api/kegs/{keg_id}", json=keg_payload(brewery, name="Cacheable", state="empty"), headers=admin_headers)
+    response = await client.get("/api/kegs/", params=params, headers={**admin_headers, "If-None-Match": etag})
+    assert response.status_code == 200 and response.json()[0]["state"] == "empty"
+    response = await client.get(f"/api/kegs/{keg_id}", headers={**admin_headers, "If-None-Match": keg.headers["ETag"]})
+    assert response.status_code == 200
+    # También un borrado
+    list_etag = (await client.get("/api/kegs/", params=params, headers=admin_headers)).headers["ETag"]
+    await client.delete(f"/api/kegs/{keg_id}", headers=admin_headers)
+    response = await client.get("/api/kegs/", params=params, headers={**admin_headers, "If-None-Match": list_etag})
+    assert response.status_code == 200 and response.json() == []
+
+@pytest.mark.asyncio
+async def test_conditional_get_users_and_breweries(client, brewery, admin_headers):
+    for path, create in (
+        ("/api/users/", {"email": "etag-user@example.com", "password": "secreto", "brewery_id": brewery.id}),
+        ("/api/breweries/", {"name": "Cervecería ETag"}),
+    ):
+        etag = (await client.get(path, headers=admin_headers)).headers["ETag"]
+        response = await client.get(path, headers={**admin_headers, "If-None-Match": etag})
+        assert response.status_code == 304
+        assert (await client.post(path, json=create, headers=admin_headers)).status_code == 200
+        response = await client.get(path, headers={**admin_headers, "If-None-Match": etag})
+        assert response.status_code == 200 and response.headers["ETag"] != etag
+
+@pytest.mark.asyncio
+async def test_sync_operations_idempotent(client, brewery, admin_headers, monkeypatch):
+    from app.services import keg_sync
+    # Sin la purga periódica de claves, que añadiría una sentencia al primer lote del proceso
+    monkeypatch.setattr(keg_sync, "_last_purge", float("inf"))
+    response = await client.post("/api/kegs/", json=keg_payload(brewery, name="Offline", state="ready"), headers=admin_headers)
+    keg = response.json()
+    ops = [
+        {"idempotency_key": "op-1", "keg_id": keg["id"], "client_ts": "2024-01-01T10:00:00Z", "base_version": keg["version"], "changes": {"state": "in_use"}},
+        {"idempotency_key": "op-2", "keg_id": keg["id"], "client_ts": "2024-01-01T11:00:00Z", "base_version": keg["version"], "changes": {"state": "empty", "current_content": 0}},
+        {"idempotency_key": "op-3", "keg_id": "missing", "client_ts": "2024-01-01T11:00:00Z", "changes": {"state": "empty"}},
+    ]
+    with count_queries() as statements:
+        response = await client.post("/api/kegs/sync", json={"operations": ops}, headers=admin_headers)
+    assert response.status_code == 200
+    results = response.json()
+    assert [r["status"] for r in results] == ["applied", "applied", "not_found"]
+    assert results[1]["keg"]["state"] == "empty" and results[1]["keg"]["current_content"] == 0
+    assert results[1]["keg"]["version"] > keg["version"]
+    # Sentencias fijas: claves, barriles, contador, UPDATE, historial, claves
+    assert len(statements) == 6
+    history = (await client.get(f"/api/kegs/{keg['id']}/history", headers=admin_headers)).json()
+    assert [(h["old_state"], h["new_state"]) for h in history] == [("in_use", "empty"), ("ready", "in_use")]
+    assert history[1]["changed_at"].startswith("2024-01-01T10:00")
+    # Reenvío del lote completo: mismos resultados, sin historial duplicado
+    response = await client.post("/api/kegs/sync", json={"operations": ops}, headers=admin_headers)
+    assert [r["status"] for r in response.json()] == ["applied", "applied", "not_found"]
+    assert all(r["replayed"] for r in response.json())
+    assert len((await client.get(f"/api/kegs/{keg['id']}/history", headers=admin_headers)).json()) == 2
+
+@pytest.mark.asyncio
+async def test_sync_detects_conflicts(client, brewery, admin_headers):
+    response = await client.post("/api/kegs/", json=keg_payload(brewery, name="Conflicto"), headers=admin_headers)
+    keg = response.json()
+    await client.patch(f"/api/kegs/{keg['id']}", json=keg_payload(brewery, name="Conflicto", location="Bar"), headers=admin_headers)
+    ops = [
+        # Versión antigua
+        {"idempotency_key": "c-1", "keg_id": keg["id"], "client_ts": "2030-01-01T00:00:00", "base_version": keg["version"], "changes": {"location": "Cámara"}},
+        # Sin versión, pero anterior al último cambio del servidor
+        {"idempotency_key": "c-2", "keg_id": keg["id"], "client_ts": "2000-01-01T00:00:00", "changes": {"location": "Cámara"}},
+    ]
+    results = (await client.post("/api/kegs/sync", json={"operations": ops}, headers=admin_headers)).json()
+    assert [r["status"] for r in results] == ["conflict", "conflict"]
+    assert results[0]["keg"]["location"] == "Bar"
+    user = make_user(brewery, UserRole.USER)
+    other = make_user(brewery, UserRole.USER)
+    op = {"idempotency_key": "shared", "keg_id": keg["id"], "client_ts": "2030-01-01T00:00:00", "changes": {"current_content": 5}}
+    # Las claves son por usuario
+    for u in (user, other):
+        response = await client.post("/api/kegs/sync", json={"operations": [op]}, headers=auth_headers(u))
+        assert response.json()[0]["status"] == "applied" and not response.json()[0]["replayed"]
+    response = await client.post("/api/kegs/sync", json={"operations": []}, headers=admin_headers)
+    assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_sync_does_not_revert_concurrent_write(client, brewery, admin_headers, monkeypatch):
+    from app.services import keg_sync
+    from app.db.database import SessionLocal
+    from app.db.models import Keg, KegState
+    keg = (await client.post("/api/kegs/", json=keg_payload(brewery, name="Carrera", state="ready"), headers=admin_headers)).json()
+    next_versions = keg_sync.next_versions
+
+    def commit_meanwhile(db, count=1):
+        # Otro worker confirma un cambio de estado entre la lectura del barril y el UPDATE
+        other = SessionLocal()
+        other.query(Keg).filter(Keg.id == keg["id"]).update({"state": KegState.IN_USE, "version": Keg.version + 1000})
+        other.commit()
+        other.close()
+        monkeypatch.setattr(keg_sync, "next_versions", next_versions)
+        return next_versions(db, count)
+
+    monkeypatch.setattr(keg_sync, "next_versions", commit_meanwhile)
+    op = {"idempotency_key": "race-1", "keg_id": keg["id"], "client_ts": "2030-01-01T00:00:00", "base_version": keg["version"], "changes": {"current_content": 3}}
+    [result] = (await client.post("/api/kegs/sync", json={"operations": [op]}, headers=admin_headers)).json()
+    assert result["status"] == "conflict"
+    assert result["keg"]["state"] == "in_use"
+    current = (await client.get(f"/api/kegs/{keg['id']}", headers=admin_headers)).json()
+    assert (current["state"], current["current_content"]) == ("in_use", keg["current_content"])
+    # Reintento con la versión actual: solo cambia la columna de la operación
+    op = dict(op, idempotency_key="race-2", base_version=current["version"])
+    [result] = (await client.post("/api/kegs/sync", json={"operations": [op]}, headers=admin_headers)).json()
+    assert (result["status"], result["keg"]["state"], result["keg"]["current_content"]) == ("applied", "in_use", 3)
+
+@pytest.mark.asyncio
+async def test_search_kegs(client, brewery, admin_headers):
+    created = {}
+    for name, beer_type, location in (
+        ("Imperial Oatmeal", "Stout", "Bar"),
+        ("Lote 7", "Pale Ale", "Almacén imperial"),
+        ("Session", "IPA", "Cliente"),
+    ):
+        response = await client.post("/api/kegs/", json=keg_payload(brewery, name=name, beer_type=beer_type, location=location), headers=admin_headers)
+        created[name] = response.json()["id"]
+
+    async def search(q, **params):
+        response = await client.get("/api/kegs/search", params={"q": q, "brewery_id": brewery.id, **params}, headers=admin_headers)
         assert response.status_code == 200
-        # Eliminar barril
-        response = await ac.delete(f"/api/kegs/{keg_id}")
-        assert response.status_code == 200 
\ No newline at end of file
+        return [k["name"] for k in response.json()]
+
+    # Prefijo, sin acentos; coincidencia en el nombre antes que en la ubicación
+    assert await search("imper") == ["Imperial Oatmeal", "Lote 7"]
+    assert await search("almacen") == ["Lote 7"]
+    assert await search("pale lot") == ["Lote 7"]
+    # El índice sigue a las escrituras
+    await client.patch(f"/api/kegs/{created['Session']}", json=keg_payload(brewery, name="Hazy Session", beer_type="IPA", location="Cliente"), headers=admin_headers)
+    assert await search("hazy") == ["Hazy Session"]
+    await client.delete(f"/api/kegs/{created['Imperial Oatmeal']}", headers=admin_headers)
+    assert await search("oatmeal", fuzzy=False) == []
+    # Con erratas: índice de trigramas
+    assert await search("hazzy sesion") == ["Hazy Session"]
+    assert await search("sesion", fuzzy=False) == []
+    response = await client.get("/api/kegs/search", params={"q": "hazy", "brewery_id": "otra"}, headers=admin_headers)
+    assert response.json() == []
+    # Un cambio de estado no invalida el índice de trigramas; un cambio de nombre sí
+    index = keg_search.trigram_cache.get(brewery.id)
+    assert index is not None
+    await client.post("/api/kegs/bulk-transition", json={"keg_ids": [created["Session"]], "target_state": "dirty"}, headers=admin_headers)
+    assert keg_search.trigram_cache.get(brewery.id) is index
+    await client.patch(f"/api/kegs/{created['Lote 7']}", json=keg_payload(brewery, name="Lote 8", beer_type="Pale Ale", location="Almacén imperial"), headers=admin_headers)
+    assert keg_search.trigram_cache.get(brewery.id) is None
+    # El rowid implícito de kegs puede cambiar (VACUUM, volcado y restauración): el índice se enlaza por id
+    with engine.begin() as conn:
+        conn.exec_driver_sql("UPDATE kegs SET rowid = rowid + 1000")
+    assert await search("hazy") == ["Hazy Session"]
+    assert await search("lote") == ["Lote 8"]
+
+@pytest.mark.asyncio
+async def test_fuzzy_search_cold_index_async_mode(async_mode, client, brewery, admin_headers, monkeypatch):
+    for name in ("Hazy Session", "Imperial Stout"):
+        await client.post("/api/kegs/", json=keg_payload(brewery, name=name), headers=admin_headers)
+    builds = []
+
+    class SlowIndex(keg_search.TrigramIndex):
+        def __init__(self, rows):
+            builds.append(1)
+            time.sleep(0.2)
+            super().__init__(rows)
+
+    monkeypatch.setattr(keg_search, "TrigramIndex", SlowIndex)
+    keg_search.trigram_cache.clear()
+
+    async def search():
+        return await client.get("/api/kegs/search", params={"q": "hazzy sesion", "brewery_id": brewery.id, "fuzzy": True}, headers=admin_headers)
+
+    # Con DB_ASYNC los handlers corren en el hilo del loop: la construcción del índice no puede bloquearlo
+    responses = await asyncio.wait_for(asyncio.gather(*(search() for _ in range(4)), client.get("/")), 10)
+    for response in responses[:4]:
+        assert response.status_code == 200, response.text
+        assert [k["name"] for k in response.json()] == ["Hazy Session"]
+    assert len(builds) == 1
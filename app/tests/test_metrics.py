@@ -0,0 +1,58 @@
+import logging
+import os
+import pytest
+from app.core.config import get_settings
+from app.db.models import UserRole
+from app.tests.conftest import auth_headers, make_user
+
+@pytest.mark.asyncio
+async def test_request_metrics_and_prometheus(client, admin_headers):
+    response = await client.get("/api/kegs/", headers=admin_headers)
+    assert response.status_code == 200
+    assert "db;dur=" in response.headers["Server-Timing"]
+    response = await client.get("/metrics", headers=admin_headers)
+    assert response.status_code == 200
+    body = response.text
+    assert 'kegtracker_request_duration_seconds_count{method="GET",route="/api/kegs/"}' in body
+    assert 'kegtracker_requests_total{method="GET",route="/api/kegs/",status="200"}' in body
+    queries = [line for line in body.splitlines() if line.startswith('kegtracker_request_sql_queries_total{method="GET",route="/api/kegs/"}')]
+    assert int(queries[0].split()[-1]) >= 1
+    assert "kegtracker_db_pool_checkouts" in body
+    assert "kegtracker_cache_auth_hits" in body
+
+@pytest.mark.asyncio
+async def test_metrics_require_admin_or_token(client, brewery, monkeypatch):
+    assert (await client.get("/metrics")).status_code == 401
+    user_headers = auth_headers(make_user(brewery, UserRole.ADMIN))
+    assert (await client.get("/metrics", headers=user_headers)).status_code == 403
+    monkeypatch.setattr(get_settings(), "METRICS_TOKEN", "scraper-token")
+    assert (await client.get("/metrics", headers={"Authorization": "Bearer otro"})).status_code == 403
+    assert (await client.get("/metrics", headers={"Authorization": "Bearer scraper-token"})).status_code == 200
+
+@pytest.mark.asyncio
+async def test_slow_query_and_request_logging(client, admin_headers, monkeypatch, caplog):
+    monkeypatch.setattr(get_settings(), "SLOW_QUERY_MS", 0)
+    monkeypatch.setattr(get_settings(), "SLOW_REQUEST_MS", 0)
+    with caplog.at_level(logging.WARNING, logger="app.core.metrics"):
+        response = await client.get("/api/kegs/", headers=admin_headers)
+    assert response.status_code == 200
+    messages = [record.getMessage() for record in caplog.records]
+    assert any(m.startswith("Consulta lenta") and "FROM kegs" in m for m in messages)
+    assert any(m.startswith("Petición lenta: GET /api/kegs/") for m in messages)
+
+@pytest.mark.asyncio
+async def test_profiling_header(client, brewery, admin_headers, monkeypatch, tmp_path):
+    response = await client.get("/api/kegs/", headers={**admin_headers, "X-Profile": "1"})
+    assert "X-Profile-Id" not in response.headers  # desactivado por defecto
+    monkeypatch.setattr(get_settings(), "PROFILING_ENABLED", True)
+    monkeypatch.setattr(get_settings(), "PROFILE_DIR", str(tmp_path))
+    # Solo un admin global
+    user_headers = auth_headers(make_user(brewery, UserRole.ADMIN))
+    response = await client.get("/api/kegs/", headers={**user_headers, "X-Profile": "1"})
+    assert response.status_code == 200
+    assert "X-Profile-Id" not in response.headers
+    response = await client.get("/api/kegs/", headers={**admin_headers, "X-Profile": "1"})
+    assert response.status_code == 200
+    assert "X-Profile-File" not in response.headers
+    [profile] = os.listdir(tmp_path)
+    assert profile.startswith(response.headers["X-Profile-Id"] + "-GET-")
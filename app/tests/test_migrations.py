@@ -0,0 +1,89 @@
+import threading
+from sqlalchemy import create_engine, inspect, text
+from app.db.migrations import MIGRATIONS, upgrade
+
+def test_upgrade_adds_missing_columns_and_indexes(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    # Esquema antiguo: sin índices compuestos ni columna location
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE kegs (id VARCHAR NOT NULL PRIMARY KEY, name VARCHAR, type VARCHAR(5), "
+            "connector VARCHAR(9), capacity INTEGER, current_content INTEGER, beer_type VARCHAR, "
+            "state VARCHAR(6), brewery_id VARCHAR)"
+        ))
+        conn.execute(text("INSERT INTO kegs (id, name, brewery_id) VALUES ('k1', 'Viejo', 'b1')"))
+    changes = upgrade(engine)
+    assert "add column kegs.location" in changes
+    assert "create index ix_kegs_brewery_state" in changes
+    inspector = inspect(engine)
+    assert "location" in {c["name"] for c in inspector.get_columns("kegs")}
+    assert "ix_kegs_brewery_state" in {i["name"] for i in inspector.get_indexes("kegs")}
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT name FROM kegs")).scalar() == "Viejo"
+    # Idempotente
+    assert upgrade(engine) == []
+
+def test_upgrade_backfills_keg_versions(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE kegs (id VARCHAR NOT NULL PRIMARY KEY, name VARCHAR, type VARCHAR(5), "
+            "connector VARCHAR(9), capacity INTEGER, current_content INTEGER, beer_type VARCHAR, "
+            "state VARCHAR(6), brewery_id VARCHAR, location VARCHAR)"
+        ))
+        conn.execute(text("INSERT INTO kegs (id, name, brewery_id) VALUES ('k2', 'B', 'b1'), ('k1', 'A', 'b1')"))
+    changes = upgrade(engine)
+    assert "migration 1: keg change versions" in changes
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT id, version FROM kegs ORDER BY id")).all() == [("k1", 1), ("k2", 2)]
+        assert conn.execute(text("SELECT value FROM change_counters WHERE name = 'kegs'")).scalar() == 2
+
+def test_upgrade_relinks_legacy_search_index(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    # Primera versión de la migración 3: kegs_fts enlazado con el rowid implícito de kegs
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE kegs (id VARCHAR NOT NULL PRIMARY KEY, name VARCHAR, type VARCHAR(5), "
+            "connector VARCHAR(9), capacity INTEGER, current_content INTEGER, beer_type VARCHAR, "
+            "state VARCHAR(6), brewery_id VARCHAR, location VARCHAR)"
+        ))
+        conn.execute(text("CREATE VIRTUAL TABLE kegs_fts USING fts5(name, beer_type, location, content='kegs', content_rowid='rowid')"))
+        conn.execute(text(
+            "CREATE TRIGGER kegs_fts_ai AFTER INSERT ON kegs BEGIN "
+            "INSERT INTO kegs_fts(rowid, name, beer_type, location) VALUES (new.rowid, new.name, new.beer_type, new.location); END"
+        ))
+        conn.execute(text("CREATE TABLE schema_migrations (version INTEGER PRIMARY KEY, name VARCHAR(255), applied_at DATETIME)"))
+        conn.execute(text("INSERT INTO schema_migrations (version, name) VALUES (3, 'keg search index')"))
+        conn.execute(text("INSERT INTO kegs (id, name, beer_type, brewery_id) VALUES ('k1', 'Porter', 'Stout', 'b1')"))
+    changes = upgrade(engine)
+    assert "migration 5: keg search index by keg id" in changes
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO kegs (id, name, beer_type, brewery_id) VALUES ('k2', 'Lager', 'Pils', 'b1')"))
+        matches = conn.execute(text(
+            "SELECT kegs_search.keg_id FROM kegs_fts JOIN kegs_search ON kegs_search.rowid = kegs_fts.rowid "
+            "WHERE kegs_fts MATCH :q"
+        ), {"q": "porter"}).scalars().all()
+        assert matches == ["k1"]
+        assert conn.execute(text("SELECT keg_id FROM kegs_search ORDER BY keg_id")).scalars().all() == ["k1", "k2"]
+
+def test_concurrent_upgrades_apply_once(tmp_path):
+    # Varios workers arrancando a la vez sobre la misma base de datos vacía
+    url = f"sqlite:///{tmp_path / 'new.db'}"
+    errors = []
+    results = []
+
+    def start_worker():
+        try:
+            results.append(upgrade(create_engine(url)))
+        except Exception as error:
+            errors.append(error)
+
+    workers = [threading.Thread(target=start_worker) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert errors == []
+    assert sorted(len(changes) > 0 for changes in results) == [False, False, True]
+    with create_engine(url).connect() as conn:
+        assert conn.execute(text("SELECT version FROM schema_migrations ORDER BY version")).scalars().all() == [m[0] for m in MIGRATIONS]
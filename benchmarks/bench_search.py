@@ -0,0 +1,66 @@
+# Latencia de GET /api/kegs/search sobre una flota sintética: índice FTS5 (SQLite), LIKE por subcadena
+# (como filtraba antes el cliente) y el índice de trigramas en memoria para búsquedas con erratas.
+#
+#   python -m benchmarks.bench_search --kegs 100000 --queries 200
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+QUERIES = ["ipa", "stout imp", "almacen", "barril 123", "porter bar", "lager cli", "pils", "barril 99"]
+TYPOS = ["stuot", "almacne", "portr", "barirl 123"]
+
+def measure(label, fn, queries, runs):
+    rnd = random.Random(1)
+    times, hits = [], 0
+    for _ in range(runs):
+        q = rnd.choice(queries)
+        start = time.perf_counter()
+        hits += len(fn(q))
+        times.append(time.perf_counter() - start)
+    times.sort()
+    print(f"{label:34} p50={statistics.median(times) * 1000:7.2f} ms  p95={times[int(len(times) * 0.95) - 1] * 1000:7.2f} ms  resultados/consulta={hits / runs:5.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Latencia de la búsqueda de barriles")
+    parser.add_argument("--kegs", type=int, default=100000)
+    parser.add_argument("--breweries", type=int, default=1)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+    os.environ["DB_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='bench-search-'), 'search.db')}"
+    from benchmarks.load import seed
+    from app.api.kegs import keg_out_query
+    from app.db.database import SessionLocal
+    from app.db.models import Keg
+    from app.services import keg_search
+    start = time.perf_counter()
+    data = seed(argparse.Namespace(breweries=args.breweries, kegs=args.kegs, history=0, users=1), random.Random(42))
+    print(f"Dataset: {args.kegs} barriles sembrados (índice FTS por triggers) en {time.perf_counter() - start:.1f}s")
+    brewery_id = data["brewery_ids"][0]
+    db = SessionLocal()
+    try:
+        measure("FTS5 + bm25", lambda q: keg_search.search(db, keg_out_query(db), q, brewery_id), QUERIES, args.queries)
+
+        def like(q):
+            query = keg_out_query(db).filter(Keg.brewery_id == brewery_id)
+            for word in keg_search.terms(q):
+                pattern = f"%{word}%"
+                query = query.filter(Keg.name.ilike(pattern) | Keg.beer_type.ilike(pattern) | Keg.location.ilike(pattern))
+            return query.order_by(Keg.name).limit(20).all()
+        measure("antes: LIKE por subcadena", like, QUERIES, args.queries)
+
+        start = time.perf_counter()
+        keg_search.trigram_index(db, brewery_id)
+        print(f"{'construcción índice de trigramas':34} {(time.perf_counter() - start) * 1000:7.0f} ms")
+        measure("trigramas (con erratas)", lambda q: keg_search.fuzzy_search(db, keg_out_query(db), q, brewery_id), TYPOS, args.queries)
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
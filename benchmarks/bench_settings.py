@@ -0,0 +1,50 @@
+# Coste de get_settings y tiempo de importación/arranque de la app.
+# "antes" reproduce el get_settings original: una clase Settings nueva y una lectura del entorno y .env por llamada.
+#
+#   python -m benchmarks.bench_settings --calls 2000 --imports 5
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def per_call(fn, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return (time.perf_counter() - start) / calls
+
+def import_time(module, runs, env):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", f"import {module}"], cwd=ROOT, env=env, check=True, capture_output=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def main():
+    parser = argparse.ArgumentParser(description="Coste de get_settings y tiempo de importación")
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--imports", type=int, default=5)
+    args = parser.parse_args()
+    env = dict(os.environ, DB_URL=f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='bench-settings-'), 'bench.db')}")
+    os.environ.update(DB_URL=env["DB_URL"])
+    from pydantic import create_model
+    from app.core.config import Settings, get_settings
+
+    old = per_call(lambda: create_model("Settings", __base__=Settings)(), args.calls)
+    fresh = per_call(Settings, args.calls)
+    cached = per_call(get_settings, args.calls * 100)
+    print(f"{'antes: clase nueva + lectura por llamada':42} {old * 1e6:10.1f} µs/llamada")
+    print(f"{'Settings() sin clase nueva':42} {fresh * 1e6:10.1f} µs/llamada")
+    print(f"{'después: get_settings() cacheado':42} {cached * 1e6:10.3f} µs/llamada")
+    for module in ("app.core.config", "app.main"):
+        print(f"{'import ' + module + ' (proceso nuevo, mediana)':42} {import_time(module, args.imports, env) * 1000:10.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# Benchmark de lecturas/escrituras concurrentes sobre SQLite, con y sin el perfil de producción
+# (WAL + pragmas + serialización de escritores). Simula varios workers de uvicorn con procesos
+# y su threadpool con threads.
+#
+#   python -m benchmarks.bench_sqlite --processes 4 --threads 8 --seconds 10 --write-ratio 0.2
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ROWS = 1000
+
+def setup_db(path):
+    import sqlite3
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE kegs (id INTEGER PRIMARY KEY, name TEXT, state TEXT, current_content INTEGER)")
+    conn.execute("CREATE TABLE history (id INTEGER PRIMARY KEY AUTOINCREMENT, keg_id INTEGER, state TEXT, changed_at REAL)")
+    conn.executemany(
+        "INSERT INTO kegs (id, name, state, current_content) VALUES (?, ?, 'ready', 0)",
+        [(i, f"keg {i}") for i in range(ROWS)],
+    )
+    conn.commit()
+    conn.close()
+
+def worker(path, profile, threads, seconds, write_ratio, results):
+    from app.db.database import create_db_engine
+    engine = create_db_engine(f"sqlite:///{path}", sqlite_profile=profile)
+    counters = {"reads": 0, "writes": 0, "locked": 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def run():
+        reads = writes = locked = 0
+        rnd = random.Random()
+        while time.monotonic() < deadline:
+            keg_id = rnd.randrange(ROWS)
+            try:
+                with engine.connect() as conn:
+                    if rnd.random() < write_ratio:
+                        conn.execute(text("UPDATE kegs SET state = 'in_use', current_content = :c WHERE id = :id"), {"c": rnd.randrange(50), "id": keg_id})
+                        conn.execute(text("INSERT INTO history (keg_id, state, changed_at) VALUES (:id, 'in_use', :t)"), {"id": keg_id, "t": time.time()})
+                        conn.commit()
+                        writes += 1
+                    else:
+                        conn.execute(text("SELECT * FROM kegs WHERE id = :id"), {"id": keg_id}).fetchall()
+                        conn.execute(text("SELECT state, COUNT(*) FROM kegs GROUP BY state")).fetchall()
+                        reads += 1
+            except OperationalError:
+                locked += 1
+        with lock:
+            counters["reads"] += reads
+            counters["writes"] += writes
+            counters["locked"] += locked
+
+    pool = [threading.Thread(target=run) for _ in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    engine.dispose()
+    results.put(counters)
+
+def run_case(profile, args):
+    directory = tempfile.mkdtemp(prefix="bench-sqlite-")
+    path = os.path.join(directory, "bench.db")
+    setup_db(path)
+    results = multiprocessing.Queue()
+    procs = [
+        multiprocessing.Process(target=worker, args=(path, profile, args.threads, args.seconds, args.write_ratio, results))
+        for _ in range(args.processes)
+    ]
+    for p in procs:
+        p.start()
+    totals = {"reads": 0, "writes": 0, "locked": 0}
+    for _ in procs:
+        for key, value in results.get().items():
+            totals[key] += value
+    for p in procs:
+        p.join()
+    return totals
+
+def main():
+    parser = argparse.ArgumentParser(description="Lecturas/escrituras concurrentes sobre SQLite, antes y después del perfil de producción")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    args = parser.parse_args()
+    print(f"{args.processes} procesos x {args.threads} threads, {args.seconds}s, {args.write_ratio:.0%} escrituras")
+    for label, profile in (("antes (por defecto)", False), ("después (perfil SQLite)", True)):
+        totals = run_case(profile, args)
+        print(
+            f"{label:26} lecturas/s={totals['reads'] / args.seconds:9.1f} "
+            f"escrituras/s={totals['writes'] / args.seconds:8.1f} "
+            f"'database is locked'={totals['locked']}"
+        )
+
+if __name__ == "__main__":
+    main()
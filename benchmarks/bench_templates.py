@@ -0,0 +1,49 @@
+# Micro-benchmark de renderizado de plantillas de email: Environment por defecto (como antes) frente al
+# entorno precompilado con caché de bytecode, y la API por lotes render_many.
+#
+#   python -m benchmarks.bench_templates --renders 20000
+import argparse
+import os
+import sys
+import tempfile
+import time
+from jinja2 import Environment, FileSystemLoader
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def rate(label, renders, fn):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:38} {renders / elapsed:12.0f} renders/s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Renders por segundo de las plantillas de email")
+    parser.add_argument("--renders", type=int, default=20000)
+    parser.add_argument("--template", default="reset_password.html")
+    args = parser.parse_args()
+    from app.services.email_service import TEMPLATES_DIR, create_environment, render_many
+    contexts = [{"reset_link": f"https://kegtracker.test/reset-password?token={i}", "registration_link": f"https://kegtracker.test/register?token={i}"} for i in range(args.renders)]
+
+    default_env = Environment(loader=FileSystemLoader(TEMPLATES_DIR))
+    rate("antes: get_template + render por envío", args.renders, lambda: [
+        default_env.get_template(args.template).render(**context) for context in contexts
+    ])
+
+    cache_dir = tempfile.mkdtemp(prefix="bench-jinja-")
+    start = time.perf_counter()
+    create_environment(cache_dir=cache_dir).get_template(args.template)
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    env = create_environment(cache_dir=cache_dir)
+    env.get_template(args.template)
+    warm = time.perf_counter() - start
+    print(f"{'primera carga (compilar / desde bytecode)':38} {cold * 1000:8.2f} ms / {warm * 1000:.2f} ms")
+
+    rate("después: get_template + render", args.renders, lambda: [
+        env.get_template(args.template).render(**context) for context in contexts
+    ])
+    rate("después: render_many (lote)", args.renders, lambda: render_many(args.template, contexts))
+
+if __name__ == "__main__":
+    main()
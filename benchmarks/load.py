@@ -0,0 +1,277 @@
+# Prueba de carga reproducible de la API: siembra un dataset sintético, obtiene tokens y lanza los endpoints
+# principales con httpx, en proceso (ASGI) o contra un uvicorn local (--url, que debe usar la misma DB_URL).
+# Guarda los resultados en JSON para comparar entre commits.
+#
+#   python -m benchmarks.load --breweries 5 --kegs 20000 --history 100000 --requests 500 --concurrency 20
+#   python -m benchmarks.load --url http://127.0.0.1:8000 --db /tmp/kegs.db --seed-only      # sembrar y arrancar uvicorn aparte
+#   python -m benchmarks.load --compare benchmarks/results/load-<commit>.json
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+PASSWORD = "load-test-password"
+SEED_BATCH = 5000
+STATES = ["in_use", "empty", "dirty", "clean", "ready"]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Prueba de carga de la API de KegTracker")
+    parser.add_argument("--breweries", type=int, default=5)
+    parser.add_argument("--kegs", type=int, default=5000, help="Barriles en total, repartidos entre cervecerías")
+    parser.add_argument("--history", type=int, default=20000, help="Filas de historial de estados en total")
+    parser.add_argument("--users", type=int, default=3, help="Usuarios por cervecería")
+    parser.add_argument("--requests", type=int, default=300, help="Peticiones por escenario")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--scenarios", default="login,list_kegs,get_keg,update_keg,history,list_users")
+    parser.add_argument("--url", help="Servidor externo; por defecto la app en proceso")
+    parser.add_argument("--db", help="Fichero SQLite a usar/sembrar; por defecto uno temporal")
+    parser.add_argument("--seed", type=int, default=42, help="Semilla aleatoria (dataset y peticiones reproducibles)")
+    parser.add_argument("--seed-only", action="store_true", help="Solo sembrar la base de datos")
+    parser.add_argument("--bcrypt-rounds", type=int, default=None, help="Coste de bcrypt de la app en proceso")
+    parser.add_argument("--output", help="Fichero de resultados (por defecto benchmarks/results/load-<commit>-<fecha>.json)")
+    parser.add_argument("--compare", help="Resultados previos con los que comparar")
+    return parser.parse_args()
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def seed(args, rnd):
+    # Inserciones masivas con Core: sembrar 100k filas lleva segundos, no minutos
+    from sqlalchemy import insert
+    from app.core.security import pwd_context
+    from app.db.database import SessionLocal
+    from app.db.init_db import init_db
+    from app.db.models import Brewery, Keg, KegConnector, KegState, KegStateHistory, KegType, User, UserRole
+    from app.services.keg_changes import next_versions
+    init_db()
+    db = SessionLocal()
+    try:
+        hashed = pwd_context.hash(PASSWORD)
+        breweries = [{"id": str(uuid.uuid4()), "name": f"Load {uuid.uuid4().hex[:8]}", "active": True} for _ in range(args.breweries)]
+        db.execute(insert(Brewery), breweries)
+        brewery_ids = [b["id"] for b in breweries]
+        users = [{
+            "id": str(uuid.uuid4()),
+            "email": f"admin-{uuid.uuid4().hex[:8]}@load.example.com",
+            "hashed_password": hashed,
+            "role": UserRole.GLOBAL_ADMIN,
+            "active": True,
+            "brewery_id": brewery_ids[0],
+        }]
+        for brewery_id in brewery_ids:
+            for role in ([UserRole.ADMIN] + [UserRole.USER] * max(0, args.users - 1))[:args.users]:
+                users.append({
+                    "id": str(uuid.uuid4()),
+                    "email": f"{role.value}-{uuid.uuid4().hex[:8]}@load.example.com",
+                    "hashed_password": hashed,
+                    "role": role,
+                    "active": True,
+                    "brewery_id": brewery_id,
+                })
+        db.execute(insert(User), users)
+        keg_ids = []
+        first_version = next_versions(db, args.kegs) if args.kegs else 0
+        for start in range(0, args.kegs, SEED_BATCH):
+            batch = []
+            for i in range(start, min(start + SEED_BATCH, args.kegs)):
+                keg_id = str(uuid.uuid4())
+                keg_ids.append(keg_id)
+                batch.append({
+                    "id": keg_id,
+                    "name": f"Barril {i}",
+                    "type": rnd.choice(list(KegType)),
+                    "connector": rnd.choice(list(KegConnector)),
+                    "capacity": rnd.choice([20, 30, 50]),
+                    "current_content": rnd.randrange(50),
+                    "beer_type": rnd.choice(["IPA", "Lager", "Stout", "Porter", "Pils"]),
+                    "state": KegState(rnd.choice(STATES)),
+                    "brewery_id": brewery_ids[i % len(brewery_ids)],
+                    "location": rnd.choice(["Almacén", "Bar", "Cliente", None]),
+                    "version": first_version + i,
+                })
+            db.execute(insert(Keg), batch)
+        started = datetime.utcnow() - timedelta(days=365)
+        for start in range(0, args.history, SEED_BATCH):
+            batch = []
+            for i in range(start, min(start + SEED_BATCH, args.history)):
+                old_state, new_state = rnd.sample(STATES, 2)
+                batch.append({
+                    "id": str(uuid.uuid4()),
+                    "keg_id": rnd.choice(keg_ids),
+                    "old_state": KegState(old_state),
+                    "new_state": KegState(new_state),
+                    "changed_at": started + timedelta(seconds=rnd.randrange(365 * 24 * 3600)),
+                    "user_id": users[0]["id"],
+                })
+            db.execute(insert(KegStateHistory), batch)
+        db.commit()
+    finally:
+        db.close()
+    return {"brewery_ids": brewery_ids, "keg_ids": keg_ids, "users": users}
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+class LoadRunner:
+    def __init__(self, client, data, rnd):
+        self.client = client
+        self.data = data
+        self.rnd = rnd
+        self.headers = None
+
+    async def login(self, email=None):
+        email = email or self.data["users"][0]["email"]
+        return await self.client.post("/api/auth/login", json={"email": email, "password": PASSWORD})
+
+    async def authenticate(self):
+        response = await self.login()
+        response.raise_for_status()
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    def keg_id(self):
+        return self.rnd.choice(self.data["keg_ids"])
+
+    async def scenario_login(self):
+        return await self.login(self.rnd.choice(self.data["users"])["email"])
+
+    async def scenario_list_kegs(self):
+        params = {"brewery_id": self.rnd.choice(self.data["brewery_ids"]), "limit": 50}
+        if self.rnd.random() < 0.5:
+            params["state"] = self.rnd.choice(STATES)
+        return await self.client.get("/api/kegs/", params=params, headers=self.headers)
+
+    async def scenario_get_keg(self):
+        return await self.client.get(f"/api/kegs/{self.keg_id()}", headers=self.headers)
+
+    async def scenario_update_keg(self):
+        keg_id = self.keg_id()
+        response = await self.client.get(f"/api/kegs/{keg_id}", headers=self.headers)
+        keg = response.json()
+        payload = {key: keg[key] for key in ("name", "type", "connector", "capacity", "current_content", "beer_type", "brewery_id", "location")}
+        payload["state"] = self.rnd.choice(STATES)
+        return await self.client.patch(f"/api/kegs/{keg_id}", json=payload, headers=self.headers)
+
+    async def scenario_history(self):
+        return await self.client.get(f"/api/kegs/{self.keg_id()}/history", headers=self.headers)
+
+    async def scenario_list_users(self):
+        return await self.client.get("/api/users/", headers=self.headers)
+
+    async def run(self, name, requests, concurrency):
+        scenario = getattr(self, f"scenario_{name}")
+        latencies, errors = [], 0
+        remaining = iter(range(requests))
+
+        async def worker():
+            nonlocal errors
+            for _ in remaining:
+                start = time.perf_counter()
+                try:
+                    response = await scenario()
+                    ok = response.status_code < 400
+                except Exception:
+                    ok = False
+                latencies.append(time.perf_counter() - start)
+                if not ok:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        return {
+            "requests": requests,
+            "errors": errors,
+            "seconds": round(elapsed, 3),
+            "rps": round(requests / elapsed, 1),
+            "mean_ms": round(statistics.mean(latencies) * 1000, 2),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        }
+
+async def drive(args, data, rnd):
+    import httpx
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=60)
+    else:
+        from app.main import app
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://load.test", timeout=60)
+    results = {}
+    async with client:
+        runner = LoadRunner(client, data, rnd)
+        await runner.authenticate()
+        for name in args.scenarios.split(","):
+            results[name] = await runner.run(name.strip(), args.requests, args.concurrency)
+            r = results[name]
+            print(f"{name:12} {r['rps']:9.1f} req/s  p50={r['p50_ms']:8.2f} ms  p95={r['p95_ms']:8.2f} ms  p99={r['p99_ms']:8.2f} ms  errores={r['errors']}")
+    return results
+
+def compare(baseline_path, results):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nComparación con {baseline['meta']['commit']} ({baseline_path})")
+    for name, current in results["scenarios"].items():
+        previous = baseline["scenarios"].get(name)
+        if not previous:
+            continue
+        rps = (current["rps"] - previous["rps"]) / previous["rps"] * 100
+        p95 = (current["p95_ms"] - previous["p95_ms"]) / previous["p95_ms"] * 100 if previous["p95_ms"] else 0.0
+        print(f"{name:12} req/s {previous['rps']:9.1f} -> {current['rps']:9.1f} ({rps:+6.1f}%)  p95 {previous['p95_ms']:8.2f} -> {current['p95_ms']:8.2f} ms ({p95:+6.1f}%)")
+
+def main():
+    args = parse_args()
+    # La base de datos se fija antes de importar la app
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="kegtracker-load-"), "load.db")
+    os.environ["DB_URL"] = f"sqlite:///{db_path}"
+    os.environ["EMAIL_WORKER_ENABLED"] = "false"
+    if args.bcrypt_rounds:
+        os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    rnd = random.Random(args.seed)
+    start = time.perf_counter()
+    data = seed(args, rnd)
+    print(f"Dataset: {args.breweries} cervecerías, {args.kegs} barriles, {args.history} historial en {time.perf_counter() - start:.1f}s ({db_path})")
+    if args.seed_only:
+        print(f"Usuario admin: {data['users'][0]['email']} / {PASSWORD}")
+        return
+    scenarios = asyncio.run(drive(args, data, rnd))
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.utcnow().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "target": args.url or "in-process",
+            "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        },
+        "scenarios": scenarios,
+    }
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"load-{results['meta']['commit']}-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Resultados guardados en {output}")
+    if args.compare:
+        compare(args.compare, results)
+
+if __name__ == "__main__":
+    main()